@@ -0,0 +1,594 @@
+import bisect
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
+import platform
+import random
+import shutil
+import sys
+import time
+
+from pathlib import Path
+
+import pomps
+
+
+BENCHMARK_DATA = './data/benchmark'
+
+
+def zipf_key_picker(rng, key_cardinality, key_skew):
+    """
+    Return a func picking key numbers in [0, key_cardinality) where key number k turns up in proportion to
+    1 / (k + 1)**key_skew.  key_skew=0 is uniform, around 1 is a typical real world skew.
+    """
+    if not key_skew:
+        return lambda: rng.randrange(key_cardinality)
+
+    cum_weights = list(itertools.accumulate(1 / rank**key_skew for rank in range(1, key_cardinality + 1)))
+    total = cum_weights[-1]
+
+    return lambda: bisect.bisect_left(cum_weights, rng.random() * total)
+
+
+def generate_jsonl(filepath, rows, key_cardinality, row_width=64, fields=0, key_skew=0.0, seed=369):
+    rng = random.Random(seed)
+    pick_key = zipf_key_picker(rng, key_cardinality=key_cardinality, key_skew=key_skew)
+    Path(filepath).parent.mkdir(parents=True, exist_ok=True)
+
+    with open(filepath, 'w', encoding='utf-8') as f:
+        for i in range(rows):
+            doc = {'_id': f"key_{pick_key():012d}", 'row': i, 'payload': 'x' * row_width}
+            for field in range(fields):
+                doc[f"field_{field}"] = {'value': rng.random(), 'tags': ['a', 'b', str(field)]}
+            f.write(json.dumps(doc) + '\n')
+
+    return filepath
+
+
+def group_key_func(data):
+    return data['_id']
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # No resource module on Windows.
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024**2)
+
+    return peak / 1024
+
+
+def _measured_child(queue, func, kwargs):
+    start = time.perf_counter()
+    extra = func(**kwargs)
+    result = {'seconds': round(time.perf_counter() - start, 3), 'peak_rss_mb': peak_rss_mb()}
+    if isinstance(extra, dict):
+        result.update(extra)
+    queue.put(result)
+
+
+def measure(func, **kwargs):
+    """
+    Run func in a fresh process so that peak RSS belongs to this run alone.  If func returns a dict, it is folded into
+    the result.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measured_child, args=(queue, func, kwargs))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    return result
+
+
+def fresh_copy(source_path, name):
+    run_path = f"{BENCHMARK_DATA}/{name}/source_data.jsonl"
+    shutil.rmtree(Path(run_path).parent, ignore_errors=True)
+    Path(run_path).parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(source_path, run_path)
+
+    return run_path
+
+
+def bench_sampled_bucket_boundaries(rows=1_000_000, key_cardinality=200_000, group_buckets=16, key_sample_size=10_000):
+    source_path = generate_jsonl(f"{BENCHMARK_DATA}/sampled_bucket_boundaries.jsonl", rows=rows, key_cardinality=key_cardinality)
+
+    results = {}
+    for name, sample_size in [('exact', None), ('sampled', key_sample_size)]:
+        run_path = fresh_copy(source_path, f"sampled_bucket_boundaries_{name}")
+        results[name] = measure(
+            pomps.group_data,
+            source_path=run_path,
+            group_key_func=group_key_func,
+            group_buckets=group_buckets,
+            key_sample_size=sample_size,
+        )
+
+    return results
+
+
+def linear_get_bucket(key, bucket_map):
+    """
+    The get_bucket() lookup as it was before bisect, kept here as the reference point.
+    """
+    for bucket in bucket_map:
+        if bucket_map[bucket][0] <= key <= bucket_map[bucket][1]:
+            return bucket
+
+
+def bench_bucket_lookup(lookups=200_000, key_cardinality=1_000_000, bucket_counts=(1, 10, 100, 1000)):
+    """
+    Throughput of the per row bucket lookup a range partitioned bucketing pass makes, with bisect and with the old linear
+    scan, as the number of buckets grows.  See bench_bucket_partitioning() for the whole group_data() run.
+    """
+    rng = random.Random(369)
+    keys = [f"key_{rng.randrange(key_cardinality):012d}" for _ in range(lookups)]
+    all_keys = sorted(f"key_{key:012d}" for key in range(key_cardinality))
+
+    results = {}
+    for buckets in bucket_counts:
+        bucket_map = pomps.generate_bucket_map(keys=all_keys, buckets=buckets)
+        bucket_starts, bucket_names = pomps.bucket_boundaries(bucket_map)
+
+        start = time.perf_counter()
+        for key in keys:
+            pomps.get_bucket(key=key, bucket_starts=bucket_starts, bucket_names=bucket_names)
+        bisect_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for key in keys:
+            linear_get_bucket(key=key, bucket_map=bucket_map)
+        linear_seconds = time.perf_counter() - start
+
+        results[buckets] = {
+            'bisect_lookups_per_second': int(lookups / bisect_seconds),
+            'linear_lookups_per_second': int(lookups / linear_seconds),
+        }
+
+    return results
+
+
+def bench_bucket_partitioning(rows=500_000, key_cardinality=100_000, key_skew=1.0, bucket_counts=(1, 10, 100, 1000)):
+    """
+    group_data() end to end with partition='range' and partition='hash' on the same skewed source, as the number of
+    buckets grows.  Range buckets put the hottest keys together while hash buckets spread them out.
+    """
+    source_path = generate_jsonl(
+        f"{BENCHMARK_DATA}/bucket_partitioning.jsonl", rows=rows, key_cardinality=key_cardinality, key_skew=key_skew
+    )
+
+    results = {}
+    for buckets in bucket_counts:
+        for partition in ['range', 'hash']:
+            run_path = fresh_copy(source_path, f"bucket_partitioning_{partition}_{buckets}")
+            results[f"{partition}_{buckets}"] = measure(
+                run_stage,
+                stage_func=pomps.group_data,
+                source_path=run_path,
+                group_key_func=group_key_func,
+                group_buckets=buckets,
+                partition=partition,
+            )
+
+    return results
+
+
+def group_and_merge(source_path, group_buckets, codec, compression):
+    grouped_path = pomps.group_data(
+        source_path=source_path, group_key_func=group_key_func, group_buckets=group_buckets, codec=codec, compression=compression
+    )
+    pomps.merge_data_sources(
+        name='merged',
+        namespace=str(Path(source_path).parent),
+        data_one_jsonl_path=grouped_path,
+        data_two_jsonl_path=grouped_path,
+        merge_func=lambda val: val[1][:1],
+    )
+
+
+def bench_intermediate_codecs(rows=500_000, key_cardinality=100_000, group_buckets=4):
+    source_path = generate_jsonl(f"{BENCHMARK_DATA}/intermediate_codecs.jsonl", rows=rows, key_cardinality=key_cardinality)
+
+    results = {}
+    for codec in ['jsonl', 'pickle', 'marshal']:
+        for compression in [None, 'gzip']:
+            name = f"{codec}_{compression}"
+            run_path = fresh_copy(source_path, f"intermediate_codecs_{name}")
+            results[name] = measure(
+                group_and_merge, source_path=run_path, group_buckets=group_buckets, codec=codec, compression=compression
+            )
+
+    return results
+
+
+def group_counting_decodes(source_path, group_buckets, key_sample_size=None, partition='range'):
+    calls = {'document_decodes': 0, 'other_decodes': 0, 'group_key_func': 0}
+    json_loads = json.loads
+
+    def counting_json_loads(s, *args, **kwargs):
+        # The generated docs are json objects, while carried group_keys are json strings.
+        calls['document_decodes' if s[:1] in ('{', b'{') else 'other_decodes'] += 1
+        return json_loads(s, *args, **kwargs)
+
+    def counting_group_key_func(data):
+        calls['group_key_func'] += 1
+        return data['_id']
+
+    json.loads = counting_json_loads
+    try:
+        pomps.group_data(
+            source_path=source_path,
+            group_key_func=counting_group_key_func,
+            group_buckets=group_buckets,
+            key_sample_size=key_sample_size,
+            partition=partition,
+        )
+    finally:
+        json.loads = json_loads
+
+    return calls
+
+
+def bench_group_decodes(rows=200_000, key_cardinality=50_000, fields=20, group_buckets=4):
+    source_path = generate_jsonl(
+        f"{BENCHMARK_DATA}/group_decodes.jsonl", rows=rows, key_cardinality=key_cardinality, fields=fields
+    )
+
+    results = {}
+    for name, kwargs in [
+        ('single_bucket', {'group_buckets': 1}),
+        ('range', {'group_buckets': group_buckets}),
+        ('range_sampled', {'group_buckets': group_buckets, 'key_sample_size': 10_000}),
+        ('hash', {'group_buckets': group_buckets, 'partition': 'hash'}),
+    ]:
+        run_path = fresh_copy(source_path, f"group_decodes_{name}")
+        results[name] = measure(group_counting_decodes, source_path=run_path, **kwargs)
+
+    return results
+
+
+def group_and_count(source_path, group_buckets, combiner):
+    grouped_path = pomps.group_data(
+        source_path=source_path, group_key_func=group_key_func, group_buckets=group_buckets, combiner=combiner
+    )
+    buckets_path = Path(grouped_path).parent / 'buckets'
+
+    return {
+        'bucket_bytes': sum(path.stat().st_size for path in buckets_path.glob('*')) if buckets_path.is_dir() else 0,
+        'grouped_bytes': Path(grouped_path).stat().st_size,
+    }
+
+
+def bench_combiner(rows=500_000, key_cardinality=10_000, group_buckets=4):
+    source_path = generate_jsonl(f"{BENCHMARK_DATA}/combiner.jsonl", rows=rows, key_cardinality=key_cardinality, key_skew=1.0)
+
+    results = {}
+    for name, combiner in [('collect_rows', None), ('count_combiner', pomps.count_combiner())]:
+        run_path = fresh_copy(source_path, f"combiner_{name}")
+        results[name] = measure(group_and_count, source_path=run_path, group_buckets=group_buckets, combiner=combiner)
+
+    return results
+
+
+def copy_load_func(filepath, source_path):
+    shutil.copyfile(source_path, filepath)
+
+
+def transform_row(data):
+    data['payload_length'] = len(data['payload'])
+    return data
+
+
+def merge_rows(val):
+    group_key, left, right = val
+    return [{'_id': group_key, 'left_rows': len(left), 'right_rows': len(right)}]
+
+
+def run_stage(stage_func, **kwargs):
+    """
+    Run one pomps stage and pick the throughput numbers out of the metrics summary it wrote next to its output.
+    """
+    output_path = stage_func(**kwargs)
+    summary = json.loads(Path(f"{output_path}.metrics.json").read_text())
+
+    return {
+        'rows_in': summary['counters'].get('rows_in', 0),
+        'rows_out': summary['counters'].get('rows_out', 0),
+        'rows_per_second': summary['rows_per_second'],
+        'bytes_read': summary['bytes_read'],
+        'bytes_written': summary['bytes_written'],
+        'stage_peak_rss_mb': round(summary['peak_rss_bytes'] / (1024**2), 1),
+    }
+
+
+def bench_pipeline(rows=500_000, key_cardinality=100_000, row_width=64, key_skew=1.0, group_buckets=8):
+    """
+    Time every stage end to end on two synthetic sources sharing a key space: load_and_transform_source_data() for
+    both, group_data() with one bucket and with group_buckets, then merge_data_sources() of the two grouped sources.
+    """
+    namespace = f"{BENCHMARK_DATA}/pipeline"
+    shutil.rmtree(namespace, ignore_errors=True)
+
+    results = {}
+    transformed_paths = {}
+    for name, seed in [('left', 369), ('right', 963)]:
+        source_path = generate_jsonl(
+            f"{BENCHMARK_DATA}/pipeline_{name}.jsonl",
+            rows=rows,
+            key_cardinality=key_cardinality,
+            row_width=row_width,
+            key_skew=key_skew,
+            seed=seed,
+        )
+        results[f"load_and_transform_{name}"] = measure(
+            run_stage,
+            stage_func=pomps.load_and_transform_source_data,
+            name=name,
+            namespace=namespace,
+            transform_func=transform_row,
+            load_func=functools.partial(copy_load_func, source_path=source_path),
+        )
+        transformed_paths[name] = f"{namespace}/{name}/transformed_source_data.jsonl"
+
+    for group_by_name, buckets in [('single_bucket', 1), ('multi_bucket', group_buckets)]:
+        results[f"group_data_{group_by_name}"] = measure(
+            run_stage,
+            stage_func=pomps.group_data,
+            source_path=transformed_paths['left'],
+            group_key_func=group_key_func,
+            group_by_name=group_by_name,
+            group_buckets=buckets,
+        )
+
+    # The left side was already grouped above, so this only groups the right side.
+    grouped_paths = [
+        pomps.group_data(
+            source_path=transformed_paths[name],
+            group_key_func=group_key_func,
+            group_by_name='multi_bucket',
+            group_buckets=group_buckets,
+        )
+        for name in ['left', 'right']
+    ]
+    results['merge_data_sources'] = measure(
+        run_stage,
+        stage_func=pomps.merge_data_sources,
+        name='merged',
+        namespace=namespace,
+        data_one_jsonl_path=grouped_paths[0],
+        data_two_jsonl_path=grouped_paths[1],
+        merge_func=merge_rows,
+    )
+
+    return results
+
+
+def cpu_heavy_merge_rows(val):
+    """
+    Stands in for a merge_func() that does real work per row, like name_title_merge_func() in example.py.
+    """
+    group_key, left, right = val
+    digest = group_key.encode('utf-8')
+    for row in left + right:
+        for _ in range(20):
+            digest = hashlib.sha256(digest + row['payload'].encode('utf-8')).digest()
+
+    return [{'_id': group_key, 'rows': len(left) + len(right), 'digest': digest.hex()}]
+
+
+def bench_parallel_merge(rows=200_000, key_cardinality=50_000, worker_counts=(1, 2, 4)):
+    """
+    merge_data_sources() with a CPU heavy merge_func() over key ranges merged by 1, 2 and 4 workers.
+    """
+    namespace = f"{BENCHMARK_DATA}/parallel_merge"
+    shutil.rmtree(namespace, ignore_errors=True)
+
+    grouped_paths = []
+    for name, seed in [('left', 369), ('right', 963)]:
+        source_path = generate_jsonl(f"{namespace}/{name}/source_data.jsonl", rows=rows, key_cardinality=key_cardinality, seed=seed)
+        grouped_paths.append(pomps.group_data(source_path=source_path, group_key_func=group_key_func))
+
+    results = {}
+    for workers in worker_counts:
+        results[f"workers_{workers}"] = measure(
+            run_stage,
+            stage_func=pomps.merge_data_sources,
+            name=f"merged_{workers}",
+            namespace=namespace,
+            data_one_jsonl_path=grouped_paths[0],
+            data_two_jsonl_path=grouped_paths[1],
+            merge_func=cpu_heavy_merge_rows,
+            workers=workers,
+        )
+
+    return results
+
+
+PRINCIPALS_FIELD_MAP = {'tconst': 'imdb_tconst', 'nconst': 'imdb_nconst', 'category': 'category'}
+
+
+def generate_principals_jsonl(filepath, rows, seed=369):
+    """
+    Rows shaped like the IMDB title.principals rows example.py loads.
+    """
+    rng = random.Random(seed)
+    Path(filepath).parent.mkdir(parents=True, exist_ok=True)
+
+    with open(filepath, 'w', encoding='utf-8') as f:
+        for i in range(rows):
+            doc = {'tconst': f"tt{i // 10:07d}", 'ordering': str(i % 10), 'nconst': f"nm{rng.randrange(10**7):07d}"}
+            doc['category'] = rng.choice(['actor', 'actress', 'director', 'writer', 'producer'])
+            f.write(json.dumps(doc) + '\n')
+
+    return filepath
+
+
+def transform_principal(doc):
+    return {PRINCIPALS_FIELD_MAP[key]: val for key, val in doc.items() if key in PRINCIPALS_FIELD_MAP}
+
+
+def transform_principal_rows(docs):
+    return [{PRINCIPALS_FIELD_MAP[key]: val for key, val in doc.items() if key in PRINCIPALS_FIELD_MAP} for doc in docs]
+
+
+def transform_principal_columns(columns):
+    return {new_key: columns[key] for key, new_key in PRINCIPALS_FIELD_MAP.items()}
+
+
+def bench_batch_transform(rows=1_000_000, batch_size=10_000):
+    """
+    load_and_transform_source_data() with a cheap transform like example.py's transform_title_principals(), called per
+    row and in batches of rows and of columns.
+    """
+    namespace = f"{BENCHMARK_DATA}/batch_transform"
+    shutil.rmtree(namespace, ignore_errors=True)
+    source_path = generate_principals_jsonl(f"{namespace}/principals.jsonl", rows=rows)
+
+    results = {}
+    for name, transform_func, batching in [
+        ('per_row', transform_principal, {}),
+        ('batch_rows', transform_principal_rows, {'batch_size': batch_size}),
+        ('batch_columns', transform_principal_columns, {'batch_size': batch_size, 'batch_format': 'columns'}),
+    ]:
+        results[name] = measure(
+            run_stage,
+            stage_func=pomps.load_and_transform_source_data,
+            name=name,
+            namespace=namespace,
+            transform_func=transform_func,
+            load_func=functools.partial(copy_load_func, source_path=source_path),
+            **batching,
+        )
+
+    return results
+
+
+def compressed_stages(namespace, source_path, compression, compression_level, group_buckets):
+    """
+    load_and_transform_source_data(), group_data() and merge_data_sources() all writing with the same compression.
+    bytes_on_disk also counts the bucket files group_data() leaves behind.
+    """
+    compression_kwargs = {'compression': compression, 'compression_level': compression_level}
+    stages = {}
+
+    transformed_path = pomps.load_and_transform_source_data(
+        name='rows',
+        namespace=namespace,
+        transform_func=transform_row,
+        load_func=functools.partial(copy_load_func, source_path=source_path),
+        **compression_kwargs,
+    )
+    grouped_path = pomps.group_data(
+        source_path=transformed_path, group_key_func=group_key_func, group_buckets=group_buckets, **compression_kwargs
+    )
+    merged_path = pomps.merge_data_sources(
+        name='merged',
+        namespace=namespace,
+        data_one_jsonl_path=grouped_path,
+        data_two_jsonl_path=grouped_path,
+        merge_func=merge_rows,
+        **compression_kwargs,
+    )
+
+    for stage, output_path in [('transform', transformed_path), ('group', grouped_path), ('merge', merged_path)]:
+        summary = json.loads(Path(f"{output_path}.metrics.json").read_text())
+        stages[stage] = {'seconds': summary['seconds'], 'bytes_written': summary['bytes_written']}
+
+    files = [path for path in Path(namespace).rglob('*') if path.is_file() and not path.name.endswith('.metrics.json')]
+
+    return {
+        'stage_seconds': round(sum(stage['seconds'] for stage in stages.values()), 3),
+        'bytes_on_disk': sum(path.stat().st_size for path in files),
+        'stages': stages,
+    }
+
+
+def bench_compression_levels(
+    rows=300_000,
+    key_cardinality=50_000,
+    group_buckets=4,
+    levels=(('gzip', 1), ('gzip', 6), ('gzip', 9), ('bz2', 1), ('bz2', 9), ('lzma', 0), ('lzma', 6)),
+):
+    """
+    Throughput against bytes written for every stage, uncompressed and at each (compression, level) in levels.
+    """
+    source_path = generate_jsonl(f"{BENCHMARK_DATA}/compression_levels.jsonl", rows=rows, key_cardinality=key_cardinality)
+
+    results = {}
+    for compression, compression_level in [(None, None), *levels]:
+        name = f"{compression}_{compression_level}" if compression else 'uncompressed'
+        namespace = f"{BENCHMARK_DATA}/compression_levels/{name}"
+        shutil.rmtree(namespace, ignore_errors=True)
+
+        results[name] = measure(
+            compressed_stages,
+            namespace=namespace,
+            source_path=source_path,
+            compression=compression,
+            compression_level=compression_level,
+            group_buckets=group_buckets,
+        )
+        results[name]['rows_per_second'] = round(rows / results[name]['stage_seconds'], 1)
+
+    return results
+
+
+BENCHMARKS = {
+    'pipeline': bench_pipeline,
+    'sampled_bucket_boundaries': bench_sampled_bucket_boundaries,
+    'bucket_lookup': bench_bucket_lookup,
+    'bucket_partitioning': bench_bucket_partitioning,
+    'intermediate_codecs': bench_intermediate_codecs,
+    'group_decodes': bench_group_decodes,
+    'combiner': bench_combiner,
+    'parallel_merge': bench_parallel_merge,
+    'batch_transform': bench_batch_transform,
+    'compression_levels': bench_compression_levels,
+}
+
+
+def write_results(results, output_path):
+    """
+    Results are saved along with where they were run, so files from two versions can be diffed to catch regressions.
+    """
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    Path(output_path).write_text(
+        json.dumps(
+            {
+                'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_implementation() + ' ' + platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': multiprocessing.cpu_count(),
+                'results': results,
+            },
+            indent=2,
+        )
+        + '\n'
+    )
+
+    return output_path
+
+
+if __name__ == '__main__':
+    """
+    python benchmark.py [--output results.json] [name ...]
+    """
+    args = sys.argv[1:]
+    output_path = None
+    if args[:1] == ['--output']:
+        output_path, args = args[1], args[2:]
+
+    results = {}
+    for name in args or list(BENCHMARKS):
+        results[name] = BENCHMARKS[name]()
+        print(json.dumps({name: results[name]}, indent=2))
+
+    if output_path:
+        print(f"[benchmark] results written to {write_results(results, output_path)}")
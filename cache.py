@@ -0,0 +1,307 @@
+import functools
+import hashlib
+import json
+import os
+import shutil
+import time
+import types
+
+from pathlib import Path
+
+import metrics
+
+
+"""
+A stage cache keyed by what went into a stage rather than by where its output lives.  Each key is a hash of the stage
+function, the user funcs handed to it, the parameters that change its output and a fingerprint of every input file.
+Stage outputs are hard linked into SETTINGS['root'] under their key, so a later run with a new execution_date, whose
+namespace is empty, links them straight back instead of recomputing them.  The key is also written next to each output
+as '{output}.stage_key', so a stage rerun in the same namespace with a changed func recomputes rather than trusting
+the stale output.
+
+The cache is off until a root is configured:
+
+    cache.configure(root='./data/stage_cache', max_bytes=50 * 1024**3)
+
+Funcs are fingerprinted by their bytecode, constants, defaults, closure values and the functions and simple constants
+they reference from their module globals.  Anything else they depend on, like a file they read, is not seen, and a func
+whose fingerprint can't be pinned down (an object with no stable repr) simply never hits.
+"""
+
+SETTINGS = {
+    # Directory to keep cached stage outputs in.  None disables the cache.
+    'root': None,
+    # Evict the least recently used entries once the cache holds more than this many bytes.
+    'max_bytes': None,
+    # 'content' hashes every input file.  'stat' only uses size and mtime, which skips the read but misses whenever an
+    # input is rewritten, e.g. downloaded again for a new execution_date.
+    'fingerprint': 'content',
+}
+
+HASH_CHUNK_BYTES = 1024**2
+SIMPLE_TYPES = (int, float, complex, str, bytes, bool, type(None))
+
+# (path, size, mtime_ns) -> content hash, so an input shared by several stages is only read once per process.
+CONTENT_HASHES = {}
+
+
+def configure(**settings):
+    for name in settings:
+        if name not in SETTINGS:
+            raise Exception(f"[configure] unknown setting: {name}  Expected one of: {list(SETTINGS)}")
+
+    if settings.get('fingerprint', 'content') not in ('content', 'stat'):
+        raise Exception(f"[configure] unknown fingerprint: {settings['fingerprint']}  Expected 'content' or 'stat'.")
+
+    SETTINGS.update(settings)
+
+
+def enabled():
+    return bool(SETTINGS['root'])
+
+
+def fingerprint_file(path):
+    stat = Path(path).stat()
+    if SETTINGS['fingerprint'] == 'stat':
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    memo_key = (str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in CONTENT_HASHES:
+        digest = hashlib.blake2b()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+                digest.update(chunk)
+
+        CONTENT_HASHES[memo_key] = digest.hexdigest()
+
+    return CONTENT_HASHES[memo_key]
+
+
+def fingerprint_code(code):
+    consts = [
+        fingerprint_code(const) if isinstance(const, types.CodeType) else fingerprint_value(const) for const in code.co_consts
+    ]
+
+    return (code.co_code.hex(), code.co_names, consts)
+
+
+def fingerprint_value(value, seen=None):
+    """
+    Return a repr()able structure that only changes when value, or for funcs, their code, does.
+    """
+    seen = set() if seen is None else seen
+    if isinstance(value, SIMPLE_TYPES):
+        return repr(value)
+
+    if id(value) in seen:
+        return 'recursion'
+    seen = seen | {id(value)}
+
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [fingerprint_value(item, seen) for item in value]
+        return (type(value).__name__, sorted(items, key=repr) if isinstance(value, (set, frozenset)) else items)
+
+    if isinstance(value, dict):
+        return ('dict', sorted((repr(key), fingerprint_value(item, seen)) for key, item in value.items()))
+
+    if isinstance(value, functools.partial):
+        return ('partial', *(fingerprint_value(part, seen) for part in [value.func, value.args, value.keywords]))
+
+    if isinstance(value, types.MethodType):
+        return ('method', fingerprint_value(value.__func__, seen), fingerprint_value(value.__self__, seen))
+
+    if isinstance(value, types.FunctionType):
+        closure = [fingerprint_value(cell.cell_contents, seen) for cell in value.__closure__ or () if cell_has_contents(cell)]
+        referenced = {}
+        for name in value.__code__.co_names:
+            referenced_value = value.__globals__.get(name)
+            if isinstance(referenced_value, (types.FunctionType, tuple, frozenset) + SIMPLE_TYPES):
+                referenced[name] = fingerprint_value(referenced_value, seen)
+
+        return (
+            'function',
+            value.__module__,
+            value.__qualname__,
+            fingerprint_code(value.__code__),
+            fingerprint_value(value.__defaults__, seen),
+            fingerprint_value(value.__kwdefaults__, seen),
+            closure,
+            sorted(referenced.items()),
+        )
+
+    # Builtins and modules have stable reprs.  Other objects usually include their address, so they never hit.
+    return repr(value)
+
+
+def cell_has_contents(cell):
+    try:
+        cell.cell_contents
+    except ValueError:
+        return False
+
+    return True
+
+
+def stage_key(stage_func, input_paths, funcs=(), params=None):
+    """
+    Return the cache key of a run of stage_func, or None when the cache is off.  funcs are the user funcs the stage was
+    handed and params any other arguments that change what it writes.
+    """
+    if not enabled():
+        return None
+
+    fingerprint = {
+        'stage': fingerprint_value(stage_func),
+        'inputs': [fingerprint_file(path) for path in input_paths],
+        'funcs': [fingerprint_value(func) for func in funcs],
+        'params': fingerprint_value(params or {}),
+    }
+
+    return hashlib.blake2b(repr(fingerprint).encode('utf-8'), digest_size=20).hexdigest()
+
+
+def stage_key_path(output_path):
+    return f"{output_path}.stage_key"
+
+
+def entry_path(key):
+    return Path(SETTINGS['root']) / key
+
+
+def link_or_copy(src, dst):
+    Path(dst).unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Across filesystems, or where hard links aren't supported.
+        shutil.copy2(src, dst)
+
+
+def reuse(key, output_paths, scratch_paths=()):
+    """
+    Return True when the outputs of the stage keyed by key are in place, linking them in from the cache if need be.
+    output_paths[0] is the stage's main output.  With the cache off (key None), this is the plain 'does the output
+    exist' check pomps has always made.
+
+    An output written under a different key is stale, so it is removed along with scratch_paths, any intermediate
+    files or folders the stage would otherwise pick back up.
+    """
+    output_path = output_paths[0]
+    if key is None:
+        return Path(output_path).is_file()
+
+    if Path(output_path).is_file():
+        if Path(stage_key_path(output_path)).is_file() and Path(stage_key_path(output_path)).read_text() == key:
+            return True
+
+        metrics.progress(f"[reuse] {output_path} was written by a different version of its stage, recomputing it.")
+        for path in list(output_paths) + list(scratch_paths):
+            if Path(path).is_dir():
+                shutil.rmtree(path)
+            else:
+                Path(path).unlink(missing_ok=True)
+
+    entry = entry_path(key)
+    if not (entry / 'entry.json').is_file():
+        return False
+
+    names = json.loads((entry / 'entry.json').read_text())['outputs']
+    for name, path in zip(names, output_paths):
+        if name is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(entry / name, f"{path}.tmp")
+            Path(f"{path}.tmp").replace(path)
+
+    Path(stage_key_path(output_path)).write_text(key)
+    os.utime(entry / 'entry.json')
+    metrics.progress(f"[reuse] linked cached output {entry} to {output_path}")
+
+    return True
+
+
+def store(key, output_paths):
+    """
+    Link the outputs of a finished stage into the cache under key.  Outputs that were not written, like a skipped sparse
+    index, are recorded as missing.
+    """
+    if key is None:
+        return
+
+    Path(stage_key_path(output_paths[0])).write_text(key)
+
+    entry = entry_path(key)
+    if (entry / 'entry.json').is_file():
+        return
+
+    tmp_entry = Path(f"{entry}.tmp")
+    shutil.rmtree(tmp_entry, ignore_errors=True)
+    tmp_entry.mkdir(parents=True)
+
+    names = []
+    for i, path in enumerate(output_paths):
+        names.append(f"{i}_{Path(path).name}" if Path(path).is_file() else None)
+        if names[-1]:
+            link_or_copy(path, tmp_entry / names[-1])
+
+    size = sum((tmp_entry / name).stat().st_size for name in names if name)
+    (tmp_entry / 'entry.json').write_text(json.dumps({'outputs': names, 'bytes': size, 'created': time.time()}))
+    tmp_entry.replace(entry)
+
+    if SETTINGS['max_bytes'] is not None:
+        evict(SETTINGS['max_bytes'])
+
+
+def evict(max_bytes):
+    """
+    Remove the least recently used entries until the cache holds at most max_bytes.  Returns the keys removed.
+    """
+    entries = []
+    for entry_json in Path(SETTINGS['root']).glob('*/entry.json'):
+        entries.append((entry_json.stat().st_mtime, json.loads(entry_json.read_text())['bytes'], entry_json.parent))
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+
+    evicted = []
+    for _, size, entry in entries:
+        if total <= max_bytes:
+            break
+
+        shutil.rmtree(entry)
+        total -= size
+        evicted.append(entry.name)
+
+    if evicted:
+        metrics.progress(f"[evict] evicted {len(evicted)} cache entries, {total/(1024**2):.1f} MB left.")
+
+    return evicted
+
+
+def evict_namespaces(root_dir, env, max_bytes, keep=1):
+    """
+    Remove the oldest execution_date namespaces under f"{root_dir}/{env}", never the newest keep of them, until the rest
+    hold at most max_bytes.  Only bytes a namespace holds on its own count, since files also linked into the cache, or
+    into another namespace, are not freed by removing it.  Returns the namespaces removed.
+    """
+    namespaces = sorted(path for path in Path(f"{root_dir}/{env}").iterdir() if path.is_dir())
+
+    def own_bytes(namespace):
+        stats = (path.stat() for path in namespace.rglob('*') if path.is_file())
+        return sum(stat.st_size for stat in stats if stat.st_nlink == 1)
+
+    sizes = {namespace: own_bytes(namespace) for namespace in namespaces}
+    total = sum(sizes.values())
+
+    removed = []
+    for namespace in namespaces[: max(len(namespaces) - keep, 0)]:
+        if total <= max_bytes:
+            break
+
+        shutil.rmtree(namespace)
+        total -= sizes[namespace]
+        removed.append(f"{root_dir}/{env}/{namespace.name}")
+
+    if removed:
+        metrics.progress(f"[evict_namespaces] removed {removed}, {total/(1024**2):.1f} MB left.")
+
+    return removed
@@ -86,33 +86,30 @@ start_time = time.time()
 execution_date = datetime.strptime('20230118-120000-000000', '%Y%m%d-%H%M%S-%f')
 namespace = pomps.namespace(root_dir=DATA_DIR, env=ENV, execution_date=execution_date)
 
-title_principals = pomps.load_and_transform_source_data(
-    name='title_principals',
-    namespace=namespace,
-    transform_func=transform_title_principals,
-    load_func=load_imdb_data_func('https://datasets.imdbws.com/title.principals.tsv.gz'),
-)
-
-title_basics = pomps.load_and_transform_source_data(
-    name='title_basics',
-    namespace=namespace,
-    transform_func=transform_title_basics,
-    load_func=load_imdb_data_func('https://datasets.imdbws.com/title.basics.tsv.gz'),
-)
-
-name_basics = pomps.load_and_transform_source_data(
-    name='name_basics',
-    namespace=namespace,
-    transform_func=transform_name_basics,
-    load_func=load_imdb_data_func('https://datasets.imdbws.com/name.basics.tsv.gz'),
-)
-
-grouped_title_principals = pomps.group_data(
-    source_path=title_principals, group_key_func=lambda x: x['imdb_tconst'], group_by_name='imdb_tconst'
-)
-
-grouped_title_basics = pomps.group_data(
-    source_path=title_basics, group_key_func=lambda x: x['imdb_tconst'], group_by_name='imdb_tconst'
+"""
+The three downloads are independent, so they are fetched at the same time.
+"""
+title_principals, title_basics, name_basics = pomps.load_and_transform_sources(
+    [
+        {
+            'name': 'title_principals',
+            'namespace': namespace,
+            'transform_func': transform_title_principals,
+            'load_func': load_imdb_data_func('https://datasets.imdbws.com/title.principals.tsv.gz'),
+        },
+        {
+            'name': 'title_basics',
+            'namespace': namespace,
+            'transform_func': transform_title_basics,
+            'load_func': load_imdb_data_func('https://datasets.imdbws.com/title.basics.tsv.gz'),
+        },
+        {
+            'name': 'name_basics',
+            'namespace': namespace,
+            'transform_func': transform_name_basics,
+            'load_func': load_imdb_data_func('https://datasets.imdbws.com/name.basics.tsv.gz'),
+        },
+    ]
 )
 
 
@@ -132,12 +129,18 @@ def title_merge_func(val):
     return data
 
 
-title_data = pomps.merge_data_sources(
+"""
+title_merge_func() works one principal at a time, so it can opt into broadcasting title_basics in memory instead of
+grouping both sides whenever it fits.
+"""
+title_data = pomps.join_data_sources(
     name='title_data',
     namespace=namespace,
-    data_one_jsonl_path=grouped_title_basics,
-    data_two_jsonl_path=grouped_title_principals,
+    data_one_jsonl_path=title_basics,
+    data_two_jsonl_path=title_principals,
+    group_key_func=lambda x: x['imdb_tconst'],
     merge_func=title_merge_func,
+    strategy='auto',
 )
 
 grouped_name_basics = pomps.group_data(source_path=name_basics, group_key_func=lambda x: x['imdb_nconst'], group_by_name='imdb_nconst')
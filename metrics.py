@@ -0,0 +1,220 @@
+import contextlib
+import cProfile
+import json
+import threading
+import time
+import tracemalloc
+
+from collections import defaultdict
+from pathlib import Path
+
+import util
+
+
+"""
+Every pomps stage runs inside a metrics.stage().  Progress messages, per-bucket results and a summary of the stage are
+handed to each callback in CALLBACKS as callback(event, stage_metrics, payload) with event one of 'start', 'progress',
+'bucket' or 'finish'.  The default callback just prints progress messages, as pomps always has.
+
+When SETTINGS['write_summary'] is on, the summary is also written as json next to the stage output, e.g.
+'merged.jsonl.metrics.json'.
+"""
+
+SETTINGS = {
+    # Time user funcs and json encoding/decoding separately.  Costs a wrapper call per row, so it is off by default.
+    'detailed_timings': False,
+    # None, 'cprofile' or 'tracemalloc'.  Captures are written next to the stage output.
+    'profile': None,
+    'write_summary': True,
+}
+
+# Each thread nests its own stages, so sources loaded on threads don't collect into each other's stages.
+THREAD_STATE = threading.local()
+
+
+def stage_stack():
+    if not hasattr(THREAD_STATE, 'stack'):
+        THREAD_STATE.stack = []
+
+    return THREAD_STATE.stack
+
+
+def print_callback(event, stage_metrics, payload):
+    if event == 'progress':
+        print(payload)
+
+
+CALLBACKS = [print_callback]
+
+
+def configure(**settings):
+    for name in settings:
+        if name not in SETTINGS:
+            raise Exception(f"[configure] unknown setting: {name}  Expected one of: {list(SETTINGS)}")
+
+    SETTINGS.update(settings)
+
+
+def add_callback(callback):
+    CALLBACKS.append(callback)
+
+
+def remove_callback(callback):
+    CALLBACKS.remove(callback)
+
+
+def emit(event, stage_metrics, payload):
+    for callback in CALLBACKS:
+        callback(event, stage_metrics, payload)
+
+
+class StageMetrics:
+    def __init__(self, name, output_path):
+        self.name = name
+        self.output_path = output_path
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(float)
+        self.buckets = []
+        self.start_time = time.perf_counter()
+        self.peak_rss_bytes = 0
+        self.tracemalloc_peak_bytes = None
+        self.profiled = False
+
+    def sample_memory(self):
+        rss = util.MEMORY_MONITOR.rss_bytes()
+        if rss:
+            self.peak_rss_bytes = max(self.peak_rss_bytes, rss)
+
+        return rss
+
+    def summary(self):
+        seconds = time.perf_counter() - self.start_time
+        timings = dict(self.timings)
+        timings['io_and_other'] = max(0.0, seconds - sum(self.timings.values()))
+
+        bytes_written = self.counters.get('bytes_written', 0)
+        if not bytes_written and Path(self.output_path).is_file():
+            bytes_written = Path(self.output_path).stat().st_size
+
+        return {
+            'stage': self.name,
+            'output_path': self.output_path,
+            'seconds': round(seconds, 3),
+            'counters': dict(self.counters),
+            'rows_per_second': round(self.counters.get('rows_in', 0) / seconds, 1) if seconds else None,
+            'bytes_read': self.counters.get('bytes_read', 0),
+            'bytes_written': bytes_written,
+            'timings': {name: round(value, 3) for name, value in timings.items()},
+            'peak_rss_bytes': self.peak_rss_bytes,
+            'tracemalloc_peak_bytes': self.tracemalloc_peak_bytes,
+            'buckets': self.buckets,
+        }
+
+
+def current():
+    stack = stage_stack()
+    return stack[-1] if stack else None
+
+
+@contextlib.contextmanager
+def stage(name, output_path, write_summary=None):
+    """
+    Collect metrics for everything run inside the block.  Stages nest, with the innermost one collecting.  Profiling is
+    skipped for a nested stage when an outer one is already being profiled.
+    """
+    stage_metrics = StageMetrics(name, output_path)
+    stage_metrics.sample_memory()
+
+    profiler = None
+    started_tracemalloc = False
+    if SETTINGS['profile'] == 'cprofile' and not any(s.profiled for s in stage_stack()):
+        profiler = cProfile.Profile()
+        stage_metrics.profiled = True
+    elif SETTINGS['profile'] == 'tracemalloc' and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        started_tracemalloc = True
+
+    stage_stack().append(stage_metrics)
+    emit('start', stage_metrics, None)
+    try:
+        if profiler:
+            profiler.enable()
+
+        yield stage_metrics
+
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(f"{output_path}.prof")
+
+        if started_tracemalloc:
+            stage_metrics.tracemalloc_peak_bytes = tracemalloc.get_traced_memory()[1]
+            top_stats = tracemalloc.take_snapshot().statistics('lineno')[:25]
+            Path(f"{output_path}.tracemalloc.txt").write_text('\n'.join(str(stat) for stat in top_stats) + '\n')
+
+        stage_metrics.sample_memory()
+        summary = stage_metrics.summary()
+
+        if SETTINGS['write_summary'] if write_summary is None else write_summary:
+            Path(f"{output_path}.metrics.json").write_text(json.dumps(summary, indent=2) + '\n')
+
+        emit('finish', stage_metrics, summary)
+    finally:
+        if profiler:
+            profiler.disable()
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+        stage_stack().remove(stage_metrics)
+
+
+def progress(message):
+    stage_metrics = current()
+    if stage_metrics:
+        stage_metrics.sample_memory()
+
+    emit('progress', stage_metrics, message)
+
+
+def count(name, value=1):
+    stage_metrics = current()
+    if stage_metrics:
+        stage_metrics.counters[name] += value
+
+
+def add_timings(timings):
+    stage_metrics = current()
+    if stage_metrics:
+        for name, value in timings.items():
+            stage_metrics.timings[name] += value
+
+
+def record_bucket(bucket_summary):
+    stage_metrics = current()
+    if stage_metrics:
+        stage_metrics.buckets.append(bucket_summary)
+        stage_metrics.peak_rss_bytes = max(stage_metrics.peak_rss_bytes, bucket_summary.get('peak_rss_bytes') or 0)
+
+    emit('bucket', stage_metrics, bucket_summary)
+
+
+def timed(name, func):
+    """
+    Wrap func so its run time is added to the current stage's timings[name].  Returns func untouched unless
+    SETTINGS['detailed_timings'] is on and a stage is running.
+    """
+    stage_metrics = current()
+    if not SETTINGS['detailed_timings'] or stage_metrics is None:
+        return func
+
+    timings = stage_metrics.timings
+    perf_counter = time.perf_counter
+
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings[name] += perf_counter() - start
+
+    return wrapper
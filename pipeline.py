@@ -0,0 +1,296 @@
+import hashlib
+import itertools
+import json
+
+from pathlib import Path
+
+import cache
+import metrics
+import pomps
+import storage
+
+
+"""
+A Pipeline chains pomps stages lazily.  Row-wise stages (map, filter and flat_map) never run on their own.  They are
+fused into one generator feeding whatever comes next, so rows only touch the disk at the shuffle boundaries: as the
+input of group_data() and as the output of group_data() and merge_data_sources().  Nothing runs until run(), and
+explain() shows the plan beforehand.
+
+    titles = pipeline.load('title_basics', namespace, load_func).map(transform_title_basics).group(lambda x: x['tconst'])
+    principals = pipeline.source(principals_path).filter(is_actor).group(lambda x: x['tconst'])
+
+    title_data = titles.merge([principals], merge_func=title_merge_func, name='title_data').map(drop_empty_fields)
+    print(title_data.explain())
+    title_data_path = title_data.run()
+
+Like the rest of pomps, every file a pipeline writes is reused by later runs if it is already there.  Materialized and
+grouped files are kept in folders named after a hash of every stage leading up to them, funcs included, so two pipelines
+over the same source only share files when they would write the same rows.
+"""
+
+ROW_STAGES = ('map', 'filter', 'flat_map')
+
+
+def source(path):
+    """
+    Start from an existing jsonl or grouped file.  Anything materialized goes in a '_pipeline' folder next to it.
+    """
+    return Pipeline(work_path=str(Path(path).parent), stages=[{'op': 'source', 'path': path}])
+
+
+def load(name, namespace, load_func):
+    """
+    Start from f"{namespace}/{name}/source_data.jsonl", written by load_func() the first time, see pomps.load_source_data().
+    """
+    stage = {'op': 'load', 'name': name, 'namespace': namespace, 'load_func': load_func}
+
+    return Pipeline(work_path=f"{namespace}/{name}", stages=[stage])
+
+
+def func_name(func):
+    return getattr(func, '__name__', repr(func))
+
+
+def stages_key(stages):
+    """
+    A short hash of stages that changes with any func in them, see cache.fingerprint_value().  The stages of the
+    pipelines a merge reads from are hashed in.
+    """
+
+    def fingerprint(stage):
+        fingerprints = []
+        for name, value in sorted(stage.items()):
+            if name == 'inputs':
+                fingerprints.append((name, [stages_fingerprint(pipeline.stages) for pipeline in value]))
+            else:
+                fingerprints.append((name, cache.fingerprint_value(value)))
+
+        return fingerprints
+
+    def stages_fingerprint(stages):
+        return [fingerprint(stage) for stage in stages]
+
+    return hashlib.blake2b(repr(stages_fingerprint(stages)).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def apply_row_stages(rows, row_stages):
+    for stage in row_stages:
+        func = metrics.timed('user_func', stage['func'])
+        if stage['op'] == 'map':
+            rows = map(func, rows)
+        elif stage['op'] == 'filter':
+            rows = filter(func, rows)
+        else:
+            rows = itertools.chain.from_iterable(map(func, rows))
+
+    return rows
+
+
+def materialize(input_path, row_stages, output_path):
+    """
+    Stream the records of input_path through row_stages into the jsonl output_path.
+    """
+    if Path(output_path).is_file():
+        metrics.progress(f"[materialize] found existing data, returning: {output_path}")
+        return output_path
+
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+
+    with metrics.stage('materialize', output_path):
+        metrics.count('bytes_read', Path(input_path).stat().st_size)
+        codec, _ = storage.detect(input_path)
+        loads, dumps = metrics.timed('codec', json.loads), metrics.timed('codec', json.dumps)
+
+        rows_in, rows_out = 0, 0
+
+        def read_rows(f):
+            nonlocal rows_in
+            if codec != 'jsonl':
+                records = storage.iter_records(f, codec=codec)
+            else:
+                records = (loads(line) for line in f if line.strip())
+
+            for record in records:
+                rows_in += 1
+                yield record
+
+        with storage.open_path(input_path) as f, open(output_path + '.tmp', 'w', encoding='utf-8') as output:
+            for row in apply_row_stages(read_rows(f), row_stages):
+                output.write(dumps(row) + '\n')
+                rows_out += 1
+
+        metrics.count('rows_in', rows_in)
+        metrics.count('rows_out', rows_out)
+        Path(output_path + '.tmp').replace(output_path)
+
+    return output_path
+
+
+def fuse_merge_func(merge_func, row_stages):
+    if not row_stages:
+        return merge_func
+
+    def fused_merge_func(val):
+        return list(apply_row_stages(merge_func(val), row_stages))
+
+    return fused_merge_func
+
+
+class Pipeline:
+    def __init__(self, work_path, stages):
+        self.work_path = work_path
+        self.stages = stages
+
+    def then(self, stage):
+        return Pipeline(work_path=self.work_path, stages=self.stages + [stage])
+
+    def map(self, func):
+        return self.then({'op': 'map', 'func': func})
+
+    def filter(self, func):
+        return self.then({'op': 'filter', 'func': func})
+
+    def flat_map(self, func):
+        """
+        func(row) returns an iterable of any number of rows.
+        """
+        return self.then({'op': 'flat_map', 'func': func})
+
+    def group(self, group_key_func, group_by_name='', **group_kwargs):
+        """
+        group_kwargs are passed on to pomps.group_data().  group_by_name only prefixes the folder the grouped file is
+        written to, see group_step().
+        """
+        return self.then(
+            {'op': 'group', 'group_key_func': group_key_func, 'group_by_name': group_by_name, 'group_kwargs': group_kwargs}
+        )
+
+    def merge(self, others, merge_func, name):
+        """
+        Merge this pipeline with others, each of which must end in group(), like pomps.merge_multiple_data_sources().
+        Row-wise stages chained after the merge are fused into merge_func(), so they are applied before anything is
+        written.
+        """
+        inputs = [self, *others]
+        for pipeline in inputs:
+            if pipeline.segments()[-1][0]['op'] != 'group':
+                raise Exception(f"[Pipeline.merge] every pipeline merged must end in group().  {pipeline.work_path} does not.")
+
+        namespace = str(Path(self.work_path).parent)
+        stage = {'op': 'merge', 'inputs': inputs, 'merge_func': merge_func, 'name': name, 'namespace': namespace}
+
+        return Pipeline(work_path=f"{namespace}/{name}", stages=[stage])
+
+    def segments(self):
+        """
+        Split the stages into (boundary, row_stages) pairs, where boundary is a stage that reads or writes whole files.
+        """
+        segments = []
+        for stage in self.stages:
+            if stage['op'] in ROW_STAGES:
+                segments[-1][1].append(stage)
+            else:
+                segments.append((stage, []))
+
+        return segments
+
+    def plan(self):
+        """
+        Return the steps run() will take as (description, action) pairs.  Each action takes the path the step before it
+        produced and returns the path it produced.
+        """
+        steps = []
+        pending = []
+        for index, (boundary, row_stages) in enumerate(self.segments()):
+            if boundary['op'] == 'group' and pending:
+                steps.append(self.materialize_step(pending, index))
+
+            if boundary['op'] == 'merge':
+                # Row-wise stages straight after a merge run inside merge_func(), so nothing is left pending.
+                steps.append(self.merge_step(boundary, row_stages))
+                row_stages = []
+            elif boundary['op'] == 'group':
+                steps.append(self.group_step(boundary))
+            else:
+                steps.append(BOUNDARY_STEPS[boundary['op']](boundary))
+
+            pending = row_stages
+
+        if pending:
+            steps.append(self.materialize_step(pending, len(self.stages)))
+
+        return steps
+
+    def upstream(self, last_stage):
+        return self.stages[: next(i for i, stage in enumerate(self.stages) if stage is last_stage) + 1]
+
+    def materialize_step(self, row_stages, index):
+        upstream = self.upstream(row_stages[-1])
+        output_path = f"{self.work_path}/_pipeline/{index}_{stages_key(upstream)}/source_data.jsonl"
+        fused = ' | '.join(f"{stage['op']} {func_name(stage['func'])}" for stage in row_stages)
+
+        def action(path):
+            return materialize(input_path=path, row_stages=row_stages, output_path=output_path)
+
+        return f"materialize {fused} -> {output_path}", action
+
+    def group_step(self, boundary):
+        """
+        The grouped file goes in a folder named after a hash of the stages up to and including this group(), next to
+        whatever file it groups, so a different group_key_func never picks up another pipeline's grouping.
+        """
+        kwargs = ''.join(f", {key}={value!r}" for key, value in boundary['group_kwargs'].items())
+        group_by_name = f"{boundary['group_by_name'] or 'pipeline'}_{stages_key(self.upstream(boundary))}"
+
+        def action(path):
+            return pomps.group_data(
+                source_path=path,
+                group_key_func=boundary['group_key_func'],
+                group_by_name=group_by_name,
+                **boundary['group_kwargs'],
+            )
+
+        return f"group_data by {func_name(boundary['group_key_func'])}{kwargs}", action
+
+    def merge_step(self, boundary, row_stages):
+        fused = ''.join(f" | {stage['op']} {func_name(stage['func'])}" for stage in row_stages)
+        inputs = '\n'.join(pipeline.explain(indent='    ') for pipeline in boundary['inputs'])
+        merged_path = f"{boundary['namespace']}/{boundary['name']}"
+        description = f"merge_data_sources {merged_path} with {func_name(boundary['merge_func'])}{fused} of:"
+
+        def action(_):
+            return pomps.merge_multiple_data_sources(
+                name=boundary['name'],
+                namespace=boundary['namespace'],
+                data_jsonl_paths=[pipeline.run(explain=False) for pipeline in boundary['inputs']],
+                merge_func=fuse_merge_func(boundary['merge_func'], row_stages),
+            )
+
+        return f"{description}\n{inputs}", action
+
+    def explain(self, indent=''):
+        return '\n'.join(f"{indent}{line}" for description, _ in self.plan() for line in description.split('\n'))
+
+    def run(self, explain=True):
+        if explain:
+            metrics.progress(f"[Pipeline.run] plan:\n{self.explain()}")
+
+        path = None
+        for _, action in self.plan():
+            path = action(path)
+
+        return path
+
+
+def source_step(boundary):
+    return f"source {boundary['path']}", lambda _: boundary['path']
+
+
+def load_step(boundary):
+    def action(_):
+        return pomps.load_source_data(name=boundary['name'], namespace=boundary['namespace'], load_func=boundary['load_func'])
+
+    return f"load_source_data {boundary['namespace']}/{boundary['name']}", action
+
+
+BOUNDARY_STEPS = {'source': source_step, 'load': load_step}
@@ -1,56 +1,776 @@
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import heapq
+import itertools
 import json
 import math
+import queue
 import shutil
+import threading
+import time
 
 from pathlib import Path
 
+import cache
+import metrics
+import storage
 import util
 
 
 DEBUG_MODULUS = 369_369
+SPARSE_INDEX_EVERY = 1000
+COPY_CHUNK_BYTES = 1024**2
+COMBINE_MAX_KEYS = 100_000
+STREAM_QUEUE_SIZE = 64
+STREAM_BATCH_ROWS = 1000
+MERGE_RANGES_PER_WORKER = 4
+MAX_OPEN_RUNS = 64
+SPILL_CHUNK_ROWS = 10_000
+BATCH_FORMATS = ('rows', 'columns')
+
+
+def load_and_transform_source_data(
+    name,
+    namespace,
+    transform_func,
+    load_func,
+    group_key_func=None,
+    workers=1,
+    batch_size=None,
+    batch_format='rows',
+    compression=None,
+    compression_level=None,
+):
+    """
+    workers      - Split the source into newline aligned byte ranges and transform them in a process pool.  The
+                   transformed chunks are stitched back together in source order.  The source has to stay
+                   uncompressed to be split, so with workers > 1 compression only applies to the transformed output.
+    batch_size   - Call transform_func() once per batch of up to batch_size docs instead of once per doc.  It returns a
+                   list of output docs, which need not be as many as it was handed.  Each batch of lines is also decoded
+                   with a single json.loads() call.
+    batch_format - How a batch is handed to transform_func().  'rows' is a list of docs.  'columns' is a dict of lists,
+                   one per field with None where a doc lacks the field, for columnar or NumPy-style transforms, which may
+                   also return a dict of lists.
+    compression  - Compress the loaded source and the transformed output, see storage.COMPRESSIONS.  Both are then
+                   named with the compression suffix, e.g. 'transformed_source_data.jsonl.gz', and every later stage
+                   reads them as is.
+    compression_level - The compresslevel for gzip and bz2 (1 to 9) or the preset for lzma (0 to 9).  Lower levels
+                        trade bytes on disk for faster writes.  Defaults to each module's own default.
+    """
+    if batch_format not in BATCH_FORMATS:
+        raise Exception(
+            f"[load_and_transform_source_data] unknown batch_format: {batch_format}  Expected one of: {list(BATCH_FORMATS)}"
+        )
 
-
-def load_and_transform_source_data(name, namespace, transform_func, load_func, group_key_func=None):
-    source_path = f"{namespace}/{name}/source_data.jsonl"
-    transformed_path = f"{namespace}/{name}/transformed_source_data.jsonl"
+    source_compression = compression if workers == 1 else None
+    source_path = source_file_path(namespace, name, 'source_data', compression=source_compression)
+    transformed_path = source_file_path(namespace, name, 'transformed_source_data', compression=compression)
 
     Path(source_path).parent.mkdir(parents=True, exist_ok=True)
 
-    if Path(transformed_path).is_file():
-        print(f"[load_source_data] data already loaded and transformed.  Returning: {transformed_path}")
+    load_kwargs = {'compression': source_compression, 'compression_level': compression_level}
+
+    key = None
+    if cache.enabled():
+        # The cache key covers the loaded source, so it has to be loaded first.
+        load_source_data(name=name, namespace=namespace, load_func=load_func, **load_kwargs)
+        key = cache.stage_key(
+            load_and_transform_source_data,
+            [source_path],
+            funcs=[transform_func, group_key_func],
+            params={
+                'batch_size': batch_size,
+                'batch_format': batch_format,
+                'compression': compression,
+                'compression_level': compression_level,
+            },
+        )
+
+    if cache.reuse(key, [transformed_path]):
+        metrics.progress(f"[load_source_data] data already loaded and transformed.  Returning: {transformed_path}")
 
         return transformed_path
 
+    with metrics.stage('load_and_transform_source_data', transformed_path):
+        load_source_data(name=name, namespace=namespace, load_func=load_func, **load_kwargs)
+
+        if group_key_func:
+            grouped_path = group_data(source_path, group_key_func, workers=workers)
+
+            source_path = grouped_path
+
+        metrics.count('bytes_read', Path(source_path).stat().st_size)
+
+        batching = {'batch_size': batch_size, 'batch_format': batch_format}
+        if workers > 1:
+            rows_in, rows_out = transform_chunks(
+                source_path=source_path,
+                output_path=transformed_path + '.tmp',
+                transform_func=transform_func,
+                workers=workers,
+                batching=batching,
+                compression=compression,
+                compression_level=compression_level,
+            )
+        else:
+            with contextlib.ExitStack() as stack:
+                tmpfile = stack.enter_context(
+                    storage.open_file(transformed_path + '.tmp', 'w', compression=compression, level=compression_level)
+                )
+                source = stack.enter_context(storage.open_path(source_path))
+                rows_in, rows_out = transform_lines(lines=source, transform_func=transform_func, output=tmpfile, **batching)
+
+        metrics.count('rows_in', rows_in)
+        metrics.count('rows_out', rows_out)
+
+        Path(transformed_path + '.tmp').replace(transformed_path)
+
+    cache.store(key, [transformed_path])
+
+    return transformed_path
+
+
+def load_and_transform_sources(sources, load_workers=None):
+    """
+    Run load_and_transform_source_data() for several independent sources, with their load_func() calls running
+    concurrently on threads.  load_funcs are usually downloads, so they spend their time waiting on I/O rather than
+    holding the GIL.  Each source is transformed here as soon as its load finishes, while the rest keep loading.
+
+    Sources with workers > 1 are only transformed once every load has finished and its thread has exited.  Their
+    process pool forks, and a process forked while other threads are running can inherit a lock one of them holds,
+    like the stdout lock, and deadlock on it.
+
+    sources      - A list of dicts of load_and_transform_source_data() kwargs.
+    load_workers - How many load_func() calls to run at once.  Defaults to one per source.
+
+    Returns the transformed paths in the order of sources.
+    """
+    transformed_paths = [None] * len(sources)
+    forking = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=load_workers or max(len(sources), 1)) as executor:
+        loads = {}
+        for i, source in enumerate(sources):
+            transformed_path = source_file_path(
+                source['namespace'], source['name'], 'transformed_source_data', compression=source.get('compression')
+            )
+            if Path(transformed_path).is_file():
+                transformed_paths[i] = load_and_transform_source_data(**source)
+                continue
+
+            load_kwargs = {key: source[key] for key in ['name', 'namespace', 'load_func']}
+            if source.get('workers', 1) == 1:
+                load_kwargs.update({key: source.get(key) for key in ['compression', 'compression_level']})
+            loads[executor.submit(load_source_data, **load_kwargs)] = i
+
+        for load in concurrent.futures.as_completed(loads):
+            i = loads[load]
+            if sources[i].get('workers', 1) > 1:
+                metrics.progress(f"[load_and_transform_sources] loaded {load.result()}, transforming it once all loads are done.")
+                forking.append(i)
+                continue
+
+            metrics.progress(f"[load_and_transform_sources] loaded {load.result()}, transforming it.")
+            transformed_paths[i] = load_and_transform_source_data(**sources[i])
+
+    for i in forking:
+        transformed_paths[i] = load_and_transform_source_data(**sources[i])
+
+    return transformed_paths
+
+
+def source_file_path(namespace, name, filename, compression=None):
+    return f"{namespace}/{name}/{filename}{storage.suffix(compression=compression)}"
+
+
+def load_source_data(name, namespace, load_func, compression=None, compression_level=None):
+    """
+    load_func() always writes plain jsonl.  With a compression, what it wrote is compressed into
+    f"{namespace}/{name}/source_data.jsonl.gz" (or .bz2, .xz) as soon as it returns and the plain file is removed.
+    """
+    source_path = source_file_path(namespace, name, 'source_data', compression=compression)
+    Path(source_path).parent.mkdir(parents=True, exist_ok=True)
+
     if not Path(source_path).is_file():
-        print(f"[load_source_data] source data '{source_path}' not yet loaded, retrieving it using provided load_func().")
+        metrics.progress(f"[load_source_data] source data '{source_path}' not yet loaded, retrieving it using provided load_func().")
 
-        load_func(filepath=source_path + '.tmp')
-        Path(source_path + '.tmp').replace(source_path)
+        loaded_path = source_file_path(namespace, name, 'source_data') + '.tmp'
+        metrics.timed('user_func', load_func)(filepath=loaded_path)
 
-    if group_key_func:
-        grouped_path = group_data(source_path, group_key_func)
+        if compression:
+            compress_file(loaded_path, source_path + '.tmp', compression=compression, level=compression_level)
+            Path(loaded_path).unlink()
+            loaded_path = source_path + '.tmp'
 
-        source_path = grouped_path
+        Path(loaded_path).replace(source_path)
 
-    with open(transformed_path + '.tmp', 'w', encoding='utf-8') as tmpfile, open(source_path, encoding='utf-8') as source:
-        counter = 0
-        for line in source:
-            counter += 1
-            doc = transform_func(json.loads(line.rstrip()))
-            tmpfile.write(json.dumps(doc) + '\n')
+    return source_path
 
-            if not counter % DEBUG_MODULUS:
-                print(f"[load_and_transform_source_data] transformed {counter} docs.")
+
+def compress_file(path, output_path, compression, level=None):
+    with open(path, 'rb') as f, storage.open_binary(output_path, 'w', compression=compression, level=level) as output:
+        shutil.copyfileobj(f, output, COPY_CHUNK_BYTES)
+
+
+def stream_and_transform_source_data(
+    name,
+    namespace,
+    transform_func,
+    stream_func,
+    cache_source=True,
+    queue_size=STREAM_QUEUE_SIZE,
+    batch_size=None,
+    batch_format='rows',
+    compression=None,
+    compression_level=None,
+):
+    """
+    Like load_and_transform_source_data(), but the source is transformed while it is still arriving instead of after it
+    has been written out in full.  stream_func() takes no args and yields either rows (dicts) or chunks of jsonl (bytes
+    or str, which need not end on a newline).  It runs on its own thread and hands what it yields over through a queue
+    of at most queue_size batches, so a slow transform holds the download back rather than letting it pile up in memory.
+
+    cache_source - Also write what stream_func() yields to source_data.jsonl, so later runs can transform it again
+                   without streaming it.  Without it, the source never touches the disk.
+    batch_size, batch_format, compression, compression_level - See load_and_transform_source_data().  The cached
+                   source is compressed as it streams in.
+    """
+    source_path = source_file_path(namespace, name, 'source_data', compression=compression)
+    transformed_path = source_file_path(namespace, name, 'transformed_source_data', compression=compression)
+
+    Path(source_path).parent.mkdir(parents=True, exist_ok=True)
+
+    if Path(transformed_path).is_file():
+        metrics.progress(f"[stream_and_transform_source_data] data already loaded and transformed.  Returning: {transformed_path}")
+
+        return transformed_path
+
+    with metrics.stage('stream_and_transform_source_data', transformed_path), contextlib.ExitStack() as stack:
+        if Path(source_path).is_file():
+            metrics.progress(f"[stream_and_transform_source_data] transforming previously cached source: {source_path}")
+            metrics.count('bytes_read', Path(source_path).stat().st_size)
+
+            source = stack.enter_context(storage.open_path(source_path))
+            rows = (json.loads(line) for line in source if line.strip())
+            cache_source = False
+        else:
+            batches = queue.Queue(maxsize=queue_size)
+            stop = threading.Event()
+            cache_file = None
+            if cache_source:
+                cache_file = storage.open_binary(source_path + '.tmp', 'w', compression=compression, level=compression_level)
+
+            producer = threading.Thread(target=produce_stream, args=(stream_func, batches, stop, cache_file), daemon=True)
+            producer.start()
+            stack.callback(producer.join)
+            stack.callback(stop.set)
+
+            rows = consume_stream(batches)
+
+        with storage.open_file(transformed_path + '.tmp', 'w', compression=compression, level=compression_level) as tmpfile:
+            rows_in, rows_out = transform_rows(
+                rows=rows, transform_func=transform_func, output=tmpfile, batch_size=batch_size, batch_format=batch_format
+            )
+
+        metrics.count('rows_in', rows_in)
+        metrics.count('rows_out', rows_out)
+
+    if cache_source:
+        Path(source_path + '.tmp').replace(source_path)
 
     Path(transformed_path + '.tmp').replace(transformed_path)
 
     return transformed_path
 
 
-def group_data(source_path, group_key_func, group_by_name=''):
-    group_buckets = util.calculate_group_buckets(source_path=source_path)
-    print(f"[group_data] Start available_ram MB: {util.available_ram_bytes()/(1024**2)}")
+def stream_batches(items, cache=None, batch_rows=STREAM_BATCH_ROWS):
+    """
+    Pass chunks through as bytes and collect rows into lists of batch_rows, so the queue is not paid for row by row.
+    """
+    rows = []
+    for item in items:
+        if isinstance(item, (bytes, str)):
+            chunk = item.encode('utf-8') if isinstance(item, str) else item
+            if cache:
+                cache.write(chunk)
+
+            if rows:
+                yield rows
+                rows = []
+
+            yield chunk
+            continue
+
+        if cache:
+            cache.write(storage.dumps_record(item))
+
+        rows.append(item)
+        if len(rows) >= batch_rows:
+            yield rows
+            rows = []
+
+    if rows:
+        yield rows
+
+
+def put_unless_stopped(batches, batch, stop):
+    while not stop.is_set():
+        try:
+            batches.put(batch, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+def produce_stream(stream_func, batches, stop, cache_file=None):
+    """
+    Runs on the producer thread.  Ends the stream with None, or with the exception stream_func() raised.  Gives up as
+    soon as stop is set, which is how the consumer says it is not reading any more.  cache_file, a binary file opened
+    for writing, gets a copy of the stream and is closed once the stream ends.
+    """
+    try:
+        with cache_file or contextlib.nullcontext() as cache:
+            for batch in stream_batches(stream_func(), cache=cache):
+                if not put_unless_stopped(batches, batch, stop):
+                    return
+        last = None
+    except Exception as e:
+        last = e
+
+    put_unless_stopped(batches, last, stop)
+
+
+def consume_stream(batches):
+    """
+    Yield the rows of the batches produce_stream() queues up, splitting chunks back into jsonl lines.
+    """
+    pending = b''
+    while True:
+        start = time.perf_counter()
+        batch = batches.get()
+        metrics.add_timings({'stream_wait': time.perf_counter() - start})
+
+        if batch is None:
+            break
+
+        if isinstance(batch, Exception):
+            raise Exception(f"[consume_stream] stream_func() failed: {batch!r}") from batch
+
+        if isinstance(batch, bytes):
+            metrics.count('bytes_read', len(batch))
+            lines = (pending + batch).split(b'\n')
+            pending = lines.pop()
+            yield from (json.loads(line) for line in lines if line.strip())
+        else:
+            yield from batch
+
+    if pending.strip():
+        yield json.loads(pending)
+
+
+def transform_rows(rows, transform_func, output, batch_size=None, batch_format='rows'):
+    """
+    Returns (rows in, rows out).
+    """
+    if batch_size:
+        rows = iter(rows)
+        batches = iter(lambda: list(itertools.islice(rows, batch_size)), [])
+        return transform_batches(batches, transform_func=transform_func, output=output, batch_format=batch_format)
+
+    transform_func = metrics.timed('user_func', transform_func)
+    dumps = metrics.timed('codec', json.dumps)
+
+    counter = 0
+    for row in rows:
+        counter += 1
+        output.write(dumps(transform_func(row)) + '\n')
+
+        if not counter % DEBUG_MODULUS:
+            metrics.progress(f"[transform_rows] transformed {counter} docs.")
+
+    return counter, counter
+
+
+def transform_lines(lines, transform_func, output, batch_size=None, batch_format='rows'):
+    loads = metrics.timed('codec', json.loads)
+
+    if batch_size:
+        lines = (line for line in lines if line.strip())
+        line_batches = iter(lambda: list(itertools.islice(lines, batch_size)), [])
+        batches = (loads(decode_json_lines(line_batch)) for line_batch in line_batches)
+        return transform_batches(batches, transform_func=transform_func, output=output, batch_format=batch_format)
+
+    return transform_rows(rows=(loads(line.rstrip()) for line in lines), transform_func=transform_func, output=output)
+
+
+def decode_json_lines(lines):
+    """
+    Join jsonl lines, str or bytes, into one json array so a whole batch is decoded in a single json.loads() call.
+    """
+    if isinstance(lines[0], bytes):
+        return b'[' + b','.join(lines) + b']'
+
+    return '[' + ','.join(lines) + ']'
+
+
+def rows_to_columns(rows):
+    fields = dict.fromkeys(field for row in rows for field in row)
+
+    return {field: [row.get(field) for row in rows] for field in fields}
+
+
+def columns_to_rows(columns):
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+
+def transform_batches(batches, transform_func, output, batch_format='rows'):
+    """
+    Hand each batch of docs to transform_func() as a list, or as a dict of lists with batch_format='columns', and write
+    out whatever docs it returns.  Returns (rows in, rows out).
+    """
+    transform_func = metrics.timed('user_func', transform_func)
+    dumps = metrics.timed('codec', json.dumps)
+
+    rows_in, rows_out = 0, 0
+    for batch in batches:
+        transformed = transform_func(rows_to_columns(batch) if batch_format == 'columns' else batch)
+        if isinstance(transformed, dict):
+            transformed = columns_to_rows(transformed)
+
+        output.writelines([dumps(doc) + '\n' for doc in transformed])
+
+        if (rows_in + len(batch)) // DEBUG_MODULUS > rows_in // DEBUG_MODULUS:
+            metrics.progress(f"[transform_batches] transformed {rows_in + len(batch)} docs.")
+
+        rows_in += len(batch)
+        rows_out += len(transformed)
+
+    return rows_in, rows_out
+
+
+def read_byte_range(f, start, end):
+    f.seek(start)
+    position = start
+    while position < end:
+        line = f.readline()
+        if not line:
+            break
+
+        position += len(line)
+        yield line
+
+
+def transform_chunk_worker(source_path, start, end, output_path, batching, compression_level=None):
+    """
+    output_path is compressed as its suffix says.  Returns ((rows in, rows out), timings) so the parent stage can
+    account for the work done here.
+    """
+    with metrics.stage('transform_chunk', output_path, write_summary=False) as chunk_metrics:
+        with open(source_path, 'rb') as source, storage.open_path(output_path, 'w', level=compression_level) as output:
+            lines = read_byte_range(source, start, end)
+            rows = transform_lines(lines=lines, transform_func=WORKER_FUNCS['transform_func'], output=output, **batching)
+
+        return rows, dict(chunk_metrics.timings)
+
+
+def transform_chunks(
+    source_path,
+    output_path,
+    transform_func,
+    workers,
+    chunks_per_worker=4,
+    batching=None,
+    compression=None,
+    compression_level=None,
+):
+    """
+    A few chunks per worker keeps every worker busy even when some byte ranges are slower to transform than others.
+    Each chunk is compressed on its own and the compressed chunks are concatenated as is.
+    """
+    chunks = util.newline_aligned_chunks(source_path, chunks=workers * chunks_per_worker)
+
+    parts_path = f"{output_path}_parts"
+    shutil.rmtree(parts_path, ignore_errors=True)
+    Path(parts_path).mkdir(parents=True, exist_ok=True)
+
+    part_paths = [f"{parts_path}/{i}{storage.suffix(compression=compression)}" for i in range(len(chunks))]
+    metrics.progress(f"[transform_chunks] transforming {len(chunks)} chunks of {source_path} with {workers} workers.")
+
+    with util.process_pool(workers, initializer=init_worker, initargs=({'transform_func': transform_func},)) as pool:
+        args = [
+            (source_path, start, end, part_path, batching or {}, compression_level)
+            for (start, end), part_path in zip(chunks, part_paths)
+        ]
+        results = pool.starmap(transform_chunk_worker, args)
+
+    for _, timings in results:
+        metrics.add_timings(timings)
+
+    Path(output_path).unlink(missing_ok=True)
+    concatenate_files(paths=part_paths, output_path=output_path)
+    shutil.rmtree(parts_path)
+
+    return sum(rows[0] for rows, _ in results), sum(rows[1] for rows, _ in results)
+
+
+"""
+A Combiner folds the rows of a group into one accumulator.  create(row) starts an accumulator from a group's first row,
+add(accumulator, row) folds in another row and merge(accumulator, accumulator) combines two partial accumulators.  Each
+returns the new accumulator.  Accumulators are written to intermediate files, so they must be serializable with the
+codec in use.
+"""
+Combiner = collections.namedtuple('Combiner', ['create', 'add', 'merge'])
+
+
+def combiner_key(combiner):
+    """
+    A short hash of combiner's funcs, see cache.fingerprint_value().  group_data() keeps combined files in a folder named
+    after it, so they are never mistaken for a plain grouping or one by another combiner.
+    """
+    return hashlib.blake2b(repr(cache.fingerprint_value(combiner)).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def count_combiner():
+    return Combiner(create=lambda row: 1, add=lambda count, row: count + 1, merge=lambda one, two: one + two)
+
+
+def sum_combiner(value_func):
+    return Combiner(create=value_func, add=lambda total, row: total + value_func(row), merge=lambda one, two: one + two)
+
+
+def top_k_combiner(k, sort_key_func):
+    """
+    Keep the k rows with the largest sort_key_func(row), largest first.
+    """
+
+    def merge(one, two):
+        return heapq.nlargest(k, one + two, key=sort_key_func)
+
+    return Combiner(create=lambda row: [row], add=lambda top, row: merge(top, [row]), merge=merge)
+
+
+def group_data(
+    source_path,
+    group_key_func,
+    group_by_name='',
+    group_buckets=None,
+    key_sample_size=None,
+    partition='range',
+    workers=1,
+    codec='jsonl',
+    compression=None,
+    compression_level=None,
+    spill_bytes=None,
+    memory_multiplier=None,
+    index_every=SPARSE_INDEX_EVERY,
+    combiner=None,
+    chunk_rows=None,
+):
+    """
+    key_sample_size - When set, bucket boundaries are estimated from this many lines sampled from source_path instead of
+                      from a full scan and sort of every key.  This skips a full pass over the source and keeps the key
+                      list bounded at the cost of less evenly sized buckets.
+    partition       - 'range' splits the keys into sorted, contiguous buckets so the grouped buckets can simply be appended
+                      one after the other.  'hash' sends each row to bucket fixed_hash(group_key) % group_buckets in a
+                      single pass with no key pre-scan, then k-way merges the sorted buckets.  Bucket sizes stay even
+                      however clustered the keys are, but group keys must be strings.
+    workers         - Group this many buckets at once in a process pool.  Buckets are admitted only while their combined
+                      estimated memory stays within util.group_memory_budget().
+    codec           - How bucket files and the grouped file are serialized, see storage.CODECS.  'pickle' and 'marshal'
+                      skip the json text round trip between stages.  merge_data_sources() reads any of them.
+    compression     - Optionally compress bucket files and the grouped file, see storage.COMPRESSIONS.  source_path may
+                      be compressed too, whatever this is set to.
+    compression_level - See load_and_transform_source_data().
+    spill_bytes     - Estimated in-memory size at which a bucket being grouped is spilled to disk as a sorted run.  The
+                      runs are k-way merged back together, so a hot key or a bad estimate costs disk I/O instead of an
+                      OOM.  Defaults to each worker's share of util.group_memory_budget().
+    memory_multiplier - In-memory bytes per uncompressed byte of source_path, used to size buckets, admit them to
+                        workers and decide when to spill.  Measured from a sample of source_path when not given.
+    index_every       - Write a sparse index of every index_every'th group_key next to the grouped file for
+                        lookup_group(), lookup_groups() and read_group_range().  0 or None skips it, and the index is then
+                        built on first lookup instead.
+    combiner          - A Combiner to fold the rows of each group_key into one accumulator instead of collecting them,
+                        e.g. count_combiner().  Partial accumulators are already folded while the buckets are written,
+                        so the buckets hold at most one per group_key per COMBINE_MAX_KEYS rows rather than every row.
+                        Each grouped line then has the final accumulator as its only data.  It is written, along with
+                        its buckets, under a group_by_name suffixed with combiner_key(combiner), so neither is ever read
+                        back as a plain grouping of the same source_path or the other way around.
+    chunk_rows        - Split each group into consecutive records of at most chunk_rows rows, all under the same
+                        group_key, so a hot key is never written, or read back, as one giant line.  Groups coming off of
+                        spilled runs are chunked as they stream out, and with a codec other than 'jsonl' they are chunked
+                        at SPILL_CHUNK_ROWS rows even without chunk_rows, since those records can't be streamed.
+                        merge_data_sources() and the lookups read chunked files the same as any other, and
+                        merge_data_sources(lazy=True) only ever holds one chunk per source in memory.
+    """
+    if partition not in ('range', 'hash'):
+        raise Exception(f"[group_data] unknown partition: {partition}  Expected 'range' or 'hash'.")
+
+    file_suffix = storage.suffix(codec=codec, compression=compression)
+
+    if combiner:
+        group_by_name = f"{group_by_name}_combined_{combiner_key(combiner)}" if group_by_name else f"combined_{combiner_key(combiner)}"
+
+    grouped_path = grouped_file_path(source_path, group_by_name, file_suffix)
+    Path(grouped_path).parent.mkdir(parents=True, exist_ok=True)
+
+    key = cache.stage_key(
+        group_data,
+        [source_path],
+        funcs=[group_key_func, combiner],
+        params={
+            'partition': partition,
+            'codec': codec,
+            'compression': compression,
+            'compression_level': compression_level,
+            'index_every': index_every,
+            'chunk_rows': chunk_rows,
+        },
+    )
+    scratch_paths = [str(Path(grouped_path).parent / folder) for folder in ['buckets', 'hash_buckets']]
+    if cache.reuse(key, [grouped_path, sparse_index_path(grouped_path)], scratch_paths=scratch_paths):
+        metrics.progress(f"[group_data] found existing data, returning: {grouped_path}")
+        return grouped_path
+
+    if memory_multiplier is None:
+        memory_multiplier = util.estimate_memory_multiplier(source_path, key_func=group_key_func, decode=codec != 'jsonl')
+
+    if not group_buckets:
+        group_buckets = util.calculate_group_buckets(source_path=source_path, memory_multiplier=memory_multiplier, workers=workers)
+    metrics.progress(f"[group_data] Start available_ram MB: {util.available_ram_bytes()/(1024**2)}")
+
+    with metrics.stage('group_data', grouped_path):
+        metrics.count('bytes_read', Path(source_path).stat().st_size)
+
+        """
+        If group_buckets > 1, we will generate all of our buckets and assign them to the buckets var.
+        """
+        grouped_file = grouped_path.split('/')[-1]
+        buckets_path = grouped_path.replace(grouped_file, 'buckets' if partition == 'range' else 'hash_buckets')
+        if group_buckets > 1 and not Path(buckets_path).is_dir():
+            tmp_buckets_path = f"{buckets_path}_tmp"
+
+            shutil.rmtree(tmp_buckets_path, ignore_errors=True)
+            Path(tmp_buckets_path).mkdir(parents=True, exist_ok=True)
+
+            keys_path = None
+            if partition == 'hash':
+                bucket_names = [str(bucket) for bucket in range(group_buckets)]
+
+                def bucket_func(group_key):
+                    return bucket_names[fixed_hash(group_key) % group_buckets]
+
+            else:
+                if key_sample_size:
+                    sorted_keys = sample_and_sort_keys(jsonl_path=source_path, key_func=group_key_func, sample_size=key_sample_size)
+                else:
+                    keys_path = f"{tmp_buckets_path}/keys{'.txt' if codec == 'jsonl' else storage.suffix(codec=codec)}"
+                    sorted_keys = get_and_sort_keys(
+                        jsonl_path=source_path, key_func=group_key_func, keys_path=keys_path, codec=codec
+                    )
+                bucket_map = generate_bucket_map(keys=sorted_keys, buckets=group_buckets)
+                bucket_starts, bucket_names = bucket_boundaries(bucket_map)
+
+                metrics.progress(f"[group_data] bucket_map: {bucket_map}")
+
+                def bucket_func(group_key):
+                    return get_bucket(key=group_key, bucket_starts=bucket_starts, bucket_names=bucket_names)
+
+            write_buckets(
+                source_path=source_path,
+                buckets_path=tmp_buckets_path,
+                bucket_names=bucket_names,
+                group_key_func=group_key_func,
+                bucket_func=bucket_func,
+                codec=codec,
+                compression=compression,
+                compression_level=compression_level,
+                keys_path=keys_path,
+                combiner=combiner,
+            )
+
+            if keys_path:
+                Path(keys_path).unlink()
+
+            Path(tmp_buckets_path).replace(buckets_path)
+
+        Path(grouped_path + '.tmp').unlink(missing_ok=True)
+
+        buckets = [source_path]
+        if group_buckets > 1:
+            buckets = [str(p) for p in Path(buckets_path).glob(f"*{file_suffix}")]
+            buckets = sorted(buckets, key=lambda x: x.split('/')[-1][: -len(file_suffix)].split('_'))
+
+        if spill_bytes is None:
+            spill_bytes = util.group_memory_budget() / workers
+
+        group_kwargs = {
+            'codec': codec,
+            'compression': compression,
+            'compression_level': compression_level,
+            'keyed': group_buckets > 1,
+            'spill_bytes': spill_bytes,
+            'memory_multiplier': memory_multiplier,
+            'chunk_rows': chunk_rows,
+        }
+
+        metrics.progress(f"[group_data] Before for buckets - available_ram MB: {util.available_ram_bytes()/(1024**2)}")
+        if len(buckets) > 1 and (partition == 'hash' or workers > 1):
+            """
+            Hash buckets each hold keys from across the whole key space, so they are k-way merged into the final sorted
+            order.  Range buckets grouped in a pool finish out of order, so they are concatenated in bucket order once done.
+            """
+            parts_path = f"{grouped_path}_parts"
+            shutil.rmtree(parts_path, ignore_errors=True)
+            Path(parts_path).mkdir(parents=True, exist_ok=True)
+
+            part_paths = group_bucket_parts(
+                buckets=buckets,
+                parts_path=parts_path,
+                group_key_func=group_key_func,
+                workers=workers,
+                group_kwargs=group_kwargs,
+                combiner=combiner,
+            )
+
+            if partition == 'hash':
+                merge_sorted_groups(
+                    paths=part_paths,
+                    output_path=grouped_path + '.tmp',
+                    codec=codec,
+                    compression=compression,
+                    compression_level=compression_level,
+                )
+            else:
+                concatenate_files(paths=part_paths, output_path=grouped_path + '.tmp')
+
+            shutil.rmtree(parts_path)
+        else:
+            for bucket_path in buckets:
+                bucket_summary = group_bucket(
+                    bucket_path=bucket_path,
+                    group_key_func=group_key_func,
+                    output_path=grouped_path + '.tmp',
+                    combiner=combiner,
+                    **group_kwargs,
+                )
+                record_bucket_summary(bucket_summary)
+
+        Path(grouped_path + '.tmp').replace(grouped_path)
+
+        if index_every:
+            write_sparse_index(grouped_path, every=index_every)
+
+    cache.store(key, [grouped_path, sparse_index_path(grouped_path)])
 
+    return grouped_path
+
+
+def grouped_file_path(source_path, group_by_name, file_suffix):
     source_filename = source_path.split('/')[-1]
 
     """
@@ -64,107 +784,812 @@ def group_data(source_path, group_key_func, group_by_name=''):
         if group_by_name[0] != '_':
             group_by_name = '_' + group_by_name
 
-    grouped_path = source_path.replace(source_filename, f"{group_by_name}grouped_source_data.jsonl")
-    Path(grouped_path).parent.mkdir(parents=True, exist_ok=True)
+    return source_path.replace(source_filename, f"{group_by_name}grouped_source_data{file_suffix}")
+
+
+def write_buckets(
+    source_path,
+    buckets_path,
+    bucket_names,
+    group_key_func,
+    bucket_func,
+    codec='jsonl',
+    compression=None,
+    compression_level=None,
+    keys_path=None,
+    combiner=None,
+):
+    """
+    Every bucket record carries its group_key along with the row, so grouping a bucket never has to decode a row just
+    to call group_key_func() again.  jsonl bucket files hold 'json encoded group_key<TAB>source line' with the source
+    line copied as is.  Other codecs store (group_key, doc) tuples.
+
+    keys_path - As written by get_and_sort_keys().  For jsonl, one json encoded group_key per non-blank source line, so
+                rows are bucketed without being decoded at all.  For other codecs, every (group_key, doc) record, which
+                is bucketed as is in place of the source.
+    combiner  - Fold rows into per group_key partial accumulators and bucket those in place of the rows.  They are
+                flushed to the buckets every COMBINE_MAX_KEYS group_keys to bound memory.
+    """
+    partials = {}
+    bucket_file_handles = {}
+    file_suffix = storage.suffix(codec=codec, compression=compression)
+
+    group_key_func = metrics.timed('user_func', group_key_func)
+    loads, dumps = metrics.timed('codec', json.loads), metrics.timed('codec', json.dumps)
+
+    try:
+        """
+        Generally, we would prefer to just use 'with open()' down where we are doing our
+        'write(line)', but opening a file to append just one line is very slow in Windows.
+
+        Thus, we have optimized to use this dict of open file handles that get closed in the
+        finally block.
+        """
+
+        for bucket in bucket_names:
+            bucket_path = f"{buckets_path}/{bucket}{file_suffix}"
+            bucket_file_handles[bucket] = storage.open_file(
+                bucket_path, 'a', codec=codec, compression=compression, level=compression_level
+            )
+
+        def combine(group_key, data):
+            if group_key in partials:
+                partials[group_key] = combiner.add(partials[group_key], data)
+            else:
+                partials[group_key] = combiner.create(data)
+                if len(partials) >= COMBINE_MAX_KEYS:
+                    flush_partials(partials, bucket_file_handles, bucket_func=bucket_func, codec=codec)
+
+        with contextlib.ExitStack() as stack:
+            if keys_path and codec != 'jsonl':
+                keyed_rows = stack.enter_context(storage.open_binary(keys_path))
+                for counter, (_, payload) in enumerate(storage.iter_raw_records(keyed_rows, codec=codec), start=1):
+                    group_key, data = storage.loads_raw(payload, codec=codec)
+                    if combiner:
+                        combine(group_key, data)
+                    else:
+                        bucket_file_handles[bucket_func(group_key)].write(storage.record_bytes(payload, codec=codec))
 
-    if Path(grouped_path).is_file():
-        print(f"[group_data] found existing data, returning: {grouped_path}")
-        return grouped_path
+                    if not counter % DEBUG_MODULUS:
+                        metrics.progress(f"[write_buckets] bucketed {counter} docs from keys_path: {keys_path}")
+            else:
+                source = stack.enter_context(storage.open_path(source_path))
+                keys = stack.enter_context(open(keys_path, encoding='utf-8')) if keys_path else None
 
+                counter = 0
+                for line in source:
+                    line = line.rstrip()
+                    if not line:
+                        continue
+
+                    counter += 1
+                    data = None
+                    if keys:
+                        key_json = keys.readline()[:-1]
+                        group_key = loads(key_json)
+                    else:
+                        data = loads(line)
+                        group_key = group_key_func(data)
+                        key_json = dumps(group_key)
+
+                    if combiner:
+                        combine(group_key, data if data is not None else loads(line))
+                    elif codec == 'jsonl':
+                        bucket_file_handles[bucket_func(group_key)].write(f"{key_json}\t{line}\n")
+                    else:
+                        storage.write_record(bucket_file_handles[bucket_func(group_key)], (group_key, data), codec=codec)
+
+                    if not counter % DEBUG_MODULUS:
+                        metrics.progress(f"[write_buckets] bucketed {counter} docs from source_path: {source_path}")
+
+        flush_partials(partials, bucket_file_handles, bucket_func=bucket_func, codec=codec)
+    finally:
+        for bucket in bucket_file_handles:
+            bucket_file_handles[bucket].close()
+
+
+def flush_partials(partials, bucket_file_handles, bucket_func, codec):
+    for group_key, partial in partials.items():
+        bucket_file = bucket_file_handles[bucket_func(group_key)]
+        if codec == 'jsonl':
+            bucket_file.write(f"{json.dumps(group_key)}\t{json.dumps(partial)}\n")
+        else:
+            storage.write_record(bucket_file, (group_key, partial), codec=codec)
+
+    partials.clear()
+
+
+def read_keyed_rows(f, codec, group_key_func, keyed, raw):
     """
-    If group_buckets > 1, we will generate all of our buckets and assign them to the buckets var.
+    Yield (group_key, row, size) for every record in f, where size is the record's serialized size in bytes.  keyed
+    files were written by write_buckets() and already carry the group_key.  With raw, jsonl rows are yielded as their
+    undecoded line.
     """
-    grouped_file = grouped_path.split('/')[-1]
-    buckets_path = grouped_path.replace(grouped_file, 'buckets')
-    if group_buckets > 1 and not Path(buckets_path).is_dir():
-        tmp_buckets_path = f"{buckets_path}_tmp"
+    if group_key_func:
+        group_key_func = metrics.timed('user_func', group_key_func)
+    loads = metrics.timed('codec', json.loads)
 
-        shutil.rmtree(tmp_buckets_path, ignore_errors=True)
-        Path(tmp_buckets_path).mkdir(parents=True, exist_ok=True)
+    if codec != 'jsonl':
+        for record, size in storage.iter_sized_records(f, codec=codec):
+            if keyed:
+                yield record[0], record[1], size
+            else:
+                yield group_key_func(record), record, size
+        return
 
-        sorted_keys = get_and_sort_keys(jsonl_path=source_path, key_func=group_key_func)
-        bucket_map = generate_bucket_map(keys=sorted_keys, buckets=group_buckets)
+    for line in f:
+        size = len(line)
+        line = line.rstrip()
+        if not line:
+            continue
 
-        print(f"[group_data] bucket_map: {bucket_map}")
+        if keyed:
+            key_json, _, line = line.partition('\t')
+            group_key = loads(key_json)
+            yield group_key, (line if raw else loads(line)), size
+        else:
+            data = loads(line)
+            yield group_key_func(data), (line if raw else data), size
 
-        bucket_file_handles = {}
 
-        try:
+def dumps_group_line(group_key, raw_rows):
+    """
+    Build the json.dumps({'group_key': group_key, 'data': rows}) line straight from already serialized rows.
+    """
+    return f"{GROUP_KEY_PREFIX}{json.dumps(group_key)}, \"data\": [{', '.join(raw_rows)}]}}\n"
+
+
+def write_group(f, group_key, rows, codec, raw, chunk_rows=None):
+    """
+    rows may be a list or an iterator.  Raw jsonl rows from an iterator are streamed out one at a time, so a huge group
+    coming off of spilled runs is never held in memory.  Other records have to be built whole, so those are only bounded
+    by chunk_rows, with which the group is written as consecutive records of at most chunk_rows rows each.
+    """
+    if chunk_rows:
+        rows = iter(rows)
+        chunk = list(itertools.islice(rows, chunk_rows))
+        while chunk:
+            write_group(f, group_key, chunk, codec=codec, raw=raw)
+            chunk = list(itertools.islice(rows, chunk_rows))
+        return
+
+    if not raw:
+        storage.write_record(f, {'group_key': group_key, 'data': list(rows)}, codec=codec)
+        return
+
+    if isinstance(rows, list):
+        f.write(dumps_group_line(group_key, rows))
+        return
+
+    f.write(f"{GROUP_KEY_PREFIX}{json.dumps(group_key)}, \"data\": [")
+    for i, row in enumerate(rows):
+        if i:
+            f.write(', ')
+        f.write(row)
+    f.write(']}\n')
+
+
+def spill_run(grouped_data, run_path, codec, raw):
+    """
+    Write grouped_data out as a keyed, sorted run in the same layout write_buckets() uses.
+    """
+    keyed_rows = ((group_key, row) for group_key in sorted(grouped_data.keys()) for row in grouped_data[group_key])
+    write_run(keyed_rows, run_path=run_path, codec=codec, raw=raw)
+
+
+def write_run(keyed_rows, run_path, codec, raw):
+    with storage.open_file(run_path, 'w', codec=codec) as run:
+        for group_key, keyed_group in itertools.groupby(keyed_rows, key=lambda keyed_row: keyed_row[0]):
+            if codec == 'jsonl':
+                key_json = json.dumps(group_key)
+                run.writelines(f"{key_json}\t{row if raw else json.dumps(row)}\n" for _, row in keyed_group)
+            else:
+                for keyed_row in keyed_group:
+                    storage.write_record(run, keyed_row, codec=codec)
+
+
+def read_run(f, codec, raw):
+    return ((group_key, row) for group_key, row, _ in read_keyed_rows(f, codec=codec, group_key_func=None, keyed=True, raw=raw))
+
+
+def compact_spilled_runs(run_paths, codec, raw):
+    """
+    Merge the runs in consecutive groups of MAX_OPEN_RUNS, pass after pass, until at most MAX_OPEN_RUNS are left, so no
+    merge ever holds more run files open than that, however many runs a big bucket with a small spill_bytes is spilled
+    into.  Each merged run takes the place of the runs it came from, so rows keep the order they were read in.  Returns
+    the runs left.
+    """
+    merge_pass = 0
+    while len(run_paths) > MAX_OPEN_RUNS:
+        merge_pass += 1
+        metrics.progress(f"[compact_spilled_runs] pass {merge_pass}: merging {len(run_paths)} runs {MAX_OPEN_RUNS} at a time.")
+
+        merged_paths = []
+        for i in range(0, len(run_paths), MAX_OPEN_RUNS):
+            merging = run_paths[i : i + MAX_OPEN_RUNS]
+            merged_paths.append(f"{Path(merging[0]).parent}/pass_{merge_pass}_{len(merged_paths)}{storage.suffix(codec=codec)}")
+
+            with contextlib.ExitStack() as stack:
+                run_files = [stack.enter_context(storage.open_file(path, 'r', codec=codec)) for path in merging]
+                runs = [read_run(f, codec=codec, raw=raw) for f in run_files]
+                write_run(heapq.merge(*runs, key=lambda keyed_row: keyed_row[0]), run_path=merged_paths[-1], codec=codec, raw=raw)
+
+            for path in merging:
+                Path(path).unlink()
+
+        run_paths = merged_paths
+
+    return run_paths
+
+
+def merge_spilled_runs(run_files, grouped_data, codec, raw):
+    """
+    Yield (group_key, rows) in key order across every spilled run plus whatever is still held in grouped_data.
+    heapq.merge() is stable, so each group's rows keep the order they were read in.
+    """
+    runs = [read_run(f, codec=codec, raw=raw) for f in run_files]
+    runs.append((group_key, row) for group_key in sorted(grouped_data.keys()) for row in grouped_data[group_key])
+
+    merged = heapq.merge(*runs, key=lambda keyed_row: keyed_row[0])
+    for group_key, keyed_rows in itertools.groupby(merged, key=lambda keyed_row: keyed_row[0]):
+        yield group_key, (row for _, row in keyed_rows)
+
+
+def group_bucket(
+    bucket_path,
+    group_key_func,
+    output_path,
+    codec='jsonl',
+    compression=None,
+    compression_level=None,
+    keyed=False,
+    spill_bytes=None,
+    memory_multiplier=2.5,
+    combiner=None,
+    chunk_rows=None,
+):
+    """
+    When writing jsonl, rows are kept as the lines they were read as and spliced straight into the grouped line.  They
+    are never re-encoded, and rows from keyed buckets are never decoded either.
+
+    Once the rows held reach an estimated spill_bytes in memory, they are written out as a sorted run and the bucket
+    carries on from empty.  The runs are merged back together as the grouped output is written.
+
+    With a combiner, each group holds a single accumulator.  Rows read straight from a source are folded in with
+    combiner.add(), while keyed buckets and spilled runs already hold accumulators and are folded with combiner.merge().
+
+    Returns a summary of the bucket for the metrics of the calling stage.
+    """
+    start_time = time.perf_counter()
+    grouped_data = {}
+    raw = codec == 'jsonl' and not combiner
+
+    held_bytes = 0
+    peak_rss_bytes = 0
+    spill_path = f"{output_path}_spill"
+    run_paths = []
+
+    metrics.progress(f"[group_bucket] bucket: '{bucket_path}', available_ram MB: {util.available_ram_bytes()/(1024**2)}")
+    bucket_codec, bucket_compression = storage.detect(bucket_path)
+    with storage.open_file(bucket_path, 'r', codec=bucket_codec, compression=bucket_compression) as b:
+        group_counter = 0
+        rows = read_keyed_rows(b, codec=bucket_codec, group_key_func=group_key_func, keyed=keyed, raw=raw)
+        for group_key, row, size in rows:
+            group_counter += 1
+
+            if combiner:
+                if group_key in grouped_data:
+                    accumulator = grouped_data[group_key][0]
+                    grouped_data[group_key][0] = combiner.merge(accumulator, row) if keyed else combiner.add(accumulator, row)
+                    # Only a new accumulator adds to what is held.
+                    size = 0
+                else:
+                    grouped_data[group_key] = [row if keyed else combiner.create(row)]
+            elif group_key not in grouped_data:
+                grouped_data[group_key] = [row]
+            else:
+                grouped_data[group_key].append(row)
+
+            held_bytes += size
+            if spill_bytes and held_bytes * memory_multiplier > spill_bytes:
+                if not run_paths:
+                    shutil.rmtree(spill_path, ignore_errors=True)
+                    Path(spill_path).mkdir(parents=True, exist_ok=True)
+
+                run_paths.append(f"{spill_path}/{len(run_paths)}{storage.suffix(codec=codec)}")
+                metrics.progress(f"[group_bucket] spilling {len(grouped_data)} groups for bucket: {bucket_path} to {run_paths[-1]}")
+                spill_run(grouped_data, run_path=run_paths[-1], codec=codec, raw=raw)
+
+                peak_rss_bytes = max(peak_rss_bytes, util.MEMORY_MONITOR.rss_bytes(max_age=0) or 0)
+                grouped_data, held_bytes = {}, 0
+
+            if not group_counter % DEBUG_MODULUS:
+                metrics.progress(f"[group_bucket] grouped {group_counter} docs for bucket: {bucket_path}")
+                metrics.progress(f"[group_bucket] available_ram MB: {util.available_ram_bytes()/(1024**2)}")
+
+    peak_rss_bytes = max(peak_rss_bytes, util.MEMORY_MONITOR.rss_bytes(max_age=0) or 0)
+
+    if run_paths and not raw and not combiner and not chunk_rows:
+        # Only raw jsonl groups stream out of the runs, anything else is chunked so a hot key is never held whole.
+        chunk_rows = SPILL_CHUNK_ROWS
+
+    with contextlib.ExitStack() as stack:
+        if run_paths:
+            open_runs = compact_spilled_runs(run_paths, codec=codec, raw=raw)
+            run_files = [stack.enter_context(storage.open_file(run_path, 'r', codec=codec)) for run_path in open_runs]
+            groups = merge_spilled_runs(run_files, grouped_data, codec=codec, raw=raw)
+        else:
+            groups = ((group_key, grouped_data[group_key]) for group_key in sorted(grouped_data.keys()))
+            metrics.progress(f"[group_bucket] keys sorted, available_ram MB: {util.available_ram_bytes()/(1024**2)}")
+
+        tmpfile = stack.enter_context(
+            storage.open_file(output_path, 'a', codec=codec, compression=compression, level=compression_level)
+        )
+
+        write_counter = 0
+        for group_key, group_rows in groups:
+            if combiner:
+                group_rows = [functools.reduce(combiner.merge, group_rows)]
+
+            write_counter += 1
+            write_group(tmpfile, group_key, group_rows, codec=codec, raw=raw, chunk_rows=chunk_rows)
+
+            if not write_counter % DEBUG_MODULUS:
+                metrics.progress(f"[group_bucket] written {write_counter} groups to {output_path}")
+
+    if run_paths:
+        shutil.rmtree(spill_path)
+
+    return {
+        'bucket': bucket_path,
+        'rows': group_counter,
+        'groups': write_counter,
+        'spilled_runs': len(run_paths),
+        'seconds': round(time.perf_counter() - start_time, 3),
+        'peak_rss_bytes': peak_rss_bytes,
+    }
+
+
+def record_bucket_summary(bucket_summary):
+    metrics.add_timings(bucket_summary.pop('timings', {}))
+    metrics.count('rows_in', bucket_summary['rows'])
+    metrics.count('rows_out', bucket_summary['groups'])
+    metrics.record_bucket(bucket_summary)
+
+
+WORKER_FUNCS = {}
+
+
+def init_worker(funcs):
+    WORKER_FUNCS.update(funcs)
+
+
+def group_bucket_worker(bucket_path, output_path, group_kwargs):
+    with metrics.stage('group_bucket', output_path, write_summary=False) as bucket_metrics:
+        bucket_summary = group_bucket(
+            bucket_path=bucket_path,
+            group_key_func=WORKER_FUNCS['group_key_func'],
+            output_path=output_path,
+            combiner=WORKER_FUNCS['combiner'],
+            **group_kwargs,
+        )
+        bucket_summary['timings'] = dict(bucket_metrics.timings)
+
+    return bucket_summary
+
+
+def group_bucket_parts(buckets, parts_path, group_key_func, workers, group_kwargs, combiner=None):
+    file_suffix = storage.suffix(codec=group_kwargs['codec'], compression=group_kwargs['compression'])
+    part_paths = [f"{parts_path}/{i}{file_suffix}" for i in range(len(buckets))]
+
+    if workers == 1:
+        for bucket_path, part_path in zip(buckets, part_paths):
+            bucket_summary = group_bucket(
+                bucket_path=bucket_path, group_key_func=group_key_func, output_path=part_path, combiner=combiner, **group_kwargs
+            )
+            record_bucket_summary(bucket_summary)
+
+        return part_paths
+
+    memory_budget = util.group_memory_budget()
+    metrics.progress(f"[group_bucket_parts] grouping {len(buckets)} buckets with {workers} workers, memory_budget MB: {memory_budget/(1024**2)}")
+
+    worker_funcs = {'group_key_func': group_key_func, 'combiner': combiner}
+    with util.process_pool(workers, initializer=init_worker, initargs=(worker_funcs,)) as pool:
+        results, in_flight = [], []
+        for bucket_path, part_path in zip(buckets, part_paths):
+            estimate = util.estimate_memory_usage(bucket_path, memory_multiplier=group_kwargs['memory_multiplier'])
+
+            """
+            Hold this bucket back until enough in-flight buckets finish to make room for it.  A bucket bigger than the
+            whole budget still runs, just on its own.
             """
-            Generally, we would prefer to just use 'with open()' down where we are doing our
-            'write(line)', but opening a file to append just one line is very slow in Windows.
+            while in_flight:
+                in_flight = [(result, size) for result, size in in_flight if not result.ready()]
+                if not in_flight or sum(size for _, size in in_flight) + estimate <= memory_budget:
+                    break
+
+                in_flight[0][0].wait(0.05)
+
+            result = pool.apply_async(group_bucket_worker, (bucket_path, part_path, group_kwargs))
+            results.append(result)
+            in_flight.append((result, estimate))
+
+        for result in results:
+            record_bucket_summary(result.get())
+
+    return part_paths
+
+
+def copy_range(src, dst, start, end):
+    """
+    Copy bytes [start, end) of src to dst and return how many were copied.  src is only seeked when it is not already
+    at start, so compressed files read strictly forward are never rewound.
+    """
+    if start is None or start == end:
+        return 0
+
+    if src.tell() != start:
+        src.seek(start)
+
+    remaining = end - start
+    while remaining:
+        chunk = src.read(min(remaining, COPY_CHUNK_BYTES))
+        if not chunk:
+            raise Exception(f"[copy_range] unexpected end of file copying bytes {start} to {end}")
+
+        dst.write(chunk)
+        remaining -= len(chunk)
+
+    return end - start
+
+
+def concatenate_files(paths, output_path):
+    """
+    Plain byte concatenation.  This holds for compressed files too since gzip, bz2 and xz all read concatenated streams
+    back as one.
+    """
+    with open(output_path, 'ab') as output:
+        for path in paths:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, output)
+
+
+GROUP_KEY_PREFIX = '{"group_key": '
+GROUP_KEY_DECODER = json.JSONDecoder()
+
+
+def parse_group_key(line):
+    """
+    Grouped lines are written by json.dumps() with 'group_key' first, so the key can be decoded on its own without
+    paying to decode the whole 'data' list behind it.
+    """
+    if line.startswith(GROUP_KEY_PREFIX):
+        return GROUP_KEY_DECODER.raw_decode(line, len(GROUP_KEY_PREFIX))[0]
+
+    return json.loads(line)['group_key']
+
+
+def merge_sorted_groups(paths, output_path, codec='jsonl', compression=None, compression_level=None):
+    """
+    k-way merge the sorted grouped files in paths into output_path.  As with compact_spilled_runs(), more than
+    MAX_OPEN_RUNS files are first merged that many at a time, pass after pass, into uncompressed files next to them, so
+    a large group_buckets never holds a file open per bucket.  Every file merged in a pass is removed.
+    """
+    merge_pass = 0
+    while len(paths) > MAX_OPEN_RUNS:
+        merge_pass += 1
+        metrics.progress(f"[merge_sorted_groups] pass {merge_pass}: merging {len(paths)} files {MAX_OPEN_RUNS} at a time.")
+
+        merged_paths = []
+        for i in range(0, len(paths), MAX_OPEN_RUNS):
+            merging = paths[i : i + MAX_OPEN_RUNS]
+            merged_paths.append(f"{Path(merging[0]).parent}/pass_{merge_pass}_{len(merged_paths)}{storage.suffix(codec=codec)}")
+            merge_group_files(merging, merged_paths[-1], codec=codec)
+
+            for path in merging:
+                Path(path).unlink()
+
+        paths = merged_paths
+
+    merge_group_files(paths, output_path, codec=codec, compression=compression, compression_level=compression_level)
+
+
+def merge_group_files(paths, output_path, codec='jsonl', compression=None, compression_level=None):
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(storage.open_path(path)) for path in paths]
+        output = stack.enter_context(
+            storage.open_file(output_path, 'a', codec=codec, compression=compression, level=compression_level)
+        )
+
+        if codec == 'jsonl':
+            output.writelines(heapq.merge(*files, key=parse_group_key))
+        else:
+            records = [storage.iter_records(f, codec=codec) for f in files]
+            for record in heapq.merge(*records, key=lambda record: record['group_key']):
+                storage.write_record(output, record, codec=codec)
+
+
+def sparse_index_path(grouped_path):
+    return f"{grouped_path}.index.json"
+
+
+def raw_group_key(payload, codec='jsonl'):
+    if codec == 'jsonl':
+        return parse_group_key(payload.decode('utf-8'))
+
+    return storage.loads_raw(payload, codec=codec)['group_key']
+
+
+def write_sparse_index(grouped_path, every=SPARSE_INDEX_EVERY):
+    """
+    Record the group_key and byte offset of every `every`th group in grouped_path.  Since grouped files are sorted by
+    group_key, any key can then be found by bisecting the index and scanning at most `every` groups from the offset.
+    The offsets are into the uncompressed content, so compressed files are indexed too, they are just slower to seek.
+    """
+    codec, _ = storage.detect(grouped_path)
+
+    keys, offsets = [], []
+    with storage.open_binary(grouped_path) as f:
+        for i, (offset, payload) in enumerate(storage.iter_raw_records(f, codec=codec)):
+            if not i % every:
+                keys.append(raw_group_key(payload, codec=codec))
+                offsets.append(offset)
+
+    stat = Path(grouped_path).stat()
+    index = {'every': every, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'keys': keys, 'offsets': offsets}
+
+    index_path = sparse_index_path(grouped_path)
+    Path(index_path + '.tmp').write_text(json.dumps(index))
+    Path(index_path + '.tmp').replace(index_path)
+
+    return index
+
+
+def load_sparse_index(grouped_path):
+    """
+    Rebuild the index if it is missing or grouped_path has changed since it was written.
+    """
+    index_path = sparse_index_path(grouped_path)
+    if Path(index_path).is_file():
+        index = json.loads(Path(index_path).read_text())
+        stat = Path(grouped_path).stat()
+        if (index['size'], index['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            return index
+
+    return write_sparse_index(grouped_path)
+
+
+def scan_groups(f, codec, index, start_key=None, end_key=None):
+    """
+    Yield the decoded groups of f with start_key <= group_key <= end_key.  Either end may be None for an open range.
+    """
+    if not index['keys']:
+        return
+
+    """
+    Start from the last indexed key strictly before start_key, so a start_key sitting exactly on an index entry is still
+    found from the entry before it.
+    """
+    i = 0 if start_key is None else max(bisect.bisect_left(index['keys'], start_key) - 1, 0)
+    f.seek(index['offsets'][i])
+
+    for _, payload in storage.iter_raw_records(f, codec=codec, offset=index['offsets'][i]):
+        group_key = raw_group_key(payload, codec=codec)
+        if start_key is not None and group_key < start_key:
+            continue
+        if end_key is not None and group_key > end_key:
+            return
+
+        yield storage.loads_raw(payload, codec=codec)
+
+
+def read_group_range(grouped_path, start_key=None, end_key=None, use_mmap=False):
+    """
+    Yield the {'group_key': ..., 'data': [...]} groups with start_key <= group_key <= end_key without reading the rest of
+    grouped_path.
+    """
+    index = load_sparse_index(grouped_path)
+    codec, _ = storage.detect(grouped_path)
+
+    with storage.open_binary(grouped_path, use_mmap=use_mmap) as f:
+        yield from join_group_chunks(scan_groups(f, codec=codec, index=index, start_key=start_key, end_key=end_key))
+
+
+def join_group_chunks(groups):
+    """
+    Join the consecutive records a group was split into by group_data(chunk_rows=...) back into one group.
+    """
+    for group_key, chunks in itertools.groupby(groups, key=lambda group: group['group_key']):
+        yield {'group_key': group_key, 'data': [row for chunk in chunks for row in chunk['data']]}
+
+
+def lookup_groups(grouped_path, group_keys, use_mmap=False):
+    """
+    Return {group_key: data} for each of group_keys found in grouped_path.  The keys are looked up in sorted order in one
+    forward pass over one open file: each lookup carries on from where the last one stopped and only seeks when the
+    index has an entry further ahead.  A compressed file is never rewound and decompressed again.
+    """
+    index = load_sparse_index(grouped_path)
+    codec, _ = storage.detect(grouped_path)
+
+    found = {}
+    if not index['keys']:
+        return found
+
+    with storage.open_binary(grouped_path, use_mmap=use_mmap) as f:
+        records, record = None, None
+
+        def next_record():
+            offset, payload = next(records, (None, None))
+            return None if payload is None else (offset, raw_group_key(payload, codec=codec), payload)
+
+        for group_key in sorted(set(group_keys)):
+            i = max(bisect.bisect_left(index['keys'], group_key) - 1, 0)
+            if records is None or (record is not None and index['offsets'][i] > record[0]):
+                f.seek(index['offsets'][i])
+                records = storage.iter_raw_records(f, codec=codec, offset=index['offsets'][i])
+                record = next_record()
+            elif record is None:
+                # Read to the end already, so neither this key nor any after it is there.
+                break
+
+            while record is not None and record[1] < group_key:
+                record = next_record()
+
+            while record is not None and record[1] == group_key:
+                found.setdefault(group_key, []).extend(storage.loads_raw(record[2], codec=codec)['data'])
+                record = next_record()
+
+    return found
+
+
+def lookup_group(grouped_path, group_key, use_mmap=False):
+    """
+    Return the data grouped under group_key, or None if grouped_path has no such group_key.
+    """
+    return lookup_groups(grouped_path, [group_key], use_mmap=use_mmap).get(group_key)
+
+
+DELTA_OPS = ('insert', 'update', 'delete')
+
+
+def apply_group_delta(rows, ops, row_id_func):
+    """
+    Apply ops to the rows of one group in order.  Row ids must be unique within a group.  An update replaces its row in
+    place, an insert of an id already there acts as an update and a delete of an id not there is a no-op.
+    """
+    rows_by_id = {row_id_func(row): row for row in rows}
+    for op in ops:
+        if op.get('op') not in DELTA_OPS:
+            raise Exception(f"[apply_group_delta] unknown op: {op.get('op')}  Expected one of: {list(DELTA_OPS)}")
+
+        row_id = row_id_func(op['data'])
+        if op['op'] == 'delete':
+            rows_by_id.pop(row_id, None)
+        else:
+            rows_by_id[row_id] = op['data']
+
+    return list(rows_by_id.values())
+
+
+def read_group_keys(grouped_path):
+    codec, _ = storage.detect(grouped_path)
+    with storage.open_binary(grouped_path) as f:
+        return [raw_group_key(payload, codec=codec) for _, payload in storage.iter_raw_records(f, codec=codec)]
+
+
+def regroup_with_delta(
+    previous_grouped_path,
+    delta_path,
+    group_key_func,
+    row_id_func,
+    group_by_name='',
+    index_every=SPARSE_INDEX_EVERY,
+    chunk_rows=None,
+    compression_level=None,
+):
+    """
+    Build the new grouped file from previous_grouped_path and a delta instead of regrouping every source row.
+
+    delta_path holds one {"op": "insert" | "update" | "delete", "data": row} per line.  A deleted row needs just enough
+    of itself for group_key_func() and row_id_func().  Only the delta is grouped, then it is stream-merged into the
+    previous grouped file: groups the delta does not touch are copied over byte for byte and only the touched ones are
+    decoded, patched with apply_group_delta() and written back.  Groups left with no rows are dropped.
+
+    The new grouped file sits next to delta_path, named like group_data() would name it, and keeps the codec and
+    compression of previous_grouped_path.  Returns (grouped_path, changed_keys), where changed_keys can be handed to
+    merge_data_sources() to merge incrementally too.
+
+    chunk_rows - Write the patched groups in chunks, as group_data(chunk_rows=...) does.  Pass the same chunk_rows the
+                 previous grouped file was written with.  Groups that are copied over keep their chunks as they are.
+    compression_level - The level to compress the new grouped file at, see load_and_transform_source_data().
+    """
+    codec, compression = storage.detect(previous_grouped_path)
+
+    delta_grouped_path = group_data(
+        source_path=delta_path, group_key_func=lambda op: group_key_func(op['data']), group_by_name=group_by_name + '_delta'
+    )
+
+    grouped_path = grouped_file_path(delta_path, group_by_name, storage.suffix(codec=codec, compression=compression))
+    Path(grouped_path).parent.mkdir(parents=True, exist_ok=True)
+
+    if Path(grouped_path).is_file():
+        metrics.progress(f"[regroup_with_delta] found existing data, returning: {grouped_path}")
+        return grouped_path, read_group_keys(delta_grouped_path)
+
+    with metrics.stage('regroup_with_delta', grouped_path):
+        metrics.count('bytes_read', Path(delta_path).stat().st_size)
+        index = load_sparse_index(previous_grouped_path)
+        changed_keys = []
+
+        with contextlib.ExitStack() as stack:
+            previous = stack.enter_context(storage.open_binary(previous_grouped_path))
+            delta = stack.enter_context(storage.open_path(delta_grouped_path))
+            output = stack.enter_context(
+                storage.open_binary(grouped_path + '.tmp', 'w', compression=compression, level=compression_level)
+            )
 
-            Thus, we have optimized to use this dict of open file handles that get closed in the
-            finally block.
             """
+            previous is only ever read forward.  position is how far it has been read and copied, and held is a group
+            read from it whose key is past the current delta key, so it waits to be copied in its sorted place.
+            """
+            position = 0
+            held = None
+            for delta_group in storage.iter_records(delta):
+                group_key = delta_group['group_key']
+                changed_keys.append(group_key)
+                metrics.count('rows_in', len(delta_group['data']))
 
-            for bucket in bucket_map:
-                bucket_path = f"{tmp_buckets_path}/{bucket}.jsonl"
-                bucket_file_handles[bucket] = open(bucket_path, 'a', encoding='utf-8')
+                if held and held[0] < group_key:
+                    output.write(storage.record_bytes(held[1], codec=codec))
+                    held = None
 
-            with open(source_path, encoding='utf-8') as source:
-                counter = 0
-                for line in source:
-                    counter += 1
-                    group_key = group_key_func(json.loads(line.rstrip()))
+                if held is None:
+                    # Skip straight to the last indexed group before group_key, then scan at most index['every'] groups.
+                    i = bisect.bisect_left(index['keys'], group_key) - 1
+                    if i >= 0 and index['offsets'][i] > position:
+                        position += copy_range(previous, output, position, index['offsets'][i])
 
-                    bucket = get_bucket(key=group_key, bucket_map=bucket_map)
-                    bucket_file_handles[bucket].write(line)
+                    for offset, payload in storage.iter_raw_records(previous, codec=codec, offset=position):
+                        record = storage.record_bytes(payload, codec=codec)
+                        position = offset + len(record)
 
-                    if not counter % DEBUG_MODULUS:
-                        print(f"[group_data] bucketed {counter} docs from source_path: {source_path}")
-        finally:
-            for bucket in bucket_file_handles:
-                bucket_file_handles[bucket].close()
-
-        Path(tmp_buckets_path).replace(buckets_path)
-
-    Path(grouped_path + '.tmp').unlink(missing_ok=True)
-
-    buckets = [source_path]
-    if group_buckets > 1:
-        buckets = [str(p) for p in Path(buckets_path).glob("*.jsonl")]
-        buckets = sorted(buckets, key=lambda x: x.split('/')[-1].replace('.jsonl', '').split('_'))
-
-    print(f"[group_data] Before for buckets - available_ram MB: {util.available_ram_bytes()/(1024**2)}")
-    write_counter = 0
-    for bucket_path in buckets:
-        grouped_data = {}
-
-        print(f"[group_data] bucket: '{bucket_path}', available_ram MB: {util.available_ram_bytes()/(1024**2)}")
-        with open(bucket_path, encoding='utf-8') as b:
-            group_counter = 0
-            for line in b:
-                group_counter += 1
-                if line == '\n':
-                    continue
+                        key = raw_group_key(payload, codec=codec)
+                        if key >= group_key:
+                            held = (key, payload)
+                            break
 
-                data = json.loads(line.rstrip())
-                group_key = group_key_func(data)
+                        output.write(record)
 
-                if group_key not in grouped_data:
-                    grouped_data[group_key] = []
+                # A chunked group spans several records in a row, so keep reading until the group_key changes.
+                rows = []
+                while held and held[0] == group_key:
+                    rows.extend(storage.loads_raw(held[1], codec=codec)['data'])
+                    held = None
 
-                grouped_data[group_key].append(data)
+                    following = next(storage.iter_raw_records(previous, codec=codec, offset=position), None)
+                    if following:
+                        position = following[0] + len(storage.record_bytes(following[1], codec=codec))
+                        held = (raw_group_key(following[1], codec=codec), following[1])
 
-                if not group_counter % DEBUG_MODULUS:
-                    print(f"[group_data] grouped {group_counter} docs for bucket: {bucket_path}")
-                    print(f"[group_data] available_ram MB: {util.available_ram_bytes()/(1024**2)}")
+                rows = apply_group_delta(rows, ops=delta_group['data'], row_id_func=row_id_func)
+                chunk_size = chunk_rows or max(len(rows), 1)
+                for start in range(0, len(rows), chunk_size):
+                    chunk = {'group_key': group_key, 'data': rows[start : start + chunk_size]}
+                    output.write(storage.dumps_record(chunk, codec=codec))
 
-        sorted_keys = sorted(grouped_data.keys())
-        print(f"[group_data] keys sorted, available_ram MB: {util.available_ram_bytes()/(1024**2)}")
-        with open(grouped_path + '.tmp', 'a', encoding='utf-8') as tmpfile:
-            for group_key in sorted_keys:
-                write_counter += 1
-                line = {'group_key': group_key, 'data': grouped_data[group_key]}
-                tmpfile.write(json.dumps(line) + '\n')
+            if held:
+                output.write(storage.record_bytes(held[1], codec=codec))
+            shutil.copyfileobj(previous, output)
 
-                if not write_counter % DEBUG_MODULUS:
-                    print(f"[group_data] written {write_counter} groups to {grouped_path}.tmp")
+        metrics.count('changed_keys', len(changed_keys))
+        Path(grouped_path + '.tmp').replace(grouped_path)
 
-    Path(grouped_path + '.tmp').replace(grouped_path)
+        if index_every:
+            write_sparse_index(grouped_path, every=index_every)
 
-    return grouped_path
+    return grouped_path, changed_keys
 
 
 def fixed_hash(value):
@@ -209,17 +1634,38 @@ def generate_bucket_map(keys, buckets):
     return bucket_map
 
 
-def get_bucket(key, bucket_map):
-    for bucket in bucket_map:
-        if bucket_map[bucket][0] <= key <= bucket_map[bucket][1]:
-            return bucket
+def bucket_boundaries(bucket_map):
+    """
+    Flatten a bucket_map into sorted arrays of bucket start keys and bucket names for get_bucket() to bisect.
+    """
+    bucket_names = sorted(bucket_map, key=lambda bucket: bucket_map[bucket][0])
+    bucket_starts = [bucket_map[bucket][0] for bucket in bucket_names]
+
+    return bucket_starts, bucket_names
+
+
+def get_bucket(key, bucket_starts, bucket_names):
+    """
+    A key belongs to the last bucket starting at or before it.  A bucket_map built from sampled keys will not have seen
+    every key, so this also places keys that fall between two ranges, and keys below every range go to the first bucket.
+    """
+    index = bisect.bisect_right(bucket_starts, key) - 1
+
+    return bucket_names[max(index, 0)]
 
-    raise Exception(f"[get_bucket] key: {key}  We created a bucket_map that does not know what to do with our key!")
 
+def get_and_sort_keys(jsonl_path, key_func, keys_path=None, codec='jsonl'):
+    """
+    keys_path - Also write each key for write_buckets() to reuse, so no row is decoded a second time.  With codec
+                'jsonl', one json encoded key per non-blank line of jsonl_path, otherwise a (key, doc) record per row.
+    """
+    key_func, loads = metrics.timed('user_func', key_func), metrics.timed('codec', json.loads)
 
-def get_and_sort_keys(jsonl_path, key_func):
     keys = []
-    with open(jsonl_path, encoding='utf-8') as source:
+    with contextlib.ExitStack() as stack:
+        source = stack.enter_context(storage.open_path(jsonl_path))
+        keys_file = stack.enter_context(storage.open_file(keys_path, 'w', codec=codec)) if keys_path else None
+
         counter = 0
         for line in source:
             counter += 1
@@ -227,93 +1673,662 @@ def get_and_sort_keys(jsonl_path, key_func):
             if not line:
                 continue
 
-            keys.append(str(key_func(json.loads(line))))
+            doc = loads(line)
+            key = key_func(doc)
+            keys.append(str(key))
+
+            if keys_file and codec == 'jsonl':
+                keys_file.write(json.dumps(key) + '\n')
+            elif keys_file:
+                storage.write_record(keys_file, (key, doc), codec=codec)
 
             if not counter % DEBUG_MODULUS:
-                print(f"[get_and_sort_keys] gathered {counter} keys.")
+                metrics.progress(f"[get_and_sort_keys] gathered {counter} keys.")
 
     return sorted(keys)
 
 
-def load_line(f):
-    batch = {'group_key': None, 'data': []}
-    line = f.readline()
-    if line:
-        batch = json.loads(line[:-1])
-    return batch
+def sample_and_sort_keys(jsonl_path, key_func, sample_size):
+    keys = [str(key_func(json.loads(line))) for line in util.sample_lines_from_file(jsonl_path, sample_size=sample_size)]
 
+    metrics.progress(f"[sample_and_sort_keys] sampled {len(keys)} keys.")
 
-def merge_data_sources(name, namespace, data_one_jsonl_path, data_two_jsonl_path, merge_func):
-    merged_jsonl_path = f"{namespace}/{name}/merged.jsonl"
+    return sorted(keys)
+
+
+def merge_data_sources(
+    name,
+    namespace,
+    data_one_jsonl_path,
+    data_two_jsonl_path,
+    merge_func,
+    previous_merged_path=None,
+    changed_keys=None,
+    lazy=False,
+    workers=1,
+    compression=None,
+    compression_level=None,
+):
+    return merge_multiple_data_sources(
+        name=name,
+        namespace=namespace,
+        data_jsonl_paths=[data_one_jsonl_path, data_two_jsonl_path],
+        merge_func=merge_func,
+        previous_merged_path=previous_merged_path,
+        changed_keys=changed_keys,
+        lazy=lazy,
+        workers=workers,
+        compression=compression,
+        compression_level=compression_level,
+    )
+
+
+def merged_groups_path(merged_jsonl_path):
+    return f"{merged_jsonl_path}.groups"
+
+
+def write_merged_lines(output, groups_file, group_key, emit_json, offset):
+    """
+    Write the lines merge_func() emitted for group_key and note which byte range of the merged file they took up, so a
+    later incremental merge can copy them over as is.  emit_json may be a generator, which is written out as it goes.
+    Returns (the new offset, lines written).
+    """
+    start = offset
+    emitted = 0
+    for line in emit_json:
+        chunk = line.encode('utf-8')
+        output.write(chunk)
+        offset += len(chunk)
+        emitted += 1
+
+    if emitted:
+        groups_file.write(f"{json.dumps(group_key)}\t{start}\t{offset}\n")
+
+    return offset, emitted
+
+
+def merge_multiple_data_sources(
+    name,
+    namespace,
+    data_jsonl_paths,
+    merge_func,
+    previous_merged_path=None,
+    changed_keys=None,
+    lazy=False,
+    workers=1,
+    compression=None,
+    compression_level=None,
+):
+    """
+    Sort-merge join any number of grouped data sets on group_key in one pass.  merge_func() is handed
+    (group_key, data_one, data_two, ..., data_n) with an empty list for every source that lacks the group_key.
+
+    lazy                 - Hand merge_func() an iterator over each source's rows instead of a list.  Each iterator
+                           decodes the next chunk of its group only once the rows before it are used up, so with
+                           sources grouped by group_data(chunk_rows=...) memory is bounded by the chunk size rather
+                           than by the largest group.  Each iterator can only be walked once, so list() whichever side
+                           merge_func() needs to go over more than once.  Rows merge_func() leaves unread are skipped.
+    workers              - Cut the sources at shared group_key boundaries into about MERGE_RANGES_PER_WORKER key ranges
+                           per worker and merge them in a process pool.  Every record of a group_key lands in the same
+                           range, so the merged ranges are simply concatenated in order.  Worth it when merge_func() is
+                           CPU heavy.  Not used for incremental merges, which only rerun merge_func() on changed_keys.
+    compression          - Compress the merged file, e.g. to 'merged.jsonl.gz', see load_and_transform_source_data().
+                           The byte ranges in its groups file are offsets into the uncompressed content.
+    compression_level    - See load_and_transform_source_data().
+
+    previous_merged_path - A merged.jsonl from an earlier run over older versions of the same data sets.  Only the
+                           changed_keys are looked up and passed to merge_func() again, everything else is copied from
+                           previous_merged_path.  See regroup_with_delta().
+    """
+    merged_jsonl_path = source_file_path(namespace, name, 'merged', compression=compression)
     Path(merged_jsonl_path).parent.mkdir(parents=True, exist_ok=True)
 
-    if Path(merged_jsonl_path).is_file():
+    key = cache.stage_key(
+        merge_multiple_data_sources,
+        data_jsonl_paths,
+        funcs=[merge_func],
+        params={'lazy': lazy, 'compression': compression, 'compression_level': compression_level},
+    )
+    if cache.reuse(key, [merged_jsonl_path, merged_groups_path(merged_jsonl_path)]):
         return merged_jsonl_path
 
+    if previous_merged_path:
+        merge_changed_groups(
+            merged_jsonl_path=merged_jsonl_path,
+            previous_merged_path=previous_merged_path,
+            data_jsonl_paths=data_jsonl_paths,
+            changed_keys=changed_keys or [],
+            merge_func=merge_func,
+            lazy=lazy,
+            compression=compression,
+            compression_level=compression_level,
+        )
+    else:
+        with metrics.stage('merge_multiple_data_sources', merged_jsonl_path):
+            metrics.count('bytes_read', sum(Path(path).stat().st_size for path in data_jsonl_paths))
+
+            workfile = f"{merged_jsonl_path}.tmp"
+            compression_kwargs = {'compression': compression, 'compression_level': compression_level}
+            if workers > 1:
+                counts = merge_key_ranges(
+                    paths=data_jsonl_paths,
+                    output_path=workfile,
+                    merge_func=merge_func,
+                    workers=workers,
+                    lazy=lazy,
+                    **compression_kwargs,
+                )
+            else:
+                counts = merge_key_range(
+                    paths=data_jsonl_paths, output_path=workfile, merge_func=merge_func, lazy=lazy, **compression_kwargs
+                )
+
+            for counter_name, value in counts.items():
+                metrics.count(counter_name, value)
+
+            Path(merged_groups_path(workfile)).replace(merged_groups_path(merged_jsonl_path))
+            Path(workfile).replace(merged_jsonl_path)
+
+    cache.store(key, [merged_jsonl_path, merged_groups_path(merged_jsonl_path)])
+
+    return merged_jsonl_path
+
+
+def read_record_range(f, codec, start, end):
+    """
+    Yield the decoded records of f from byte offset start up to end, or to the end of the file when end is None.
+    """
+    f.seek(start)
+    for offset, payload in storage.iter_raw_records(f, codec=codec, offset=start):
+        if end is not None and offset >= end:
+            return
+
+        yield storage.loads_raw(payload, codec=codec)
+
+
+def merge_key_range(paths, output_path, merge_func, lazy=False, key_range=None, compression=None, compression_level=None):
+    """
+    Sort-merge the grouped files in paths into output_path, noting each group's byte range in its groups file.  See
+    merge_multiple_data_sources().
+
+    key_range - A (start, end) byte range per path, as cut by key_range_offsets(), to merge just those records.  start
+                None means the path has nothing in the range.  Whole files are merged without it.
+
+    Returns the counters for the calling stage.
+    """
+    merge_func, load = metrics.timed('user_func', merge_func), metrics.timed('codec', next)
+    dumps = metrics.timed('codec', json.dumps)
+    no_record = {'group_key': None, 'data': []}
+
     counter = 0
-    data_one_orphans = 0
-    data_two_orphans = 0
     merge_count = 0
+    groups = 0
+    rows_in = 0
+    offset = 0
+
+    with contextlib.ExitStack() as stack:
+        sources = []
+        for i, path in enumerate(paths):
+            codec, _ = storage.detect(path)
+            if key_range is None:
+                sources.append(storage.iter_records(stack.enter_context(storage.open_path(path)), codec=codec))
+            elif key_range[i][0] is None:
+                sources.append(iter(()))
+            else:
+                f = stack.enter_context(storage.open_binary(path))
+                sources.append(read_record_range(f, codec=codec, start=key_range[i][0], end=key_range[i][1]))
+
+        output = stack.enter_context(storage.open_binary(output_path, 'w', compression=compression, level=compression_level))
+        groups_file = stack.enter_context(open(merged_groups_path(output_path), 'w', encoding='utf-8'))
+
+        """
+        The heap holds the current group_key of every source that is not yet exhausted, so the smallest key is always on
+        top without needing a max str value to stand in for the exhausted sources.
+        """
+        batches = [load(source, no_record) for source in sources]
+        heap = [(batch['group_key'], i) for i, batch in enumerate(batches) if batch['group_key'] is not None]
+        heapq.heapify(heap)
+
+        def group_rows(i, group_key):
+            """
+            A group may be split over several records in a row, see group_data(chunk_rows=...).  The next one is only
+            loaded once the rows before it have been used up.
+            """
+            nonlocal rows_in
+            while batches[i]['group_key'] == group_key:
+                batch = batches[i]
+                batches[i] = load(sources[i], no_record)
+                rows_in += len(batch['data'])
+                yield from batch['data']
+
+        while heap:
+            group_key = heap[0][0]
+            groups += 1
 
-    workfile = f"{merged_jsonl_path}.tmp"
-    with open(data_one_jsonl_path, encoding='utf-8') as data_one, open(data_two_jsonl_path, encoding='utf-8') as data_two, open(
-        workfile, 'w', encoding='utf-8'
-    ) as output:
-        data_one_batch = load_line(data_one)
-        data_two_batch = load_line(data_two)
+            present = []
+            while heap and heap[0][0] == group_key:
+                present.append(heapq.heappop(heap)[1])
 
-        while data_one_batch['group_key'] is not None or data_two_batch['group_key'] is not None:
-            emit_json = []
-            if data_one_batch['group_key'] == data_two_batch['group_key']:
-                val = (data_one_batch['group_key'], data_one_batch['data'], data_two_batch['data'])
-                emit_json = [json.dumps(line) + '\n' for line in merge_func(val)]
+            data = [group_rows(i, group_key) if i in present else iter(()) for i in range(len(sources))]
+            if not lazy:
+                data = [list(rows) for rows in data]
 
-                emit_count = len(emit_json)
+            emit_json = (dumps(line) + '\n' for line in merge_func((group_key, *data)))
+            offset, emit_count = write_merged_lines(output, groups_file, group_key, emit_json=emit_json, offset=offset)
 
-                counter += emit_count
+            for i in present:
+                if lazy:
+                    collections.deque(data[i], maxlen=0)
+
+                if batches[i]['group_key'] is not None:
+                    heapq.heappush(heap, (batches[i]['group_key'], i))
+
+            counter += emit_count
+            if len(present) > 1:
                 merge_count += emit_count
 
-                if emit_json:
-                    output.writelines(emit_json)
+            if emit_count and not counter % DEBUG_MODULUS:
+                metrics.progress(f"[merge_key_range] counter: {counter}, merge_count: {merge_count} for {output_path}")
 
-                data_one_batch = load_line(data_one)
-                data_two_batch = load_line(data_two)
-            elif data_two_batch['group_key'] is None or (
-                data_one_batch['group_key'] and (data_one_batch['group_key'] < data_two_batch['group_key'])
-            ):
-                """
-                This is a pitiable logic check.. which would be simpler with a max value.. but.. we can have no
-                knowable max str value.
-                """
+    return {'groups': groups, 'rows_in': rows_in, 'rows_out': counter, 'merge_count': merge_count}
 
-                val = (data_one_batch['group_key'], data_one_batch['data'], [])
-                emit_json = [json.dumps(line) + '\n' for line in merge_func(val)]
 
-                emit_count = len(emit_json)
+def group_key_offset(f, codec, index, group_key):
+    """
+    Return the byte offset of the first record in f with a group_key >= group_key, or None if there is none.
+    """
+    if not index['keys']:
+        return None
 
-                counter += emit_count
+    i = max(bisect.bisect_left(index['keys'], group_key) - 1, 0)
+    f.seek(index['offsets'][i])
+    for offset, payload in storage.iter_raw_records(f, codec=codec, offset=index['offsets'][i]):
+        if raw_group_key(payload, codec=codec) >= group_key:
+            return offset
 
-                if emit_json:
-                    output.writelines(emit_json)
+    return None
 
-                data_one_batch = load_line(data_one)
-            else:
-                val = (data_two_batch['group_key'], [], data_two_batch['data'])
-                emit_json = [json.dumps(line) + '\n' for line in merge_func(val)]
 
-                emit_count = len(emit_json)
+def key_range_offsets(paths, ranges):
+    """
+    Cut the grouped files in paths at shared group_key boundaries into at most `ranges` key ranges.  The boundaries come
+    from the sparse indexes of the files, with each indexed key weighted by the bytes up to the next one, so the ranges
+    hold about the same number of bytes even when the files differ in size.  Compressed files are weighted less exactly.
+
+    Returns a list of key ranges, each holding a (start, end) byte range per path for merge_key_range().
+    """
+    indexes = [load_sparse_index(path) for path in paths]
+
+    weighted_keys = []
+    for index in indexes:
+        ends = index['offsets'][1:] + [index['size']]
+        weighted_keys.extend((key, max(end - start, 0)) for key, start, end in zip(index['keys'], index['offsets'], ends))
+    weighted_keys.sort(key=lambda weighted_key: weighted_key[0])
+
+    total = sum(weight for _, weight in weighted_keys)
+    boundaries = []
+    cumulative = 0
+    for key, weight in weighted_keys:
+        if total and cumulative >= total * (len(boundaries) + 1) / ranges and (not boundaries or key > boundaries[-1]):
+            boundaries.append(key)
+        cumulative += weight
+
+    cuts = []
+    for path, index in zip(paths, indexes):
+        codec, _ = storage.detect(path)
+        with storage.open_binary(path) as f:
+            cuts.append([0] + [group_key_offset(f, codec=codec, index=index, group_key=key) for key in boundaries] + [None])
+
+    return [[(path_cuts[j], path_cuts[j + 1]) for path_cuts in cuts] for j in range(len(boundaries) + 1)]
+
+
+def merge_key_range_worker(paths, output_path, lazy, key_range, compression_kwargs):
+    with metrics.stage('merge_key_range', output_path, write_summary=False) as range_metrics:
+        counts = merge_key_range(
+            paths=paths,
+            output_path=output_path,
+            merge_func=WORKER_FUNCS['merge_func'],
+            lazy=lazy,
+            key_range=key_range,
+            **compression_kwargs,
+        )
+
+        return counts, dict(range_metrics.timings)
+
+
+def merge_key_ranges(paths, output_path, merge_func, workers, lazy=False, compression=None, compression_level=None):
+    """
+    Merge the key ranges cut by key_range_offsets() in a process pool, then stitch the merged ranges and their groups
+    files together in key order.  Compressed ranges are concatenated as is.  Returns the summed counters.
+    """
+    key_ranges = key_range_offsets(paths, ranges=workers * MERGE_RANGES_PER_WORKER)
+
+    parts_path = f"{output_path}_parts"
+    shutil.rmtree(parts_path, ignore_errors=True)
+    Path(parts_path).mkdir(parents=True, exist_ok=True)
+
+    part_paths = [f"{parts_path}/{i}{storage.suffix(compression=compression)}" for i in range(len(key_ranges))]
+    metrics.progress(f"[merge_key_ranges] merging {len(key_ranges)} key ranges of {paths} with {workers} workers.")
+
+    with util.process_pool(workers, initializer=init_worker, initargs=({'merge_func': merge_func},)) as pool:
+        compression_kwargs = {'compression': compression, 'compression_level': compression_level}
+        args = [(paths, part_path, lazy, key_range, compression_kwargs) for key_range, part_path in zip(key_ranges, part_paths)]
+        results = pool.starmap(merge_key_range_worker, args)
+
+    counts = collections.Counter()
+    for part_counts, timings in results:
+        counts.update(part_counts)
+        metrics.add_timings(timings)
+
+    Path(output_path).unlink(missing_ok=True)
+    concatenate_files(paths=part_paths, output_path=output_path)
+
+    """
+    The byte ranges in each part's groups file are relative to that part, so shift them by the parts before it.  Every
+    merged line belongs to a group, so a part's last range ends at its uncompressed size.
+    """
+    with open(merged_groups_path(output_path), 'w', encoding='utf-8') as groups_file:
+        shift = 0
+        for part_path in part_paths:
+            end = 0
+            with open(merged_groups_path(part_path), encoding='utf-8') as part_groups:
+                for line in part_groups:
+                    key_json, start, end = line.rstrip('\n').split('\t')
+                    groups_file.write(f"{key_json}\t{int(start) + shift}\t{int(end) + shift}\n")
+
+            shift += int(end)
+
+    shutil.rmtree(parts_path)
+
+    return dict(counts)
+
+
+def merge_changed_groups(
+    merged_jsonl_path,
+    previous_merged_path,
+    data_jsonl_paths,
+    changed_keys,
+    merge_func,
+    lazy=False,
+    compression=None,
+    compression_level=None,
+):
+    """
+    Walk the groups recorded next to previous_merged_path in key order.  Runs of unchanged groups are copied byte for
+    byte, while each changed key gets merge_func() rerun on its groups looked up from data_jsonl_paths and is written in
+    its sorted place.  Only the changed groups are ever decoded.
+
+    previous_merged_path is only read forward, so it may be compressed, and need not be compressed like the output.
+    """
+    with metrics.stage('merge_multiple_data_sources', merged_jsonl_path):
+        merge_func, dumps = metrics.timed('user_func', merge_func), metrics.timed('codec', json.dumps)
+
+        changed_keys = sorted(set(changed_keys))
+        changed_data = [lookup_groups(path, changed_keys) for path in data_jsonl_paths]
+        metrics.count('changed_keys', len(changed_keys))
+
+        counter = 0
+        copied_groups = 0
+        offset = 0
+
+        workfile = f"{merged_jsonl_path}.tmp"
+        with contextlib.ExitStack() as stack:
+            previous = stack.enter_context(storage.open_binary(previous_merged_path))
+            previous_groups = stack.enter_context(open(merged_groups_path(previous_merged_path), encoding='utf-8'))
+            output = stack.enter_context(storage.open_binary(workfile, 'w', compression=compression, level=compression_level))
+            groups_file = stack.enter_context(open(merged_groups_path(workfile), 'w', encoding='utf-8'))
+
+            def merge_changed(group_key):
+                data = [source_data.get(group_key, []) for source_data in changed_data]
+                if not any(data):
+                    return []
+
+                if lazy:
+                    data = [iter(rows) for rows in data]
+
+                return [dumps(line) + '\n' for line in merge_func((group_key, *data))]
+
+            # [copy_start, copy_end) of previous_merged_path is waiting to be copied and moves by shift in the new file.
+            copy_start = copy_end = shift = None
+
+            i = 0
+            for line in previous_groups:
+                key_json, start, end = line.rstrip('\n').split('\t')
+                group_key, start, end = json.loads(key_json), int(start), int(end)
+
+                replaced = False
+                while i < len(changed_keys) and changed_keys[i] <= group_key:
+                    offset += copy_range(previous, output, copy_start, copy_end)
+                    copy_start = copy_end = None
+
+                    changed_key = changed_keys[i]
+                    emit_json = merge_changed(changed_key)
+                    offset, emitted = write_merged_lines(output, groups_file, changed_key, emit_json=emit_json, offset=offset)
+                    counter += emitted
+
+                    replaced = changed_key == group_key
+                    i += 1
+
+                if replaced:
+                    continue
+
+                if copy_end != start:
+                    offset += copy_range(previous, output, copy_start, copy_end)
+                    copy_start, shift = start, offset - start
+
+                copy_end = end
+                copied_groups += 1
+                groups_file.write(f"{key_json}\t{start + shift}\t{end + shift}\n")
 
-                counter += emit_count
+            offset += copy_range(previous, output, copy_start, copy_end)
 
-                if emit_json:
-                    output.writelines(emit_json)
+            for group_key in changed_keys[i:]:
+                emit_json = merge_changed(group_key)
+                offset, emitted = write_merged_lines(output, groups_file, group_key=group_key, emit_json=emit_json, offset=offset)
+                counter += emitted
+
+        metrics.count('rows_out', counter)
+        metrics.count('copied_groups', copied_groups)
+        Path(merged_groups_path(workfile)).replace(merged_groups_path(merged_jsonl_path))
+        Path(workfile).replace(merged_jsonl_path)
+
+    return merged_jsonl_path
+
+
+JOIN_STRATEGIES = ('auto', 'hash', 'sort_merge')
+
+
+def join_data_sources(
+    name,
+    namespace,
+    data_one_jsonl_path,
+    data_two_jsonl_path,
+    group_key_func,
+    merge_func,
+    strategy='sort_merge',
+    broadcast_bytes=None,
+    compression=None,
+    compression_level=None,
+):
+    """
+    Join two ungrouped data sets on group_key_func(), picking how.
+
+    strategy        - 'sort_merge' runs group_data() on both and then merge_data_sources().  'hash' runs
+                      hash_join_data_sources(), holding the smaller input in memory and streaming the larger one once
+                      with no grouping or sorting.  'auto' picks 'hash' when the smaller input is estimated to fit in
+                      broadcast_bytes of memory.
+    broadcast_bytes - Defaults to util.group_memory_budget().
+    compression, compression_level - Compress the merged file, and with 'sort_merge' the grouped files too, see
+                      load_and_transform_source_data().
+
+    With 'hash', merge_func() is handed the rows of the larger input one at a time, i.e. (group_key, data_one, data_two)
+    with a single row on the large side, and the output is in the streamed side's order.  Only opt into 'hash' or 'auto'
+    with a merge_func() that works row by row, like a lookup or a cross product, never one that counts or dedupes a
+    group.  The two write to differently named files, so output from one is never picked back up by the other.
+    """
+    if strategy not in JOIN_STRATEGIES:
+        raise Exception(f"[join_data_sources] unknown strategy: {strategy}  Expected one of: {list(JOIN_STRATEGIES)}")
+
+    if strategy == 'auto':
+        small_path = min([data_one_jsonl_path, data_two_jsonl_path], key=storage.uncompressed_size)
+        memory_multiplier = util.estimate_memory_multiplier(small_path, key_func=group_key_func)
+        estimate = util.estimate_memory_usage(small_path, memory_multiplier=memory_multiplier)
+        if broadcast_bytes is None:
+            broadcast_bytes = util.group_memory_budget()
+
+        strategy = 'hash' if estimate <= broadcast_bytes else 'sort_merge'
+        metrics.progress(
+            f"[join_data_sources] {small_path} estimated at {estimate/(1024**2):.1f} MB in memory, broadcast MB: "
+            f"{broadcast_bytes/(1024**2):.1f}.  Using strategy: {strategy}"
+        )
+
+    if strategy == 'hash':
+        return hash_join_data_sources(
+            name=name,
+            namespace=namespace,
+            data_one_jsonl_path=data_one_jsonl_path,
+            data_two_jsonl_path=data_two_jsonl_path,
+            group_key_func=group_key_func,
+            merge_func=merge_func,
+            compression=compression,
+            compression_level=compression_level,
+        )
+
+    # Each side gets its own group_by_name, the two inputs may well sit in the same folder.
+    compression_kwargs = {'compression': compression, 'compression_level': compression_level}
+    grouped_paths = [
+        group_data(source_path=path, group_key_func=group_key_func, group_by_name=f"{name}_{side}", **compression_kwargs)
+        for side, path in [('one', data_one_jsonl_path), ('two', data_two_jsonl_path)]
+    ]
+
+    return merge_data_sources(
+        name=name,
+        namespace=namespace,
+        data_one_jsonl_path=grouped_paths[0],
+        data_two_jsonl_path=grouped_paths[1],
+        merge_func=merge_func,
+        **compression_kwargs,
+    )
+
+
+def hash_join_data_sources(
+    name,
+    namespace,
+    data_one_jsonl_path,
+    data_two_jsonl_path,
+    group_key_func,
+    merge_func,
+    broadcast=None,
+    use_mmap=False,
+    compression=None,
+    compression_level=None,
+):
+    """
+    Broadcast hash join of two ungrouped jsonl data sets.  The broadcast side is loaded into a dict keyed by
+    group_key_func(), then the other side is streamed through once.  merge_func() is handed
+    (group_key, data_one, data_two) for every row of the streamed side with that row as a one element list, then once
+    more for every broadcast group_key the streamed side never had, with an empty list for the streamed side.
+
+    The output is in the streamed side's order rather than sorted by group_key.  It is written to 'hash_joined.jsonl'
+    rather than 'merged.jsonl', so it is never mistaken for the output of merge_data_sources() under the same name.
+
+    broadcast - 'one' or 'two', which input to hold in memory.  Defaults to the smaller file.
+    use_mmap  - Keep only byte offsets per group_key and decode broadcast rows from the memory mapped file when they are
+                needed.  This holds little more than the keys in memory, at the cost of decoding rows once per match.
+                A compressed broadcast side can't be mapped and is read back by seeking through it instead, which is slow.
+    compression, compression_level - See merge_multiple_data_sources().
+    """
+    merged_jsonl_path = source_file_path(namespace, name, 'hash_joined', compression=compression)
+    Path(merged_jsonl_path).parent.mkdir(parents=True, exist_ok=True)
+
+    if Path(merged_jsonl_path).is_file():
+        return merged_jsonl_path
+
+    paths = [data_one_jsonl_path, data_two_jsonl_path]
+    if broadcast is None:
+        broadcast = 'one' if storage.uncompressed_size(paths[0]) <= storage.uncompressed_size(paths[1]) else 'two'
+
+    if broadcast not in ('one', 'two'):
+        raise Exception(f"[hash_join_data_sources] broadcast must be 'one' or 'two', not: {broadcast}")
+
+    small, large = (0, 1) if broadcast == 'one' else (1, 0)
+
+    with metrics.stage('hash_join_data_sources', merged_jsonl_path):
+        metrics.count('bytes_read', sum(Path(path).stat().st_size for path in paths))
+        group_key_func, merge_func = metrics.timed('user_func', group_key_func), metrics.timed('user_func', merge_func)
+        loads, dumps = metrics.timed('codec', json.loads), metrics.timed('codec', json.dumps)
+
+        counter = 0
+        merge_count = 0
+        rows_in = 0
+
+        with contextlib.ExitStack() as stack:
+            broadcast_file = stack.enter_context(storage.open_binary(paths[small], use_mmap=use_mmap))
+
+            broadcast_rows = {}
+            for offset, payload in storage.iter_raw_records(broadcast_file):
+                row = loads(payload)
+                broadcast_rows.setdefault(group_key_func(row), []).append(offset if use_mmap else row)
+                rows_in += 1
+
+            metrics.progress(f"[hash_join_data_sources] loaded {len(broadcast_rows)} group_keys from {paths[small]}")
+
+            def read_broadcast_rows(offsets):
+                rows = []
+                for offset in offsets:
+                    broadcast_file.seek(offset)
+                    rows.append(loads(broadcast_file.readline()))
+                return rows
+
+            streamed = stack.enter_context(storage.open_path(paths[large]))
+            output = stack.enter_context(
+                storage.open_file(f"{merged_jsonl_path}.tmp", 'w', compression=compression, level=compression_level)
+            )
+
+            matched_keys = set()
+            data = [None, None]
+            for line in streamed:
+                if not line.strip():
+                    continue
+
+                row = loads(line)
+                group_key = group_key_func(row)
+                rows_in += 1
+
+                small_data = broadcast_rows.get(group_key, [])
+                if small_data:
+                    matched_keys.add(group_key)
+                    if use_mmap:
+                        small_data = read_broadcast_rows(small_data)
+
+                data[small], data[large] = small_data, [row]
+                emit_json = [dumps(doc) + '\n' for doc in merge_func((group_key, *data))]
+                output.writelines(emit_json)
+
+                counter += len(emit_json)
+                if small_data:
+                    merge_count += len(emit_json)
+
+                if emit_json and not counter % DEBUG_MODULUS:
+                    metrics.progress(f"[hash_join_data_sources] counter: {counter}, merge_count: {merge_count} for {merged_jsonl_path}")
+
+            for group_key, small_data in broadcast_rows.items():
+                if group_key in matched_keys:
+                    continue
 
-                data_two_batch = load_line(data_two)
+                if use_mmap:
+                    small_data = read_broadcast_rows(small_data)
 
-            if emit_json and not counter % DEBUG_MODULUS:
-                print(f"[merge_data_sources] counter: {counter}, merge_count: {merge_count} for {merged_jsonl_path}")
+                data[small], data[large] = small_data, []
+                emit_json = [dumps(doc) + '\n' for doc in merge_func((group_key, *data))]
+                output.writelines(emit_json)
+                counter += len(emit_json)
 
-    Path(workfile).replace(merged_jsonl_path)
+        metrics.count('groups', len(broadcast_rows))
+        metrics.count('rows_in', rows_in)
+        metrics.count('rows_out', counter)
+        metrics.count('merge_count', merge_count)
+        Path(f"{merged_jsonl_path}.tmp").replace(merged_jsonl_path)
 
     return merged_jsonl_path
 
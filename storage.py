@@ -0,0 +1,198 @@
+import bz2
+import gzip
+import json
+import lzma
+import marshal
+import mmap
+import pickle
+import struct
+
+from pathlib import Path
+
+
+"""
+Intermediate files (bucket files, grouped files and merge inputs) can be written with a codec other than jsonl, and any
+file pomps writes can be compressed.  Both are recorded in the file suffix, e.g. 'grouped_source_data.pickle.gz', so
+readers work out how to open a file from its path alone.
+"""
+
+CODECS = {'jsonl': '.jsonl', 'pickle': '.pickle', 'marshal': '.marshal'}
+COMPRESSIONS = {'gzip': '.gz', 'bz2': '.bz2', 'lzma': '.xz'}
+
+COMPRESSION_OPENERS = {'gzip': (gzip.open, 'compresslevel'), 'bz2': (bz2.open, 'compresslevel'), 'lzma': (lzma.open, 'preset')}
+
+DUMPS = {'pickle': lambda obj: pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL), 'marshal': marshal.dumps}
+LOADS = {'pickle': pickle.loads, 'marshal': marshal.loads}
+
+# How much of a compressed file compression_ratio() decompresses to measure it.
+RATIO_SAMPLE_BYTES = 4 * 1024**2
+
+# Binary records are a little-endian unsigned 8 byte length followed by that many payload bytes.
+RECORD_LENGTH = struct.Struct('<Q')
+
+
+def suffix(codec='jsonl', compression=None):
+    if codec not in CODECS:
+        raise Exception(f"[suffix] unknown codec: {codec}  Expected one of: {list(CODECS)}")
+
+    if compression and compression not in COMPRESSIONS:
+        raise Exception(f"[suffix] unknown compression: {compression}  Expected one of: {list(COMPRESSIONS)}")
+
+    return CODECS[codec] + (COMPRESSIONS[compression] if compression else '')
+
+
+def detect(path):
+    """
+    Return the (codec, compression) recorded in the suffix of path.  Anything unrecognized is read as plain jsonl.
+    """
+    suffixes = Path(path).suffixes
+
+    compression = None
+    for name, compression_suffix in COMPRESSIONS.items():
+        if suffixes and suffixes[-1] == compression_suffix:
+            compression = name
+            suffixes = suffixes[:-1]
+
+    codec = 'jsonl'
+    for name, codec_suffix in CODECS.items():
+        if suffixes and suffixes[-1] == codec_suffix:
+            codec = name
+
+    return codec, compression
+
+
+def open_file(path, mode='r', codec='jsonl', compression=None, level=None):
+    """
+    jsonl files are opened in text mode so they can be handled line by line, everything else in binary mode.  mode is
+    one of 'r', 'w' or 'a'.  level is only applied when writing.
+    """
+    text = codec == 'jsonl'
+    mode = mode + ('t' if text else 'b')
+    kwargs = {'encoding': 'utf-8'} if text else {}
+
+    if not compression:
+        return open(path, mode, **kwargs)
+
+    opener, level_arg = COMPRESSION_OPENERS[compression]
+    if level is not None and 'r' not in mode:
+        kwargs[level_arg] = level
+
+    return opener(path, mode, **kwargs)
+
+
+def open_path(path, mode='r', level=None):
+    return open_file(path, mode, *detect(path), level=level)
+
+
+def open_binary(path, mode='r', use_mmap=False, compression=None, level=None):
+    """
+    Open path for seeking by byte offset into its uncompressed content.  use_mmap maps uncompressed, non-empty files
+    into memory instead of reading them through a file buffer.  Compressed files seek by decompressing, which is only
+    cheap going forward.  compression defaults to whatever the suffix of path says.
+    """
+    compression = compression or detect(path)[1]
+    if compression:
+        opener, level_arg = COMPRESSION_OPENERS[compression]
+        kwargs = {level_arg: level} if level is not None and 'r' not in mode else {}
+        return opener(path, mode + 'b', **kwargs)
+
+    f = open(path, mode + 'b')
+    if 'r' not in mode or not use_mmap or not f.seek(0, 2):
+        f.seek(0)
+        return f
+
+    with f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def compression_ratio(path, sample_bytes=RATIO_SAMPLE_BYTES):
+    """
+    Uncompressed bytes per byte of path on disk, measured by decompressing the first sample_bytes of it.  1.0 for an
+    uncompressed file.
+    """
+    compression = detect(path)[1]
+    if not compression:
+        return 1.0
+
+    with open(path, 'rb') as raw, COMPRESSION_OPENERS[compression][0](raw, 'rb') as f:
+        uncompressed = len(f.read(sample_bytes))
+        compressed = raw.tell()
+
+    return uncompressed / compressed if compressed and uncompressed else 1.0
+
+
+def uncompressed_size(path):
+    """
+    The size of path once decompressed, estimated with compression_ratio() for compressed files.
+    """
+    return Path(path).stat().st_size * compression_ratio(path)
+
+
+def iter_raw_records(f, codec='jsonl', offset=0):
+    """
+    Yield (offset, payload) for every record of a file opened with open_binary() and already positioned at offset.
+    payload is the undecoded line for jsonl and the record bytes after the length header otherwise.
+    """
+    if codec == 'jsonl':
+        for line in iter(f.readline, b''):
+            if line.strip():
+                yield offset, line
+            offset += len(line)
+        return
+
+    header = f.read(RECORD_LENGTH.size)
+    while header:
+        size = RECORD_LENGTH.unpack(header)[0]
+        yield offset, f.read(size)
+        offset += RECORD_LENGTH.size + size
+        header = f.read(RECORD_LENGTH.size)
+
+
+def loads_raw(payload, codec='jsonl'):
+    return json.loads(payload) if codec == 'jsonl' else LOADS[codec](payload)
+
+
+def record_bytes(payload, codec='jsonl'):
+    """
+    The bytes a payload from iter_raw_records() took up in its file, so it can be copied into another one as is.
+    """
+    return payload if codec == 'jsonl' else RECORD_LENGTH.pack(len(payload)) + payload
+
+
+def dumps_record(obj, codec='jsonl'):
+    if codec == 'jsonl':
+        return (json.dumps(obj) + '\n').encode('utf-8')
+
+    return record_bytes(DUMPS[codec](obj), codec=codec)
+
+
+def write_record(f, obj, codec='jsonl'):
+    if codec == 'jsonl':
+        f.write(json.dumps(obj) + '\n')
+        return
+
+    payload = DUMPS[codec](obj)
+    f.write(RECORD_LENGTH.pack(len(payload)))
+    f.write(payload)
+
+
+def iter_records(f, codec='jsonl'):
+    for record, _ in iter_sized_records(f, codec=codec):
+        yield record
+
+
+def iter_sized_records(f, codec='jsonl'):
+    """
+    Yield (record, size) where size is the number of serialized bytes, or characters for jsonl, the record took up.
+    """
+    if codec == 'jsonl':
+        for line in f:
+            if line != '\n':
+                yield json.loads(line), len(line)
+        return
+
+    header = f.read(RECORD_LENGTH.size)
+    while header:
+        size = RECORD_LENGTH.unpack(header)[0]
+        yield LOADS[codec](f.read(size)), RECORD_LENGTH.size + size
+        header = f.read(RECORD_LENGTH.size)
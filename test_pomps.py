@@ -1,16 +1,43 @@
+import contextlib
+import csv
+import gzip
+import http.server
+import io
 import json
+import multiprocessing
 import shutil
+import threading
+import time
 import unittest
+import urllib.request
 
 from datetime import datetime
 from pathlib import Path
 
+import cache
+import metrics
+import pipeline
 import pomps
+import storage
+import util
 
 
 TEST_DATA = './data/test'
 
 
+def write_jsonl(path, docs):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    Path(path).write_text('\n'.join(map(json.dumps, docs)))
+    return path
+
+
+def keyed_rows(count=500, keys=37):
+    """
+    count rows spread round robin over keys '_id's ('000', '001', ...).  Most of the grouping tests start from these.
+    """
+    return [{'_id': f"{i % keys:03d}", 'n': i} for i in range(count)]
+
+
 class TestPomps(unittest.TestCase):
     def setUp(self):
         shutil.rmtree(TEST_DATA, ignore_errors=True)
@@ -52,6 +79,1164 @@ class TestPomps(unittest.TestCase):
 
         self.assertEqual(Path(grouped_path).read_text(), expected, 'Failed for group_data()')
 
+    def test_group_data_with_sampled_buckets(self):
+        jsonl_path = write_jsonl(f"{TEST_DATA}/test.jsonl", keyed_rows() + [{'_id': '005', 'n': i} for i in range(500, 700)])
+
+        def group_key_func(data):
+            return data['_id']
+
+        exact_path = pomps.group_data(source_path=jsonl_path, group_key_func=group_key_func, group_by_name='exact', group_buckets=4)
+        sampled_path = pomps.group_data(
+            source_path=jsonl_path, group_key_func=group_key_func, group_by_name='sampled', group_buckets=4, key_sample_size=20
+        )
+
+        self.assertEqual(Path(sampled_path).read_text(), Path(exact_path).read_text())
+        self.assertEqual(len(Path(sampled_path).read_text().splitlines()), 37)
+
+    def test_group_data_with_hash_partition(self):
+        jsonl_path = write_jsonl(f"{TEST_DATA}/test.jsonl", keyed_rows())
+
+        def group_key_func(data):
+            return data['_id']
+
+        range_path = pomps.group_data(source_path=jsonl_path, group_key_func=group_key_func, group_by_name='range')
+        hash_path = pomps.group_data(
+            source_path=jsonl_path, group_key_func=group_key_func, group_by_name='hash', group_buckets=5, partition='hash'
+        )
+
+        self.assertEqual(Path(hash_path).read_text(), Path(range_path).read_text())
+        self.assertEqual(len(list(Path(hash_path).parent.glob('hash_buckets/*.jsonl'))), 5)
+
+        # More parts than MAX_OPEN_RUNS are merged in passes with at most that many open at once.
+        open_parts = {'now': 0, 'max': 0}
+        open_path, max_open_runs = storage.open_path, pomps.MAX_OPEN_RUNS
+
+        @contextlib.contextmanager
+        def counting_open_path(path, mode='r', *args, **kwargs):
+            counted = '_parts/' in str(path) and mode == 'r'
+            with open_path(path, mode, *args, **kwargs) as f:
+                open_parts['now'] += counted
+                open_parts['max'] = max(open_parts['max'], open_parts['now'])
+                try:
+                    yield f
+                finally:
+                    open_parts['now'] -= counted
+
+        storage.open_path, pomps.MAX_OPEN_RUNS = counting_open_path, 3
+        try:
+            for codec in ['jsonl', 'pickle']:
+                many_parts_path = pomps.group_data(
+                    source_path=jsonl_path,
+                    group_key_func=group_key_func,
+                    group_by_name=f"many_parts_{codec}",
+                    group_buckets=10,
+                    partition='hash',
+                    codec=codec,
+                    compression='gzip',
+                )
+                with storage.open_path(many_parts_path) as f:
+                    records = list(storage.iter_records(f, codec=codec))
+                with open(range_path, encoding='utf-8') as f:
+                    self.assertEqual(records, [json.loads(line) for line in f], codec)
+        finally:
+            storage.open_path, pomps.MAX_OPEN_RUNS = open_path, max_open_runs
+
+        self.assertEqual(open_parts['max'], 3)
+
+    def test_group_data_decodes_rows_once(self):
+        jsonl_path = write_jsonl(f"{TEST_DATA}/test.jsonl", keyed_rows())
+        expected = {}
+        for row in keyed_rows():
+            expected.setdefault(row['_id'], []).append(row)
+        expected = [{'group_key': key, 'data': expected[key]} for key in sorted(expected)]
+
+        calls = {'document_decodes': 0, 'group_key_func': 0}
+        json_loads = json.loads
+
+        def counting_json_loads(s, *args, **kwargs):
+            # Source rows are json objects, while the keys carried in jsonl buckets are json strings.
+            calls['document_decodes'] += s[:1] in ('{', b'{')
+            return json_loads(s, *args, **kwargs)
+
+        def group_key_func(data):
+            calls['group_key_func'] += 1
+            return data['_id']
+
+        configs = {
+            'single_bucket': {'group_buckets': 1},
+            'range': {'group_buckets': 4},
+            'hash': {'group_buckets': 4, 'partition': 'hash'},
+        }
+        for codec in ['jsonl', 'pickle', 'marshal']:
+            for config_name, kwargs in configs.items():
+                calls.update(document_decodes=0, group_key_func=0)
+                json.loads = counting_json_loads
+                try:
+                    grouped_path = pomps.group_data(
+                        source_path=jsonl_path,
+                        group_key_func=group_key_func,
+                        group_by_name=f"{codec}_{config_name}",
+                        codec=codec,
+                        memory_multiplier=1.0,
+                        **kwargs,
+                    )
+                finally:
+                    json.loads = json_loads
+
+                self.assertEqual(calls, {'document_decodes': 500, 'group_key_func': 500}, (codec, config_name))
+                with storage.open_path(grouped_path) as f:
+                    self.assertEqual(list(storage.iter_records(f, codec=codec)), expected, (codec, config_name))
+
+    def test_group_data_with_workers(self):
+        jsonl_path = write_jsonl(f"{TEST_DATA}/test.jsonl", keyed_rows())
+
+        serial_path = pomps.group_data(source_path=jsonl_path, group_key_func=lambda x: x['_id'], group_by_name='serial')
+
+        for partition in ['range', 'hash']:
+            parallel_path = pomps.group_data(
+                source_path=jsonl_path,
+                group_key_func=lambda x: x['_id'],
+                group_by_name=partition,
+                group_buckets=4,
+                partition=partition,
+                workers=2,
+            )
+
+            self.assertEqual(Path(parallel_path).read_text(), Path(serial_path).read_text(), partition)
+
+    def test_group_data_with_codecs(self):
+        jsonl_path = write_jsonl(f"{TEST_DATA}/test.jsonl", keyed_rows())
+
+        jsonl_grouped_path = pomps.group_data(source_path=jsonl_path, group_key_func=lambda x: x['_id'], group_by_name='jsonl')
+        with open(jsonl_grouped_path, encoding='utf-8') as f:
+            expected = [json.loads(line) for line in f]
+
+        for codec, compression, partition in [('pickle', 'gzip', 'range'), ('marshal', None, 'hash'), ('jsonl', 'bz2', 'hash')]:
+            grouped_path = pomps.group_data(
+                source_path=jsonl_path,
+                group_key_func=lambda x: x['_id'],
+                group_by_name=f"{codec}_{compression}_{partition}",
+                group_buckets=3,
+                partition=partition,
+                codec=codec,
+                compression=compression,
+            )
+
+            self.assertEqual(storage.detect(grouped_path), (codec, compression))
+            with storage.open_path(grouped_path) as f:
+                self.assertEqual(list(storage.iter_records(f, codec=codec)), expected, grouped_path)
+
+    def test_group_data_with_spilling(self):
+        jsonl_path = write_jsonl(f"{TEST_DATA}/test.jsonl", keyed_rows() + [{'_id': '005', 'n': i} for i in range(500, 900)])
+
+        expected_path = pomps.group_data(source_path=jsonl_path, group_key_func=lambda x: x['_id'], group_by_name='expected')
+        with open(expected_path, encoding='utf-8') as f:
+            expected = [json.loads(line) for line in f]
+
+        for codec, group_buckets in [('jsonl', 1), ('jsonl', 3), ('pickle', 3)]:
+            grouped_path = pomps.group_data(
+                source_path=jsonl_path,
+                group_key_func=lambda x: x['_id'],
+                group_by_name=f"spilled_{codec}_{group_buckets}",
+                group_buckets=group_buckets,
+                codec=codec,
+                spill_bytes=2_000,
+            )
+
+            with storage.open_path(grouped_path) as f:
+                self.assertEqual(list(storage.iter_records(f, codec=codec)), expected, grouped_path)
+
+            self.assertFalse(list(Path(grouped_path).parent.glob('*_spill')))
+
+        # Pickled groups can't be streamed out of the runs, so the hot key is chunked instead of built whole.
+        spill_chunk_rows = pomps.SPILL_CHUNK_ROWS
+        pomps.SPILL_CHUNK_ROWS = 100
+        try:
+            grouped_path = pomps.group_data(
+                source_path=jsonl_path,
+                group_key_func=lambda x: x['_id'],
+                group_by_name='spilled_chunks',
+                group_buckets=3,
+                codec='pickle',
+                spill_bytes=2_000,
+            )
+        finally:
+            pomps.SPILL_CHUNK_ROWS = spill_chunk_rows
+
+        with storage.open_path(grouped_path) as f:
+            records = list(storage.iter_records(f, codec='pickle'))
+        self.assertLessEqual(max(len(record['data']) for record in records), 100)
+        self.assertGreater(len(records), len(expected))
+        chunked = {}
+        for record in records:
+            chunked.setdefault(record['group_key'], []).extend(record['data'])
+        self.assertEqual([{'group_key': key, 'data': chunked[key]} for key in chunked], expected)
+
+        # With more runs than MAX_OPEN_RUNS, they are merged in several passes with at most that many open at once.
+        open_runs = {'now': 0, 'max': 0}
+        open_file, max_open_runs = storage.open_file, pomps.MAX_OPEN_RUNS
+
+        @contextlib.contextmanager
+        def counting_open_file(path, mode='r', *args, **kwargs):
+            counted = '_spill/' in str(path) and mode == 'r'
+            with open_file(path, mode, *args, **kwargs) as f:
+                open_runs['now'] += counted
+                open_runs['max'] = max(open_runs['max'], open_runs['now'])
+                try:
+                    yield f
+                finally:
+                    open_runs['now'] -= counted
+
+        storage.open_file, pomps.MAX_OPEN_RUNS = counting_open_file, 3
+        try:
+            grouped_path = pomps.group_data(
+                source_path=jsonl_path, group_key_func=lambda x: x['_id'], group_by_name='many_runs', spill_bytes=500
+            )
+        finally:
+            storage.open_file, pomps.MAX_OPEN_RUNS = open_file, max_open_runs
+
+        with open(grouped_path, encoding='utf-8') as f:
+            self.assertEqual([json.loads(line) for line in f], expected)
+
+        summary = json.loads(Path(f"{grouped_path}.metrics.json").read_text())
+        self.assertGreater(summary['buckets'][0]['spilled_runs'], 3 * 3)
+        self.assertEqual(open_runs['max'], 3)
+
+    def test_group_data_metrics(self):
+        jsonl_path = write_jsonl(f"{TEST_DATA}/test.jsonl", keyed_rows())
+
+        events = []
+        messages = []
+
+        def callback(event, stage_metrics, payload):
+            events.append((event, stage_metrics.name if stage_metrics else None))
+            if event == 'progress':
+                messages.append(payload.split(' ')[0])
+
+        def run():
+            return pomps.group_data(
+                source_path=jsonl_path, group_key_func=lambda x: x['_id'], group_buckets=4, partition='hash', workers=2
+            )
+
+        metrics.add_callback(callback)
+        metrics.configure(detailed_timings=True, profile='cprofile')
+        try:
+            grouped_path = run()
+            self.assertIn('[estimate_memory_multiplier]', messages)
+
+            # Existing output is returned before the source is sampled.
+            messages.clear()
+            self.assertEqual(run(), grouped_path)
+            self.assertNotIn('[estimate_memory_multiplier]', messages)
+        finally:
+            metrics.configure(detailed_timings=False, profile=None)
+            metrics.remove_callback(callback)
+
+        summary = json.loads(Path(f"{grouped_path}.metrics.json").read_text())
+
+        self.assertEqual(summary['stage'], 'group_data')
+        self.assertEqual(summary['counters']['rows_in'], 500)
+        self.assertEqual(summary['counters']['rows_out'], 37)
+        self.assertEqual(sum(bucket['rows'] for bucket in summary['buckets']), 500)
+        self.assertEqual(sum(bucket['groups'] for bucket in summary['buckets']), 37)
+        self.assertEqual(summary['bytes_read'], Path(jsonl_path).stat().st_size)
+        self.assertEqual(summary['bytes_written'], Path(grouped_path).stat().st_size)
+        self.assertEqual(set(summary['timings']), {'user_func', 'codec', 'io_and_other'})
+        self.assertTrue(Path(f"{grouped_path}.prof").is_file())
+
+        stage_events = [event for event, name in events if name == 'group_data' and event != 'progress']
+        self.assertEqual(stage_events, ['start'] + ['bucket'] * 4 + ['finish'])
+
+    def test_sparse_index_lookups(self):
+        jsonl_path = write_jsonl(f"{TEST_DATA}/test.jsonl", keyed_rows())
+
+        for codec, compression in [('jsonl', None), ('pickle', 'gzip')]:
+            grouped_path = pomps.group_data(
+                source_path=jsonl_path,
+                group_key_func=lambda x: x['_id'],
+                group_by_name=codec,
+                codec=codec,
+                compression=compression,
+                index_every=5,
+            )
+            with storage.open_path(grouped_path) as f:
+                groups = list(storage.iter_records(f, codec=codec))
+
+            index = json.loads(Path(pomps.sparse_index_path(grouped_path)).read_text())
+            self.assertEqual(index['keys'], [group['group_key'] for group in groups[::5]])
+
+            for use_mmap in [False, True]:
+                for group in groups:
+                    self.assertEqual(pomps.lookup_group(grouped_path, group['group_key'], use_mmap=use_mmap), group['data'])
+
+                self.assertIsNone(pomps.lookup_group(grouped_path, '0101', use_mmap=use_mmap))
+                self.assertEqual(
+                    pomps.lookup_groups(grouped_path, ['030', '004', 'nope', '015'], use_mmap=use_mmap),
+                    {group['group_key']: group['data'] for group in groups if group['group_key'] in ('004', '015', '030')},
+                )
+                self.assertEqual(
+                    list(pomps.read_group_range(grouped_path, start_key='0095', end_key='020', use_mmap=use_mmap)),
+                    [group for group in groups if '0095' <= group['group_key'] <= '020'],
+                )
+                self.assertEqual(list(pomps.read_group_range(grouped_path, use_mmap=use_mmap)), groups)
+
+        # Many lookups in one call only ever seek forward, so the gzipped file is never decompressed again from the start.
+        class SeekRecorder:
+            def __init__(self, f):
+                self.f, self.seeks = f, []
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                self.f.close()
+
+            def seek(self, offset, *args):
+                self.seeks.append(offset)
+                return self.f.seek(offset, *args)
+
+            def __getattr__(self, name):
+                return getattr(self.f, name)
+
+        recorders = []
+        open_binary = storage.open_binary
+
+        def recording_open_binary(*args, **kwargs):
+            recorders.append(SeekRecorder(open_binary(*args, **kwargs)))
+            return recorders[-1]
+
+        storage.open_binary = recording_open_binary
+        try:
+            all_keys = [group['group_key'] for group in groups] + ['0015', '1000']
+            found = pomps.lookup_groups(grouped_path, all_keys[::-1])
+        finally:
+            storage.open_binary = open_binary
+
+        self.assertEqual(found, {group['group_key']: group['data'] for group in groups})
+        self.assertEqual(recorders[-1].seeks, sorted(recorders[-1].seeks))
+        self.assertLessEqual(len(recorders[-1].seeks), len(index['keys']))
+
+        # An index that no longer matches its grouped file is rebuilt rather than trusted.
+        stale_index = dict(index, offsets=[10**9] * len(index['offsets']), mtime_ns=0)
+        Path(pomps.sparse_index_path(grouped_path)).write_text(json.dumps(stale_index))
+        self.assertEqual(pomps.lookup_group(grouped_path, '036'), groups[-1]['data'])
+
+    def test_group_data_with_chunked_groups(self):
+        # '000' is a hot key holding most of the rows.
+        rows = [{'k': '000' if i % 4 else f"{i % 23:03d}", 'n': i} for i in range(400)]
+        names = [{'k': f"{i:03d}", 'name': f"name_{i}"} for i in range(0, 30, 2)]
+
+        rows_path = write_jsonl(f"{TEST_DATA}/rows.jsonl", rows)
+        names_path = pomps.group_data(source_path=write_jsonl(f"{TEST_DATA}/names.jsonl", names), group_key_func=lambda x: x['k'])
+        whole_path = pomps.group_data(source_path=rows_path, group_key_func=lambda x: x['k'], group_by_name='whole')
+        with open(whole_path) as f:
+            whole_groups = list(storage.iter_records(f))
+
+        def merge_func(val):
+            group_key, group_rows, group_names = val
+            return [{'k': group_key, 'n': [row['n'] for row in group_rows], 'names': [n['name'] for n in group_names]}]
+
+        expected_merged = Path(
+            pomps.merge_data_sources(
+                name='whole',
+                namespace=TEST_DATA,
+                data_one_jsonl_path=whole_path,
+                data_two_jsonl_path=names_path,
+                merge_func=merge_func,
+            )
+        ).read_text()
+
+        for codec, group_buckets, spill_bytes in [('jsonl', 1, None), ('jsonl', 3, 2000), ('pickle', 3, None)]:
+            chunked_path = pomps.group_data(
+                source_path=rows_path,
+                group_key_func=lambda x: x['k'],
+                group_by_name=f"chunked_{codec}_{group_buckets}",
+                group_buckets=group_buckets,
+                codec=codec,
+                spill_bytes=spill_bytes,
+                index_every=4,
+                chunk_rows=25,
+            )
+            with storage.open_path(chunked_path) as f:
+                chunks = list(storage.iter_records(f, codec=codec))
+
+            self.assertEqual(max(len(chunk['data']) for chunk in chunks), 25)
+            self.assertEqual(sum(chunk['group_key'] == '000' for chunk in chunks), 13)
+            self.assertEqual(list(pomps.join_group_chunks(chunks)), whole_groups)
+            self.assertEqual(list(pomps.read_group_range(chunked_path)), whole_groups)
+            self.assertEqual(pomps.lookup_group(chunked_path, '000'), whole_groups[0]['data'])
+
+            for lazy in [False, True]:
+                sides = []
+
+                def recording_merge_func(val):
+                    sides.append([type(data) for data in val[1:]])
+                    return merge_func(val)
+
+                merged_path = pomps.merge_data_sources(
+                    name=f"chunked_{codec}_{group_buckets}_{lazy}",
+                    namespace=TEST_DATA,
+                    data_one_jsonl_path=chunked_path,
+                    data_two_jsonl_path=names_path,
+                    merge_func=recording_merge_func,
+                    lazy=lazy,
+                )
+                self.assertEqual(Path(merged_path).read_text(), expected_merged)
+                self.assertEqual(all(side is list for side_types in sides for side in side_types), not lazy)
+
+        # Rows a lazy merge_func() leaves unread are skipped over rather than spilling into the next group.
+        merged_path = pomps.merge_data_sources(
+            name='first_rows',
+            namespace=TEST_DATA,
+            data_one_jsonl_path=chunked_path,
+            data_two_jsonl_path=names_path,
+            merge_func=lambda val: [{'k': val[0], 'first': next(val[1], None)}],
+            lazy=True,
+        )
+        self.assertEqual(
+            [json.loads(line) for line in Path(merged_path).read_text().splitlines()],
+            [{'k': group['group_key'], 'first': group['data'][0]} for group in whole_groups]
+            + [{'k': k, 'first': None} for k in ['024', '026', '028']],
+        )
+
+        # Patching a hot key with a delta gathers every chunk of it and writes it back chunked.
+        delta = [{'op': 'delete', 'data': {'k': '000', 'n': n}} for n in range(1, 400, 2)]
+        delta_path = write_jsonl(f"{TEST_DATA}/ns2/rows/delta.jsonl", delta)
+        grouped_path, changed_keys = pomps.regroup_with_delta(
+            previous_grouped_path=chunked_path,
+            delta_path=delta_path,
+            group_key_func=lambda x: x['k'],
+            row_id_func=lambda x: x['n'],
+            chunk_rows=25,
+        )
+        self.assertEqual(changed_keys, ['000'])
+        with storage.open_path(grouped_path) as f:
+            patched = list(storage.iter_records(f, codec='pickle'))
+
+        self.assertEqual(sum(chunk['group_key'] == '000' for chunk in patched), 5)
+        self.assertEqual(pomps.lookup_group(grouped_path, '000'), [row for row in whole_groups[0]['data'] if row['n'] % 2 == 0])
+        self.assertEqual(list(pomps.join_group_chunks(patched))[1:], whole_groups[1:])
+
+    def test_merge_data_sources_with_workers(self):
+        sources = {
+            'small': ([{'k': f"{i:03d}", 'v': i} for i in range(0, 300, 7)], {}),
+            'chunked': ([{'k': f"{i % 150:03d}", 'v': i} for i in range(900)], {'chunk_rows': 2}),
+            'pickled': ([{'k': f"{i % 200 + 50:03d}", 'v': i} for i in range(600)], {'codec': 'pickle', 'compression': 'gzip'}),
+        }
+
+        grouped_paths = []
+        for name, (docs, group_kwargs) in sources.items():
+            path = f"{TEST_DATA}/{name}/source_data.jsonl"
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            Path(path).write_text('\n'.join(map(json.dumps, docs)))
+            grouped_path = pomps.group_data(source_path=path, group_key_func=lambda x: x['k'], index_every=10, **group_kwargs)
+            grouped_paths.append(grouped_path)
+
+        def merge_func(val):
+            group_key, *data = val
+            return [{'k': group_key, 'v': [[row['v'] for row in rows] for rows in data]}]
+
+        key_ranges = pomps.key_range_offsets(grouped_paths, ranges=6)
+        self.assertGreater(len(key_ranges), 3)
+        for grouped_path, path_ranges in zip(grouped_paths, zip(*key_ranges)):
+            codec, _ = storage.detect(grouped_path)
+            range_keys = []
+            with storage.open_binary(grouped_path) as f:
+                for start, end in path_ranges:
+                    records = [] if start is None else pomps.read_record_range(f, codec, start, end)
+                    range_keys.append(sorted({record['group_key'] for record in records}))
+
+            # No group_key is split between two ranges.
+            keys = [key for keys in range_keys for key in keys]
+            self.assertEqual(keys, sorted(set(keys)))
+
+        summaries = {}
+        for workers in [1, 3]:
+            summaries[workers] = []
+            metrics.add_callback(lambda event, _, payload: event == 'finish' and summaries[workers].append(payload))
+            try:
+                pomps.merge_multiple_data_sources(
+                    name=f"merged_{workers}",
+                    namespace=TEST_DATA,
+                    data_jsonl_paths=grouped_paths,
+                    merge_func=merge_func,
+                    workers=workers,
+                )
+            finally:
+                metrics.CALLBACKS.pop()
+
+        one, three = f"{TEST_DATA}/merged_1/merged.jsonl", f"{TEST_DATA}/merged_3/merged.jsonl"
+        self.assertEqual(Path(three).read_text(), Path(one).read_text())
+        self.assertEqual(Path(pomps.merged_groups_path(three)).read_text(), Path(pomps.merged_groups_path(one)).read_text())
+        self.assertEqual(summaries[3][-1]['counters'], summaries[1][-1]['counters'])
+        # Rows, not the records they were chunked into.
+        self.assertEqual(summaries[1][-1]['counters']['rows_in'], sum(len(docs) for docs, _ in sources.values()))
+        self.assertFalse(Path(f"{three}.tmp_parts").exists())
+
+    def test_incremental_regroup_and_merge(self):
+        rows = [{'id': i, 'k': f"{i % 40 + 10:03d}", 'v': i} for i in range(400)]
+        names = [{'k': f"{i:03d}", 'name': f"name_{i}"} for i in range(5, 60, 3)]
+        delta = (
+            [{'op': 'update', 'data': {'id': i, 'k': f"{i % 40 + 10:03d}", 'v': -i}} for i in range(0, 400, 37)]
+            + [{'op': 'delete', 'data': {'id': i, 'k': '025'}} for i in range(15, 400, 40)]
+            + [{'op': 'delete', 'data': {'id': 7, 'k': '017'}}, {'op': 'delete', 'data': {'id': 9999, 'k': '017'}}]
+            + [{'op': 'insert', 'data': {'id': 1000 + i, 'k': k, 'v': i}} for i, k in enumerate(['001', '033', '033', '077'])]
+        )
+
+        new_rows = {row['id']: row for row in rows}
+        for op in delta:
+            if op['op'] == 'delete':
+                new_rows.pop(op['data']['id'], None)
+            else:
+                new_rows[op['data']['id']] = op['data']
+
+        def merge_func(val):
+            group_key, group_rows, group_names = val
+            return [{'k': group_key, 'v': [row['v'] for row in group_rows], 'names': [n['name'] for n in group_names]}]
+
+        names_path = pomps.group_data(source_path=write_jsonl(f"{TEST_DATA}/names.jsonl", names), group_key_func=lambda x: x['k'])
+
+        for codec, compression in [('jsonl', None), ('pickle', 'gzip')]:
+            group_kwargs = {'group_key_func': lambda x: x['k'], 'codec': codec, 'compression': compression, 'index_every': 3}
+
+            previous_source_path = write_jsonl(f"{TEST_DATA}/{codec}/ns1/rows/source_data.jsonl", rows)
+            full_source_path = write_jsonl(f"{TEST_DATA}/{codec}/full/rows/source_data.jsonl", list(new_rows.values()))
+            previous_path = pomps.group_data(source_path=previous_source_path, **group_kwargs)
+            full_path = pomps.group_data(source_path=full_source_path, **group_kwargs)
+
+            grouped_path, changed_keys = pomps.regroup_with_delta(
+                previous_grouped_path=previous_path,
+                delta_path=write_jsonl(f"{TEST_DATA}/{codec}/ns2/rows/delta.jsonl", delta),
+                group_key_func=lambda x: x['k'],
+                row_id_func=lambda x: x['id'],
+                index_every=3,
+            )
+
+            self.assertEqual(Path(grouped_path).name, Path(full_path).name)
+            self.assertEqual(changed_keys, sorted({op['data']['k'] for op in delta}))
+            with storage.open_path(grouped_path) as f, storage.open_path(full_path) as expected:
+                self.assertEqual(list(storage.iter_records(f, codec=codec)), list(storage.iter_records(expected, codec=codec)))
+            self.assertEqual(pomps.lookup_group(grouped_path, '077'), [{'id': 1003, 'k': '077', 'v': 3}])
+
+            merged_paths = {}
+            for run, path in [('ns1', previous_path), ('full', full_path)]:
+                merged_paths[run] = pomps.merge_data_sources(
+                    name='merged',
+                    namespace=f"{TEST_DATA}/{codec}/{run}",
+                    data_one_jsonl_path=path,
+                    data_two_jsonl_path=names_path,
+                    merge_func=merge_func,
+                )
+
+            merged_keys = []
+            merged_path = pomps.merge_data_sources(
+                name='merged',
+                namespace=f"{TEST_DATA}/{codec}/ns2",
+                data_one_jsonl_path=grouped_path,
+                data_two_jsonl_path=names_path,
+                merge_func=lambda val: merged_keys.append(val[0]) or merge_func(val),
+                previous_merged_path=merged_paths['ns1'],
+                changed_keys=changed_keys,
+            )
+
+            self.assertEqual(merged_keys, [key for key in changed_keys if key != '025'])
+            self.assertEqual(Path(merged_path).read_text(), Path(merged_paths['full']).read_text())
+            self.assertEqual(
+                Path(pomps.merged_groups_path(merged_path)).read_text(),
+                Path(pomps.merged_groups_path(merged_paths['full'])).read_text(),
+            )
+
+    def test_compressed_stages(self):
+        names = [{'k': f"{i:03d}", 'name': f"name_{i}"} for i in range(0, 60, 3)]
+
+        def load_func(filepath):
+            Path(filepath).write_text(''.join(json.dumps({'id': i, 'k': f"{i % 40:03d}"}) + '\n' for i in range(400)))
+
+        def transform_func(data):
+            return dict(data, v=data['id'] * 2)
+
+        def merge_func(val):
+            group_key, group_rows, group_names = val
+            return [{'k': group_key, 'v': sorted(row['v'] for row in group_rows), 'names': [n['name'] for n in group_names]}]
+
+        def read_lines(path):
+            with storage.open_path(path) as f:
+                return f.read().splitlines()
+
+        outputs = {}
+        for compression in [None, 'gzip', 'bz2', 'lzma']:
+            namespace = f"{TEST_DATA}/{compression}"
+            compression_kwargs = {'compression': compression, 'compression_level': 1}
+
+            transformed_path = pomps.load_and_transform_source_data(
+                name='rows', namespace=namespace, transform_func=transform_func, load_func=load_func, **compression_kwargs
+            )
+            chunked_path = pomps.load_and_transform_source_data(
+                name='chunked',
+                namespace=namespace,
+                transform_func=transform_func,
+                load_func=load_func,
+                workers=2,
+                **compression_kwargs,
+            )
+
+            suffix = storage.suffix(compression=compression)
+            self.assertEqual(transformed_path, f"{namespace}/rows/transformed_source_data{suffix}")
+            source_files = sorted(path.name for path in Path(f"{namespace}/rows").glob('source_data*'))
+            self.assertEqual(source_files, [f"source_data{suffix}"])
+            # Byte ranges can only be cut from an uncompressed source.
+            self.assertTrue(Path(f"{namespace}/chunked/source_data.jsonl").is_file())
+            self.assertEqual(read_lines(chunked_path), read_lines(transformed_path))
+
+            names_path = f"{namespace}/names/source_data{suffix}"
+            Path(names_path).parent.mkdir(parents=True, exist_ok=True)
+            with storage.open_path(names_path, 'w') as f:
+                f.write('\n'.join(map(json.dumps, names)))
+
+            group_kwargs = {'group_key_func': lambda x: x['k'], 'group_buckets': 3, 'index_every': 4, **compression_kwargs}
+            grouped_paths = [pomps.group_data(source_path=path, **group_kwargs) for path in [transformed_path, names_path]]
+            self.assertEqual(storage.detect(grouped_paths[0]), ('jsonl', compression))
+
+            merged_path = pomps.merge_data_sources(
+                name='merged',
+                namespace=namespace,
+                data_one_jsonl_path=grouped_paths[0],
+                data_two_jsonl_path=grouped_paths[1],
+                merge_func=merge_func,
+                **compression_kwargs,
+            )
+            parallel_path = pomps.merge_data_sources(
+                name='parallel',
+                namespace=namespace,
+                data_one_jsonl_path=grouped_paths[0],
+                data_two_jsonl_path=grouped_paths[1],
+                merge_func=merge_func,
+                workers=2,
+                **compression_kwargs,
+            )
+            incremental_path = pomps.merge_data_sources(
+                name='incremental',
+                namespace=namespace,
+                data_one_jsonl_path=grouped_paths[0],
+                data_two_jsonl_path=grouped_paths[1],
+                merge_func=merge_func,
+                previous_merged_path=parallel_path,
+                changed_keys=['003', '021'],
+                **compression_kwargs,
+            )
+
+            self.assertEqual(merged_path, f"{namespace}/merged/merged{suffix}")
+            for path in [parallel_path, incremental_path]:
+                self.assertEqual(read_lines(path), read_lines(merged_path))
+                self.assertEqual(
+                    Path(pomps.merged_groups_path(path)).read_text(), Path(pomps.merged_groups_path(merged_path)).read_text()
+                )
+
+            joined_path = pomps.hash_join_data_sources(
+                name='joined',
+                namespace=namespace,
+                data_one_jsonl_path=transformed_path,
+                data_two_jsonl_path=names_path,
+                group_key_func=lambda x: x['k'],
+                merge_func=lambda val: [dict(row, name=n['name']) for row in val[1] for n in val[2]],
+                **compression_kwargs,
+            )
+
+            outputs[compression] = [read_lines(path) for path in [transformed_path, merged_path, joined_path]]
+            self.assertEqual(outputs[compression], outputs[None])
+
+        level_9_path = f"{TEST_DATA}/level_9.gz"
+        with gzip.open(level_9_path, 'wb', compresslevel=9) as f:
+            f.write(b'x' * 10000)
+        self.assertEqual(storage.compression_ratio(level_9_path), 10000 / Path(level_9_path).stat().st_size)
+        self.assertEqual(storage.compression_ratio(f"{TEST_DATA}/None/rows/transformed_source_data.jsonl"), 1.0)
+
+        # gzip notes the level it was written with in its header: 4 for the fastest and 2 for the best compression.
+        self.assertEqual(Path(f"{TEST_DATA}/gzip/merged/merged.jsonl.gz").read_bytes()[8], 4)
+        self.assertEqual(Path(level_9_path).read_bytes()[8], 2)
+
+    def test_stage_cache(self):
+        people = [{'id': i, 'name': f"person {i}", 'team': f"team_{i % 7}"} for i in range(100)]
+        teams = [{'team': f"team_{i}", 'city': f"city {i}"} for i in range(7)]
+
+        def load_func(docs):
+            def func(filepath):
+                Path(filepath).write_text(''.join(json.dumps(doc) + '\n' for doc in docs))
+
+            return func
+
+        def name_transform(method):
+            return lambda doc: dict(doc, name=getattr(doc['name'], method)()) if 'name' in doc else doc
+
+        def merge_func(val):
+            team, team_people, team_cities = val
+            return [{'team': team, 'people': len(team_people), 'cities': [row['city'] for row in team_cities]}]
+
+        def run(namespace, transform_func):
+            paths = {}
+            for name, docs in [('people', people), ('teams', teams)]:
+                transformed_path = pomps.load_and_transform_source_data(
+                    name=name, namespace=namespace, transform_func=transform_func, load_func=load_func(docs)
+                )
+                paths[name] = pomps.group_data(source_path=transformed_path, group_key_func=lambda x: x['team'])
+
+            return pomps.merge_data_sources(
+                name='merged',
+                namespace=namespace,
+                data_one_jsonl_path=paths['people'],
+                data_two_jsonl_path=paths['teams'],
+                merge_func=merge_func,
+            )
+
+        started = []
+
+        def record_starts(event, stage_metrics, payload):
+            if event == 'start':
+                started.append(stage_metrics.name)
+
+        cache_root = f"{TEST_DATA}/stage_cache"
+        cache.configure(root=cache_root)
+        metrics.add_callback(record_starts)
+        try:
+            first_path = run(f"{TEST_DATA}/testing/1", transform_func=name_transform('title'))
+            self.assertEqual(len(started), 5)
+            self.assertEqual(len(list(Path(cache_root).glob('*/entry.json'))), 5)
+
+            # A new execution_date with the same sources and funcs links every output back in from the cache.
+            started.clear()
+            second_path = run(f"{TEST_DATA}/testing/2", transform_func=name_transform('title'))
+            self.assertEqual(started, [])
+            self.assertTrue(Path(second_path).samefile(first_path))
+            self.assertTrue(Path(pomps.merged_groups_path(second_path)).samefile(pomps.merged_groups_path(first_path)))
+
+            # A changed transform_func recomputes what depends on it, even in a namespace that already has outputs.  The
+            # teams have no names, so they transform the same as before and their grouping is reused.
+            started.clear()
+            third_path = run(f"{TEST_DATA}/testing/2", transform_func=name_transform('upper'))
+            self.assertEqual(
+                started, ['load_and_transform_source_data', 'group_data', 'load_and_transform_source_data', 'merge_multiple_data_sources']
+            )
+            self.assertEqual(third_path, second_path)
+            self.assertFalse(Path(third_path).samefile(first_path))
+            self.assertEqual(Path(third_path).read_text(), Path(first_path).read_text())
+            transformed_path = f"{TEST_DATA}/testing/2/people/transformed_source_data.jsonl"
+            self.assertEqual(json.loads(Path(transformed_path).read_text().splitlines()[3])['name'], 'PERSON 3')
+
+            started.clear()
+            run(f"{TEST_DATA}/testing/3", transform_func=name_transform('upper'))
+            self.assertEqual(started, [])
+
+            entries = sorted(Path(cache_root).glob('*/entry.json'), key=lambda entry: entry.stat().st_mtime)
+            self.assertEqual(len(entries), 9)
+            evicted = cache.evict(max_bytes=sum(json.loads(entry.read_text())['bytes'] for entry in entries[-3:]))
+            self.assertEqual(sorted(evicted), sorted(entry.parent.name for entry in entries[:-3]))
+
+            # Namespace outputs are still linked to the cache entries that are left, so only their own bytes count.
+            removed = cache.evict_namespaces(TEST_DATA, 'testing', max_bytes=0)
+            self.assertEqual(removed, [f"{TEST_DATA}/testing/1", f"{TEST_DATA}/testing/2"])
+            self.assertEqual([path.name for path in Path(f"{TEST_DATA}/testing").iterdir()], ['3'])
+        finally:
+            metrics.remove_callback(record_starts)
+            cache.configure(root=None)
+
+    def test_join_data_sources(self):
+        titles = [{'tconst': f"t{i:03d}", 'title': f"title {i}"} for i in range(0, 80, 2)]
+        principals = [{'tconst': f"t{i % 70:03d}", 'nconst': f"n{i}"} for i in range(300)]
+
+        paths = {}
+        for name, docs in [('titles', titles), ('principals', principals)]:
+            paths[name] = f"{TEST_DATA}/{name}/transformed_source_data.jsonl"
+            Path(paths[name]).parent.mkdir(parents=True, exist_ok=True)
+            Path(paths[name]).write_text('\n'.join(map(json.dumps, docs)))
+
+        def merge_func(val):
+            group_key, title_data, principal_data = val
+            return [dict(t, nconst=p['nconst']) for t in title_data or [{}] for p in principal_data or [{'nconst': None}]]
+
+        def join(name, **kwargs):
+            merged_path = pomps.join_data_sources(
+                name=name,
+                namespace=TEST_DATA,
+                data_one_jsonl_path=paths['titles'],
+                data_two_jsonl_path=paths['principals'],
+                group_key_func=lambda x: x['tconst'],
+                merge_func=merge_func,
+                **kwargs,
+            )
+            summary = json.loads(Path(f"{merged_path}.metrics.json").read_text())
+            return summary['stage'], sorted(Path(merged_path).read_text().splitlines())
+
+        # Hash joins are opt in, however small a side is.
+        stage, expected = join('default')
+        self.assertEqual(stage, 'merge_multiple_data_sources')
+        self.assertEqual(len(expected), 300 + 5)
+
+        self.assertEqual(join('auto_hash', strategy='auto'), ('hash_join_data_sources', expected))
+        self.assertEqual(join('auto_sort_merge', strategy='auto', broadcast_bytes=1), ('merge_multiple_data_sources', expected))
+
+        # Both strategies under one name keep their own output.
+        self.assertEqual(join('shared', strategy='hash'), ('hash_join_data_sources', expected))
+        self.assertEqual(join('shared', strategy='sort_merge'), ('merge_multiple_data_sources', expected))
+        self.assertEqual(sorted(path.name for path in Path(f"{TEST_DATA}/shared").glob('*.jsonl')), ['hash_joined.jsonl', 'merged.jsonl'])
+
+        # Both inputs in one folder are still grouped apart.
+        same_folder = {
+            'titles': write_jsonl(f"{TEST_DATA}/same_folder/titles.jsonl", titles),
+            'principals': write_jsonl(f"{TEST_DATA}/same_folder/principals.jsonl", principals),
+        }
+        merged_path = pomps.join_data_sources(
+            name='same_folder',
+            namespace=TEST_DATA,
+            data_one_jsonl_path=same_folder['titles'],
+            data_two_jsonl_path=same_folder['principals'],
+            group_key_func=lambda x: x['tconst'],
+            merge_func=merge_func,
+        )
+        self.assertEqual(sorted(Path(merged_path).read_text().splitlines()), expected)
+
+        for broadcast in ['one', 'two']:
+            for use_mmap in [False, True]:
+                merged_path = pomps.hash_join_data_sources(
+                    name=f"hash_{broadcast}_{use_mmap}",
+                    namespace=TEST_DATA,
+                    data_one_jsonl_path=paths['titles'],
+                    data_two_jsonl_path=paths['principals'],
+                    group_key_func=lambda x: x['tconst'],
+                    merge_func=merge_func,
+                    broadcast=broadcast,
+                    use_mmap=use_mmap,
+                )
+                self.assertEqual(sorted(Path(merged_path).read_text().splitlines()), expected, (broadcast, use_mmap))
+
+    def test_group_data_with_combiner(self):
+        jsonl_path = write_jsonl(f"{TEST_DATA}/test.jsonl", keyed_rows())
+
+        combiners = {
+            'count': (pomps.count_combiner(), lambda rows: len(rows)),
+            'sum': (pomps.sum_combiner(lambda x: x['n']), lambda rows: sum(row['n'] for row in rows)),
+            'top_k': (pomps.top_k_combiner(3, lambda x: x['n']), lambda rows: sorted(rows, key=lambda x: -x['n'])[:3]),
+        }
+        configs = {
+            'single_bucket': {'group_buckets': 1},
+            'range': {'group_buckets': 4},
+            'hash_workers': {'group_buckets': 4, 'partition': 'hash', 'workers': 2},
+            'pickle': {'group_buckets': 4, 'codec': 'pickle'},
+            'spilling': {'group_buckets': 1, 'spill_bytes': 200, 'memory_multiplier': 1.0},
+        }
+
+        grouped_paths = {}
+        for combiner_name, (combiner, expected_func) in combiners.items():
+            expected = {}
+            for doc in keyed_rows():
+                expected.setdefault(doc['_id'], []).append(doc)
+            expected = [{'group_key': key, 'data': [expected_func(expected[key])]} for key in sorted(expected)]
+
+            for config_name, kwargs in configs.items():
+                grouped_path = pomps.group_data(
+                    source_path=jsonl_path,
+                    group_key_func=lambda x: x['_id'],
+                    group_by_name=f"{combiner_name}_{config_name}",
+                    combiner=combiner,
+                    **kwargs,
+                )
+                with storage.open_path(grouped_path) as f:
+                    self.assertEqual(list(storage.iter_records(f, codec=kwargs.get('codec', 'jsonl'))), expected, grouped_path)
+
+                grouped_paths[(combiner_name, config_name)] = grouped_path
+
+        # Buckets hold one partial accumulator per group_key rather than every row.
+        buckets_path = Path(grouped_paths[('count', 'range')]).parent / 'buckets'
+        bucket_lines = sum(len(path.read_text().splitlines()) for path in buckets_path.glob('*.jsonl'))
+        self.assertEqual(bucket_lines, 37)
+
+        # A plain grouping under the same group_by_name neither picks up the combined file nor its buckets.
+        plain_path = pomps.group_data(
+            source_path=jsonl_path, group_key_func=lambda x: x['_id'], group_by_name='count_range', group_buckets=4
+        )
+        self.assertNotEqual(plain_path, grouped_paths[('count', 'range')])
+        self.assertEqual(sum(len(json.loads(line)['data']) for line in Path(plain_path).read_text().splitlines()), 500)
+
+    def test_pipeline(self):
+        titles = [{'tconst': f"t{i:03d}", 'title': f"title {i}", 'year': 1990 + i % 20} for i in range(60)]
+        principals = [{'tconst': f"t{i % 70:03d}", 'nconst': f"n{i}"} for i in range(300)]
+
+        paths = {}
+        for name, docs in [('titles', titles), ('principals', principals)]:
+            paths[name] = f"{TEST_DATA}/{name}/source_data.jsonl"
+            Path(paths[name]).parent.mkdir(parents=True, exist_ok=True)
+            Path(paths[name]).write_text('\n'.join(map(json.dumps, docs)))
+
+        def add_decade(doc):
+            return dict(doc, decade=doc['year'] // 10 * 10)
+
+        def merge_func(val):
+            group_key, title_data, principal_data = val
+            return [{'tconst': group_key, 'titles': title_data, 'people': [p['nconst'] for p in principal_data]}]
+
+        def count_people(doc):
+            return {'tconst': doc['tconst'], 'people': len(doc['people'])}
+
+        merged = (
+            pipeline.source(paths['titles'])
+            .map(add_decade)
+            .filter(lambda x: x['decade'] == 2000)
+            .group(lambda x: x['tconst'])
+            .merge([pipeline.source(paths['principals']).group(lambda x: x['tconst'])], merge_func=merge_func, name='joined')
+            .map(count_people)
+            .flat_map(lambda x: [x] * (x['people'] > 4))
+        )
+
+        plan = merged.explain().splitlines()
+        self.assertEqual(
+            plan[0], f"merge_data_sources {Path(TEST_DATA)}/joined with merge_func | map count_people | flat_map <lambda> of:"
+        )
+        self.assertEqual(
+            [line.split(' -> ')[0] for line in plan[1:]],
+            [
+                f"    source {paths['titles']}",
+                '    materialize map add_decade | filter <lambda>',
+                '    group_data by <lambda>',
+                f"    source {paths['principals']}",
+                '    group_data by <lambda>',
+            ],
+        )
+
+        merged_path = merged.run()
+
+        expected_titles_path = f"{TEST_DATA}/expected/titles.jsonl"
+        Path(expected_titles_path).parent.mkdir(parents=True, exist_ok=True)
+        Path(expected_titles_path).write_text('\n'.join(json.dumps(add_decade(doc)) for doc in titles if doc['year'] >= 2000))
+        grouped_paths = [
+            pomps.group_data(source_path=path, group_key_func=lambda x: x['tconst'], group_by_name='expected')
+            for path in [expected_titles_path, paths['principals']]
+        ]
+        expected_path = pomps.merge_data_sources(
+            name='expected',
+            namespace=TEST_DATA,
+            data_one_jsonl_path=grouped_paths[0],
+            data_two_jsonl_path=grouped_paths[1],
+            merge_func=lambda val: [doc for doc in map(count_people, merge_func(val)) if doc['people'] > 4],
+        )
+
+        self.assertEqual(Path(merged_path).read_text(), Path(expected_path).read_text())
+        # Only the filtered titles are materialized, the merge output is written with its row-wise stages fused in.
+        materialized_paths = list(Path(TEST_DATA).glob('*/_pipeline/*/source_data.jsonl'))
+        self.assertEqual([path.parent.parent for path in materialized_paths], [Path(f"{TEST_DATA}/titles/_pipeline")])
+
+    def test_pipelines_sharing_a_source(self):
+        source_path = f"{TEST_DATA}/rows/source_data.jsonl"
+        Path(source_path).parent.mkdir(parents=True, exist_ok=True)
+        Path(source_path).write_text('\n'.join(json.dumps({'k': f"{i % 5}", 'n': i}) for i in range(20)))
+
+        def tagger(tag):
+            return lambda doc: dict(doc, tag=tag)
+
+        grouped_paths = {}
+        for tag in ['A', 'B']:
+            grouped_paths[tag] = pipeline.source(source_path).map(tagger(tag)).group(lambda x: x['k']).run()
+            with open(grouped_paths[tag], encoding='utf-8') as f:
+                tags = {row['tag'] for line in f for row in json.loads(line)['data']}
+
+            self.assertEqual(tags, {tag})
+
+        self.assertNotEqual(grouped_paths['A'], grouped_paths['B'])
+        # The same pipeline again reuses what it wrote.
+        self.assertEqual(pipeline.source(source_path).map(tagger('A')).group(lambda x: x['k']).run(), grouped_paths['A'])
+
+        # Grouping the source itself by two different keys.
+        by_key = pipeline.source(source_path).group(lambda x: x['k']).run()
+        by_parity = pipeline.source(source_path).group(lambda x: str(x['n'] % 2)).run()
+        self.assertNotEqual(by_key, by_parity)
+        for grouped_path, expected_keys in [(by_key, ['0', '1', '2', '3', '4']), (by_parity, ['0', '1'])]:
+            with open(grouped_path, encoding='utf-8') as f:
+                self.assertEqual([json.loads(line)['group_key'] for line in f], expected_keys)
+
+    def test_estimate_memory_multiplier(self):
+        jsonl_path = f"{TEST_DATA}/test.jsonl"
+        Path(jsonl_path).parent.mkdir(parents=True, exist_ok=True)
+        Path(jsonl_path).write_text(''.join(json.dumps({'_id': i % 10, 'n': i}) + '\n' for i in range(1000)))
+
+        raw = util.estimate_memory_multiplier(jsonl_path, decode=False)
+        decoded = util.estimate_memory_multiplier(jsonl_path, decode=True)
+        grouped = util.estimate_memory_multiplier(jsonl_path, key_func=lambda x: x['_id'], decode=True)
+
+        self.assertGreater(raw, 1)
+        self.assertGreater(decoded, raw)
+        self.assertGreater(grouped, 0)
+        self.assertEqual(util.calculate_group_buckets(jsonl_path, memory_multiplier=decoded), 1)
+
+    def test_read_cgroup_available_bytes(self):
+        cgroup_root = f"{TEST_DATA}/cgroup"
+        Path(f"{cgroup_root}/memory").mkdir(parents=True, exist_ok=True)
+
+        Path(f"{cgroup_root}/memory/memory.limit_in_bytes").write_text('9223372036854771712\n')
+        Path(f"{cgroup_root}/memory/memory.usage_in_bytes").write_text('500\n')
+        self.assertIsNone(util.read_cgroup_available_bytes(cgroup_root))
+
+        Path(f"{cgroup_root}/memory/memory.limit_in_bytes").write_text('1000\n')
+        Path(f"{cgroup_root}/memory/memory.stat").write_text('cache 300\ninactive_file 100\ntotal_inactive_file 200\n')
+        self.assertEqual(util.read_cgroup_available_bytes(cgroup_root), 600)
+
+        Path(f"{cgroup_root}/memory.max").write_text('2000\n')
+        Path(f"{cgroup_root}/memory.current").write_text('1500\n')
+        self.assertEqual(util.read_cgroup_available_bytes(cgroup_root), 500)
+
+        # Without a MemAvailable line or a cgroup limit, free RAM is probed instead.
+        meminfo_path = f"{TEST_DATA}/meminfo"
+        Path(meminfo_path).write_text('MemTotal:       16384 kB\nMemFree:         4096 kB\n')
+        self.assertIsNone(util.read_meminfo_available_bytes(meminfo_path))
+
+        funcs = (util.read_meminfo_available_bytes, util.read_cgroup_available_bytes, util.probe_available_ram_bytes)
+        util.read_meminfo_available_bytes = lambda: funcs[0](meminfo_path)
+        util.read_cgroup_available_bytes = lambda: None
+        util.probe_available_ram_bytes = lambda: 4096 * 1024
+        try:
+            self.assertEqual(util.read_available_ram_bytes(), 4096 * 1024)
+        finally:
+            util.read_meminfo_available_bytes, util.read_cgroup_available_bytes, util.probe_available_ram_bytes = funcs
+
+    def test_memory_monitor(self):
+        monitor = util.MemoryMonitor(ttl=60)
+        probes = []
+
+        def probe():
+            probes.append(len(probes))
+            return probes[-1]
+
+        self.assertEqual([monitor.read('probe', probe, max_age=60) for _ in range(3)], [0, 0, 0])
+        self.assertEqual(monitor.read('probe', probe, max_age=0), 1)
+
+        monitor.start(interval=0.01)
+        try:
+            self.assertGreater(monitor.available_ram_bytes(), 0)
+            self.assertGreater(monitor.rss_bytes(), 0)
+        finally:
+            monitor.stop()
+
+        self.assertGreaterEqual(monitor.peak_rss_bytes, monitor.rss_bytes())
+
+    def test_memory_monitor_after_fork(self):
+        # A child forked while another thread holds the lock must not block on it.
+        with util.MEMORY_MONITOR.lock:
+            child = multiprocessing.get_context('fork').Process(target=util.available_ram_bytes)
+            child.start()
+            child.join(timeout=5)
+
+        if child.is_alive():
+            child.kill()
+        self.assertEqual(child.exitcode, 0)
+
+    def test_get_bucket(self):
+        bucket_map = pomps.generate_bucket_map(keys=['b', 'c', 'e', 'f', 'h', 'i'], buckets=3)
+        bucket_starts, bucket_names = pomps.bucket_boundaries(bucket_map)
+
+        self.assertEqual(bucket_names, ['b_c', 'e_f', 'h_i'])
+        self.assertEqual(
+            [pomps.get_bucket(key=key, bucket_starts=bucket_starts, bucket_names=bucket_names) for key in 'abcdefghij'],
+            ['b_c', 'b_c', 'b_c', 'b_c', 'e_f', 'e_f', 'e_f', 'h_i', 'h_i', 'h_i'],
+        )
+
+    def test_load_and_transform_sources(self):
+        tables = {f"table_{t}": [{'id': f"{t}_{i}", 'value': str(i * t)} for i in range(200)] for t in range(1, 4)}
+        in_flight = {'now': 0, 'max': 0}
+        lock = threading.Lock()
+
+        class SlowTsvHandler(http.server.BaseHTTPRequestHandler):
+            """
+            Stands in for the IMDB datasets: gzipped TSVs that take a while to download.
+            """
+
+            def do_GET(self):
+                with lock:
+                    in_flight['now'] += 1
+                    in_flight['max'] = max(in_flight['max'], in_flight['now'])
+
+                time.sleep(0.2)
+
+                text = io.StringIO()
+                writer = csv.DictWriter(text, fieldnames=['id', 'value'], delimiter='\t')
+                writer.writeheader()
+                writer.writerows(tables[self.path.strip('/')])
+                body = gzip.compress(text.getvalue().encode('utf-8'))
+
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+                with lock:
+                    in_flight['now'] -= 1
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SlowTsvHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        def load_func(url):
+            def func(filepath):
+                with urllib.request.urlopen(url) as r:
+                    with gzip.open(r, mode='rt', encoding='utf-8') as gzip_f, open(filepath, 'w', encoding='utf-8') as f:
+                        for doc in csv.DictReader(gzip_f, delimiter='\t'):
+                            f.write(json.dumps(doc) + '\n')
+
+            return func
+
+        try:
+            sources = [
+                {
+                    'name': name,
+                    'namespace': TEST_DATA,
+                    'transform_func': lambda doc: dict(doc, value=int(doc['value'])),
+                    'load_func': load_func(f"http://127.0.0.1:{server.server_port}/{name}"),
+                }
+                for name in tables
+            ]
+            transformed_paths = pomps.load_and_transform_sources(sources)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(in_flight['max'], len(tables))
+        self.assertEqual(transformed_paths, [f"{TEST_DATA}/{name}/transformed_source_data.jsonl" for name in tables])
+        for name, path in zip(tables, transformed_paths):
+            self.assertFalse(Path(f"{TEST_DATA}/{name}/source_data.jsonl.tmp").exists())
+            expected = [dict(doc, value=int(doc['value'])) for doc in tables[name]]
+            self.assertEqual([json.loads(line) for line in Path(path).read_text().splitlines()], expected)
+
+        # Already transformed sources are returned without loading them again.
+        self.assertEqual(pomps.load_and_transform_sources(sources), transformed_paths)
+
+    def test_load_and_transform_sources_forks_without_load_threads(self):
+        def load_func(seconds):
+            def func(filepath):
+                time.sleep(seconds)
+                Path(filepath).write_text(''.join(json.dumps({'id': i}) + '\n' for i in range(100)))
+
+            return func
+
+        threads_at_fork = []
+        process_pool = util.process_pool
+
+        def recording_process_pool(*args, **kwargs):
+            threads_at_fork.append([thread for thread in threading.enumerate() if thread.name.startswith('ThreadPoolExecutor')])
+            return process_pool(*args, **kwargs)
+
+        sources = [
+            {'name': 'fast_parallel', 'namespace': TEST_DATA, 'transform_func': dict, 'load_func': load_func(0), 'workers': 2},
+            {'name': 'slow', 'namespace': TEST_DATA, 'transform_func': dict, 'load_func': load_func(0.3)},
+        ]
+
+        util.process_pool = recording_process_pool
+        try:
+            transformed_paths = pomps.load_and_transform_sources(sources)
+        finally:
+            util.process_pool = process_pool
+
+        self.assertEqual(threads_at_fork, [[]])
+        for path in transformed_paths:
+            self.assertEqual(len(Path(path).read_text().splitlines()), 100)
+
     def test_load_and_transform_source_data(self):
         name = 'some_name_for_data'
 
@@ -86,6 +1271,120 @@ class TestPomps(unittest.TestCase):
 
         self.assertEqual(Path(transformed_path).read_text(), expected)
 
+    def test_stream_and_transform_source_data(self):
+        docs = [{'_id': i, 'name': f"name {i}"} for i in range(500)]
+        source_text = ''.join(json.dumps(doc) + '\n' for doc in docs)
+        expected = [{'id': doc['_id'], 'name': doc['name'].title()} for doc in docs]
+        progress = {'produced': 0, 'transformed': 0, 'max_ahead': 0}
+
+        def transform_func(data):
+            progress['transformed'] += len(json.dumps(data)) + 1
+            progress['max_ahead'] = max(progress['max_ahead'], progress['produced'] - progress['transformed'])
+            return {'id': data['_id'], 'name': data['name'].title()}
+
+        def stream_chunks():
+            # Chunks that split lines in two, as a download would.
+            for start in range(0, len(source_text), 10):
+                progress['produced'] += len(source_text[start : start + 10])
+                yield source_text[start : start + 10].encode('utf-8')
+
+        def read_jsonl(path):
+            return [json.loads(line) for line in Path(path).read_text().splitlines()]
+
+        transformed_path = pomps.stream_and_transform_source_data(
+            name='chunks', namespace=TEST_DATA, transform_func=transform_func, stream_func=stream_chunks, queue_size=2
+        )
+        self.assertEqual(read_jsonl(transformed_path), expected)
+        self.assertEqual(Path(f"{TEST_DATA}/chunks/source_data.jsonl").read_text(), source_text)
+        # The stream is held back to the 2 queued chunks, plus the one being put and the one being split into rows.
+        self.assertLessEqual(progress['max_ahead'], (2 + 2) * 10 + len(source_text.splitlines()[-1]))
+
+        # A cached source is transformed again without streaming it.
+        Path(transformed_path).unlink()
+        pomps.stream_and_transform_source_data(
+            name='chunks', namespace=TEST_DATA, transform_func=transform_func, stream_func=lambda: 1 / 0
+        )
+        self.assertEqual(read_jsonl(transformed_path), expected)
+
+        transformed_path = pomps.stream_and_transform_source_data(
+            name='rows', namespace=TEST_DATA, transform_func=transform_func, stream_func=lambda: iter(docs), cache_source=False
+        )
+        self.assertEqual(read_jsonl(transformed_path), expected)
+        self.assertFalse(Path(f"{TEST_DATA}/rows/source_data.jsonl").exists())
+
+        def failing_stream():
+            yield from docs[:10]
+            raise ValueError('connection reset')
+
+        with self.assertRaisesRegex(Exception, 'connection reset'):
+            pomps.stream_and_transform_source_data(
+                name='failing', namespace=TEST_DATA, transform_func=transform_func, stream_func=failing_stream
+            )
+        self.assertFalse(Path(f"{TEST_DATA}/failing/transformed_source_data.jsonl").exists())
+        self.assertFalse(Path(f"{TEST_DATA}/failing/source_data.jsonl").exists())
+
+    def test_load_and_transform_source_data_with_workers(self):
+        def transform_func(data):
+            return {'id': data['_id'], 'name': data['name'].title()}
+
+        def load_func(filepath):
+            Path(filepath).write_text(''.join(json.dumps({'_id': i, 'name': f"name {i}"}) + '\n' for i in range(1000)))
+
+        namespace = pomps.namespace(root_dir=TEST_DATA, env='testing', execution_date=datetime.now())
+        transformed_path = pomps.load_and_transform_source_data(
+            name='chunked', namespace=namespace, transform_func=transform_func, load_func=load_func, workers=3
+        )
+
+        expected = ''.join(json.dumps({'id': i, 'name': f"Name {i}"}) + '\n' for i in range(1000))
+
+        self.assertEqual(Path(transformed_path).read_text(), expected)
+        self.assertFalse(Path(transformed_path + '.tmp_parts').exists())
+
+    def test_load_and_transform_source_data_with_batches(self):
+        docs = [{'_id': i, 'name': f"name {i}"} if i % 3 else {'_id': i} for i in range(1000)]
+
+        def load_func(filepath):
+            # Blank lines are skipped rather than ending a batch early.
+            Path(filepath).write_text(''.join(json.dumps(doc) + '\n' + ('\n' if i % 7 else '') for i, doc in enumerate(docs)))
+
+        def transform_rows(batch):
+            self.assertLessEqual(len(batch), 64)
+            return [{'id': doc['_id'], 'name': doc['name'].title()} for doc in batch if 'name' in doc]
+
+        def transform_columns(columns):
+            self.assertEqual(list(columns), ['_id', 'name'])
+            return {'id': columns['_id'], 'named': [name is not None for name in columns['name']]}
+
+        summaries = []
+        metrics.add_callback(lambda event, _, payload: event == 'finish' and summaries.append(payload))
+        try:
+            named = [{'id': i, 'name': f"Name {i}"} for i in range(1000) if i % 3]
+            flagged = [{'id': i, 'named': bool(i % 3)} for i in range(1000)]
+            for name, kwargs, expected in [
+                ('rows', {'transform_func': transform_rows}, named),
+                ('columns', {'transform_func': transform_columns, 'batch_format': 'columns'}, flagged),
+                ('workers', {'transform_func': transform_rows, 'workers': 2}, named),
+            ]:
+                transformed_path = pomps.load_and_transform_source_data(
+                    name=name, namespace=TEST_DATA, load_func=load_func, batch_size=64, **kwargs
+                )
+                self.assertEqual([json.loads(line) for line in Path(transformed_path).read_text().splitlines()], expected)
+                counters = summaries[-1]['counters']
+                self.assertEqual((counters['rows_in'], counters['rows_out']), (1000, len(expected)))
+
+            transformed_path = pomps.stream_and_transform_source_data(
+                name='stream', namespace=TEST_DATA, transform_func=transform_rows, stream_func=lambda: iter(docs), batch_size=64
+            )
+            expected_text = Path(f"{TEST_DATA}/rows/transformed_source_data.jsonl").read_text()
+            self.assertEqual(Path(transformed_path).read_text(), expected_text)
+        finally:
+            metrics.CALLBACKS.pop()
+
+        with self.assertRaisesRegex(Exception, 'unknown batch_format'):
+            pomps.load_and_transform_source_data(
+                name='bad', namespace=TEST_DATA, transform_func=transform_rows, load_func=load_func, batch_format='arrow'
+            )
+
     def test_load_and_transform_source_data_with_grouping(self):
         name = 'some_name_for_data'
 
@@ -255,6 +1554,48 @@ class TestPomps(unittest.TestCase):
 
         self.assertEqual(Path(merged_jsonl_path).read_text(), expected)
 
+    def test_merge_multiple_data_sources(self):
+        namespace = pomps.namespace(root_dir=TEST_DATA, env='testing', execution_date=datetime.now())
+
+        sources = {
+            'names': [{'id': 'a', 'name': 'Al'}, {'id': 'b', 'name': 'Bo'}, {'id': 'd', 'name': 'Di'}],
+            'emails': [{'id': 'b', 'email': 'bo@x'}, {'id': 'b', 'email': 'bo@y'}, {'id': 'c', 'email': 'cy@x'}],
+            'phones': [{'id': 'd', 'phone': '555'}, {'id': 'a', 'phone': '123'}],
+        }
+
+        grouped_paths = []
+        for source_name, docs in sources.items():
+            codec = 'pickle' if source_name == 'emails' else 'jsonl'
+            jsonl_path = f"{namespace}/{source_name}/source_data.jsonl"
+            Path(jsonl_path).parent.mkdir(parents=True, exist_ok=True)
+            Path(jsonl_path).write_text('\n'.join(map(json.dumps, docs)))
+
+            grouped_paths.append(pomps.group_data(source_path=jsonl_path, group_key_func=lambda x: x['id'], codec=codec))
+
+        def merge_func(val):
+            group_key, names, emails, phones = val
+            return [
+                {
+                    'id': group_key,
+                    'names': [n['name'] for n in names],
+                    'emails': [e['email'] for e in emails],
+                    'phones': [p['phone'] for p in phones],
+                }
+            ]
+
+        merged_jsonl_path = pomps.merge_multiple_data_sources(
+            name='names_emails_phones', namespace=namespace, data_jsonl_paths=grouped_paths, merge_func=merge_func
+        )
+
+        expected = [
+            {'id': 'a', 'names': ['Al'], 'emails': [], 'phones': ['123']},
+            {'id': 'b', 'names': ['Bo'], 'emails': ['bo@x', 'bo@y'], 'phones': []},
+            {'id': 'c', 'names': [], 'emails': ['cy@x'], 'phones': []},
+            {'id': 'd', 'names': ['Di'], 'emails': [], 'phones': ['555']},
+        ]
+
+        self.assertEqual(Path(merged_jsonl_path).read_text(), ''.join(json.dumps(doc) + '\n' for doc in expected))
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -1,11 +1,187 @@
+import json
 import math
+import multiprocessing
+import os
 import platform
 import subprocess
+import sys
+import threading
+import time
 
 from pathlib import Path
 
+import metrics
+import storage
+
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# cgroup v1 reports "no limit" as a page aligned LONG_MAX rather than a marker like v2's 'max'.
+CGROUP_UNLIMITED = 2**60
+
+
+def read_meminfo_available_bytes(meminfo_path='/proc/meminfo'):
+    with open(meminfo_path, encoding='utf-8') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+
+    return None
+
+
+def read_cgroup_available_bytes(cgroup_root=CGROUP_ROOT):
+    """
+    Memory left under this container's cgroup limit, or None when there is no limit.  Reclaimable page cache
+    (inactive_file) is not counted as used.  Checks cgroup v2 first, then v1.
+    """
+    for limit_file, usage_file, stat_file in [
+        ('memory.max', 'memory.current', 'memory.stat'),
+        ('memory/memory.limit_in_bytes', 'memory/memory.usage_in_bytes', 'memory/memory.stat'),
+    ]:
+        limit_path = Path(cgroup_root) / limit_file
+        if not limit_path.is_file():
+            continue
+
+        limit = limit_path.read_text().strip()
+        if limit == 'max' or int(limit) >= CGROUP_UNLIMITED:
+            return None
+
+        usage = int((Path(cgroup_root) / usage_file).read_text().strip())
+
+        inactive_file = 0
+        stat_path = Path(cgroup_root) / stat_file
+        if stat_path.is_file():
+            for line in stat_path.read_text().splitlines():
+                if line.startswith('inactive_file '):
+                    inactive_file = int(line.split()[1])
+
+        return max(0, int(limit) - usage + inactive_file)
+
+    return None
+
+
+def read_available_ram_bytes():
+    if platform.system() != "Linux":
+        return probe_available_ram_bytes()
+
+    available = read_meminfo_available_bytes()
+    if available is None:
+        # Kernels older than 3.14 have no MemAvailable line.
+        available = probe_available_ram_bytes()
+
+    cgroup_available = read_cgroup_available_bytes()
+    if cgroup_available is not None:
+        available = cgroup_available if available is None else min(available, cgroup_available)
+
+    return available
+
+
+def read_rss_bytes():
+    """
+    Current resident set size of this process, or its peak where the current value can't be read cheaply.
+    """
+    if Path('/proc/self/statm').is_file():
+        with open('/proc/self/statm', encoding='utf-8') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    try:
+        import resource
+    except ImportError:
+        # No resource module on Windows.
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if platform.system() == "Darwin" else peak * 1024
+
+
+class MemoryMonitor:
+    """
+    Cached readings of available RAM and this process' RSS so that hot loops can ask as often as they like.  A reading
+    older than ttl seconds is refreshed on the next call, or start() keeps them fresh from a background thread instead.
+    The highest RSS seen is kept in peak_rss_bytes.
+
+    The lock is only held to look up and store readings, never while probing, and a forked child starts over with a
+    fresh lock and no sampling thread, see after_fork_in_child().
+    """
+
+    def __init__(self, ttl=1.0):
+        self.ttl = ttl
+        self.readings = {}
+        self.peak_rss_bytes = 0
+        self.lock = threading.Lock()
+        self.stop_event = None
+        self.thread = None
+
+    def read(self, name, probe, max_age):
+        with self.lock:
+            timestamp, value = self.readings.get(name, (None, None))
+
+        now = time.monotonic()
+        if timestamp is not None and now - timestamp < max_age:
+            return value
+
+        value = probe()
+        with self.lock:
+            self.readings[name] = (now, value)
+            if name == 'rss' and value:
+                self.peak_rss_bytes = max(self.peak_rss_bytes, value)
+
+        return value
+
+    def after_fork_in_child(self):
+        """
+        A fork only copies the thread that called it, so the sampling thread is gone in the child and the lock may have
+        been copied while it was held.  The child's readings are of its parent, so they are dropped too.
+        """
+        self.lock = threading.Lock()
+        self.readings = {}
+        self.stop_event = None
+        self.thread = None
+
+    def available_ram_bytes(self, max_age=None):
+        return self.read('available_ram', read_available_ram_bytes, self.ttl if max_age is None else max_age)
+
+    def rss_bytes(self, max_age=None):
+        return self.read('rss', read_rss_bytes, self.ttl if max_age is None else max_age)
+
+    def start(self, interval=0.5):
+        if self.thread:
+            return
+
+        self.stop_event = threading.Event()
+
+        def sample():
+            while not self.stop_event.wait(interval):
+                self.available_ram_bytes(max_age=0)
+                self.rss_bytes(max_age=0)
+
+        self.thread = threading.Thread(target=sample, name='pomps-memory-monitor', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.thread:
+            return
+
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+
+MEMORY_MONITOR = MemoryMonitor()
+
+if hasattr(os, 'register_at_fork'):
+    # Not available on Windows, which never forks.
+    os.register_at_fork(after_in_child=MEMORY_MONITOR.after_fork_in_child)
+
 
 def available_ram_bytes():
+    return MEMORY_MONITOR.available_ram_bytes()
+
+
+def probe_available_ram_bytes():
+    """
+    Shell out for free RAM.  Only used where /proc/meminfo is not available.
+    """
     if platform.system() == "Linux":
         free_b = subprocess.run(['free', '-b'], capture_output=True, text=True, check=True)
         free_mem = int(free_b.stdout.split('\n')[1].split()[3])
@@ -35,40 +211,162 @@ def available_ram_bytes():
     raise Exception("Unsupported Operating System")
 
 
-def calculate_group_buckets(source_path, fraction_of_ram=0.25, memory_multiplier=2.5):
-    file_size_bytes = Path(source_path).stat().st_size
+def estimate_memory_usage(source_path, memory_multiplier=2.5):
+    # Estimate the in-memory size of the data, applying a memory multiplier to its uncompressed size
+    return storage.uncompressed_size(source_path) * memory_multiplier
+
+
+def group_memory_budget(fraction_of_ram=0.25):
+    return available_ram_bytes() * fraction_of_ram
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    sys.getsizeof() of obj plus everything it holds.  Objects shared between containers are only counted once.
+    """
+    if seen is None:
+        seen = set()
+
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+
+    return size
+
+
+def estimate_memory_multiplier(source_path, key_func=None, decode=True, sample_size=1000, default=2.5):
+    """
+    Measure how many bytes of memory each uncompressed byte of source_path takes once loaded, using a sample of its lines.
+
+    decode   - Hold rows as decoded docs, otherwise as the raw line strings (which is how jsonl buckets get grouped).
+    key_func - Also group the sampled rows by key_func() so the dict and list overhead of grouping is counted.
+    """
+    lines = sample_lines_from_file(source_path, sample_size=sample_size)
+    if not lines:
+        return default
+
+    if key_func:
+        loaded = {}
+        for line in lines:
+            doc = json.loads(line)
+            loaded.setdefault(key_func(doc), []).append(doc if decode else line)
+    else:
+        loaded = [json.loads(line) if decode else line for line in lines]
 
-    available_ram = available_ram_bytes()
+    file_bytes = sum(len(line.encode('utf-8')) + 1 for line in lines)
+    memory_bytes = deep_sizeof(loaded)
+    memory_multiplier = memory_bytes / file_bytes
 
-    # Estimate the in-memory size of the data, applying a memory multiplier
-    estimated_memory_usage = file_size_bytes * memory_multiplier
+    metrics.progress(
+        f"[estimate_memory_multiplier] {source_path}: sampled {len(lines)} lines, {file_bytes} bytes on disk, "
+        f"{memory_bytes} bytes in memory.  memory_multiplier: {memory_multiplier:.2f}"
+    )
 
-    max_memory_per_bucket = available_ram * fraction_of_ram
+    return memory_multiplier
+
+
+def calculate_group_buckets(source_path, fraction_of_ram=0.25, memory_multiplier=None, workers=1):
+    """
+    With workers > 1, that many buckets are grouped at the same time, so each bucket only gets its share of the budget.
+    Without a memory_multiplier, one is measured from a sample of source_path.
+    """
+    if memory_multiplier is None:
+        memory_multiplier = estimate_memory_multiplier(source_path)
+
+    estimated_memory_usage = estimate_memory_usage(source_path, memory_multiplier=memory_multiplier)
+
+    max_memory_per_bucket = group_memory_budget(fraction_of_ram=fraction_of_ram) / workers
 
     group_buckets = max(1, math.ceil(estimated_memory_usage / max_memory_per_bucket))
 
+    metrics.progress(
+        f"[calculate_group_buckets] estimated_memory_usage MB: {estimated_memory_usage/(1024**2):.1f}, "
+        f"max_memory_per_bucket MB: {max_memory_per_bucket/(1024**2):.1f}, group_buckets: {group_buckets}"
+    )
+
     return group_buckets
 
 
+def process_pool(workers, initializer=None, initargs=()):
+    """
+    Prefer fork so the user funcs handed to initializer (often lambdas or closures) are inherited by the workers instead
+    of pickled.  Where fork is not available, as on Windows, those funcs must be picklable.
+    """
+    start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+
+    return multiprocessing.get_context(start_method).Pool(processes=workers, initializer=initializer, initargs=initargs)
+
+
+def newline_aligned_chunks(file_path, chunks):
+    """
+    Split file_path into at most chunks (start, end) byte ranges, each starting at the beginning of a line.  file_path
+    must be uncompressed.
+    """
+    file_size = Path(file_path).stat().st_size
+    offsets = [0]
+
+    with open(file_path, 'rb') as file:
+        for i in range(1, chunks):
+            pos = file_size * i // chunks
+            if pos <= offsets[-1]:
+                continue
+
+            file.seek(pos - 1)
+            file.readline()
+            if offsets[-1] < file.tell() < file_size:
+                offsets.append(file.tell())
+
+    offsets.append(file_size)
+
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
 def sample_lines_from_file(file_path, sample_size=100):
+    """
+    Seek to sample_size evenly spaced byte offsets and return the first full line found after each one.  The file is read
+    in binary mode since a text mode seek() to an arbitrary byte offset can land in the middle of a multi-byte character.
+
+    Compressed files can't be seeked into cheaply, so the first sample_size lines are returned instead.
+    """
     lines = []
 
-    with open(file_path, 'r', encoding='utf-8') as file:
-        file_size = Path(file_path).stat().st_size
+    if storage.detect(file_path)[1]:
+        with storage.open_binary(file_path) as file:
+            for line in file:
+                if line.strip():
+                    lines.append(line.strip().decode('utf-8'))
+                if len(lines) >= sample_size:
+                    break
+
+        return lines
 
-        positions = [file_size * (i // sample_size) for i in range(sample_size)]
+    file_size = Path(file_path).stat().st_size
+    positions = [file_size * i // sample_size for i in range(sample_size)]
 
+    with open(file_path, 'rb') as file:
+        last_line_start = None
         for pos in positions:
-            file.seek(pos)
-            # Move to the start of the next line if not at the start of a line
+            # Step back one byte so that a position already sitting at the start of a line is not skipped.
             if pos != 0:
+                file.seek(pos - 1)
                 file.readline()
+            else:
+                file.seek(0)
+
+            line_start = file.tell()
+            if line_start == last_line_start:
+                # Small files will map many positions onto the same line.  Don't count it twice.
+                continue
+            last_line_start = line_start
 
             line = file.readline().strip()
             if line:
-                lines.append(line)
-
-            if len(lines) >= sample_size:
-                break
+                lines.append(line.decode('utf-8'))
 
     return lines